@@ -0,0 +1,420 @@
+import os
+import sys
+import json
+import time
+import struct
+import socket
+import argparse
+import platform
+import subprocess
+import multiprocessing
+import asyncio
+import tracemalloc
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import rc4, StationURL, LAZY_MODULES
+from kerberos import derive_kerberos_key
+from rmc import RMCRequest
+from common import DATA_PACKET, FLAG_RELIABLE, FLAG_NEED_ACK, FLAG_HAS_SIZE
+from prudp import PRUDPServer, PRUDPClient, PRUDPPacketV0, PRUDPPacketV1
+from client import PRUDPConnection
+from capture import Replayer, NullSocket
+from netsim import Network
+
+
+def measure(func, min_time=0.2):
+    # Grow the iteration count until a batch takes long enough to time reliably
+    iterations = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        iterations *= 2 if elapsed <= 0 else max(2, int(min_time / elapsed * 1.2))
+
+    runs = []
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        runs.append((time.perf_counter() - start) / iterations)
+
+    best = min(runs)
+    return {
+        "iterations": iterations,
+        "ns_per_op": best * 1e9,
+        "ops_per_sec": 1 / best if best > 0 else 0
+    }
+
+
+def micro_benchmarks(min_time=0.2):
+    key = b"CD&ML"
+    payload_small = os.urandom(64)
+    payload_large = os.urandom(1300)
+
+    request = RMCRequest(protocol=10, call=1, method=2, params=os.urandom(256))
+    request_bytes = request.to_bytes()
+
+    url = "prudps:/address=127.0.0.1;port=60001;CID=1;PID=2;sid=1;stream=10;type=2"
+
+    client = PRUDPClient(None, None)
+    client.set_access_key("ridfebb9")
+    client.set_session_key(os.urandom(32))
+    v0 = PRUDPPacketV0(client)
+    v1 = PRUDPPacketV1(client)
+    v1.packet_type = DATA_PACKET
+    header = os.urandom(12)
+    connection_signature = os.urandom(16)
+    options = os.urandom(8)
+
+    cases = {
+        "rc4_64": lambda: rc4(key, payload_small),
+        "rc4_1300": lambda: rc4(key, payload_large),
+        "derive_kerberos_key": lambda: derive_kerberos_key(1337, b"password"),
+        "rmc_request_from_bytes": lambda: RMCRequest.from_bytes(request_bytes),
+        "rmc_request_to_bytes": lambda: request.to_bytes(),
+        "station_url_parse": lambda: StationURL(url),
+        "calculate_checksum_1300": lambda: v0.calculate_checksum(payload_large),
+        "calculate_signature_1300": lambda: v1.calculate_signature(header, connection_signature, options, payload_large)
+    }
+
+    results = {}
+    for name, func in cases.items():
+        results[name] = measure(func, min_time)
+        print(f"{name:30} {results[name]['ns_per_op']:12.0f} ns/op", file=sys.stderr)
+    return results
+
+
+def import_benchmark(module="prudp", runs=5):
+    # Every run is a fresh interpreter, which is what a short-lived worker or test shard pays at startup
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = f"import {module}, sys, json; print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))"
+    best = None
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=root, capture_output=True, text=True, check=True)
+        children = []
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            fields = line[len("import time:"):].split("|")
+            if not fields[0].strip().isdigit():
+                continue
+            # Children are listed before their parent, two more spaces in per level
+            depth = (len(fields[2]) - len(fields[2].lstrip()) - 1) // 2
+            name = fields[2].strip()
+            if depth == 0 and name == module:
+                total = int(fields[1])
+                break
+            if depth == 0:
+                children = []
+            elif depth == 1:
+                children.append((name, int(fields[1])))
+        if best is None or total < best[0]:
+            best = (total, children, json.loads(result.stdout))
+
+    total, children, loaded = best
+    slowest = sorted(children, key=lambda child: -child[1])[:10]
+    return {
+        "module": module,
+        "import_ms": total / 1000,
+        "slowest_imports_ms": {name: us / 1000 for name, us in slowest},
+        "lazy_modules_loaded": loaded
+    }
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def traced_memory(packet):
+    # First call starts tracing, the second returns what was allocated since and stops
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        return struct.pack("<Q", 0)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return struct.pack("<Q", memory)
+
+
+def loopback_server(port):
+    # Runs in its own process, so the memory figure leaves out everything the clients allocate
+    server = PRUDPServer()
+    server.access_key = "ridfebb9"
+    server.register_rmc(10, 1, lambda packet: packet.rmc_request["params"])
+    server.register_rmc(10, 2, traced_memory)
+    server.listen(f"127.0.0.1:{port}")
+
+
+def loopback_benchmark(sessions=100, calls=20, timeout=30.0):
+    port = free_port()
+    server = multiprocessing.Process(target=loopback_server, args=(port,), daemon=True)
+    server.start()
+    time.sleep(0.5)
+
+    latencies = []
+
+    async def session(connection):
+        for _ in range(calls):
+            start = time.perf_counter()
+            await connection.call(10, 1, bytes(64))
+            latencies.append(time.perf_counter() - start)
+
+    async def run():
+        connections = [PRUDPConnection(1, "ridfebb9") for _ in range(sessions)]
+
+        # Memory is what the server allocated across the handshakes, asked for over a separate session
+        probe = PRUDPConnection(1, "ridfebb9")
+        await asyncio.wait_for(probe.connect(("127.0.0.1", port)), timeout)
+        await probe.call(10, 2)
+        await asyncio.wait_for(asyncio.gather(*[c.connect(("127.0.0.1", port)) for c in connections]), timeout)
+        memory = struct.unpack("<Q", await probe.call(10, 2))[0]
+        await probe.close()
+
+        # The handshakes are not part of the timed run, so neither are their packets
+        packets_out = -sum(c.stats["packets_out"] for c in connections)
+        packets_in = -sum(c.stats["packets_in"] for c in connections)
+        start = time.perf_counter()
+        await asyncio.wait_for(asyncio.gather(*[session(c) for c in connections], return_exceptions=True), timeout)
+        elapsed = time.perf_counter() - start
+
+        packets_out += sum(c.stats["packets_out"] for c in connections)
+        packets_in += sum(c.stats["packets_in"] for c in connections)
+        retransmits = sum(c.stats["retransmits"] for c in connections)
+        for connection in connections:
+            await connection.close()
+        return memory, elapsed, packets_out, packets_in, retransmits
+
+    try:
+        memory, elapsed, packets_out, packets_in, retransmits = asyncio.run(run())
+    finally:
+        server.terminate()
+        server.join()
+    handled = len(latencies)
+    return {
+        "sessions": sessions,
+        "calls_sent": sessions * calls,
+        "calls_completed": handled,
+        "calls_per_sec": handled / elapsed if elapsed > 0 else 0,
+        # Every datagram the server received or sent during the timed calls, counted on the client side
+        "packets_per_sec": (packets_out + packets_in) / elapsed if elapsed > 0 else 0,
+        "client_packets_out": packets_out,
+        "client_packets_in": packets_in,
+        "retransmits": retransmits,
+        "latency_p50_us": percentile(latencies, 0.50) * 1e6,
+        "latency_p99_us": percentile(latencies, 0.99) * 1e6,
+        "latency_mean_us": statistics.mean(latencies) * 1e6 if latencies else 0,
+        "server_memory_per_session_bytes": memory / sessions
+    }
+
+
+def netsim_benchmark(sessions=20, calls=20, loss=0.05, seed=0, latency=0.02, bandwidth=1_000_000):
+    # Same workload as the loopback benchmark but over a simulated lossy link in virtual time
+    server = PRUDPServer()
+    server.access_key = "ridfebb9"
+    server.register_rmc(10, 1, lambda packet: packet.rmc_request["params"])
+    network = Network(server, seed=seed, loss=loss, latency=latency, jitter=latency / 4, bandwidth=bandwidth, queue_bytes=64000)
+
+    async def session(connection):
+        for _ in range(calls):
+            await connection.call(10, 1, bytes(1024))
+
+    async def run():
+        connections = [PRUDPConnection(1, "ridfebb9", seed=seed + i) for i in range(sessions)]
+        await asyncio.gather(*[c.connect(network.server_address) for c in connections])
+        start = network.loop.time()
+        await asyncio.gather(*[session(c) for c in connections])
+        elapsed = network.loop.time() - start
+        retransmits = sum(c.stats["retransmits"] for c in connections)
+        for connection in connections:
+            await connection.close()
+        return elapsed, retransmits
+
+    elapsed, retransmits = network.run(run())
+    stats = network.stats()
+    network.close()
+    return {
+        "sessions": sessions,
+        "loss": loss,
+        "seed": seed,
+        "goodput_bytes_per_sec": sessions * calls * 2048 / elapsed if elapsed > 0 else 0,
+        "client_retransmits": retransmits,
+        "server_retransmits": sum(client.retransmits for client in server.clients.values()),
+        "virtual_seconds": stats["virtual_time"],
+        "wall_seconds": stats["wall_time"],
+        "uplink": stats["uplink"],
+        "downlink": stats["downlink"]
+    }
+
+
+def fanout_benchmark(clients=1000, size=2000, min_time=0.2):
+    server = PRUDPServer()
+    server.access_key = "ridfebb9"
+    server.socket = NullSocket()
+    recipients = []
+    for i in range(clients):
+        client = server.new_client(("127.0.0.1", 10000 + i))
+        client.set_session_key(os.urandom(32))
+        client.connected = True
+        recipients.append(client)
+
+    request = RMCRequest(protocol=14, call=1, method=1, params=os.urandom(size)).to_bytes()
+
+    def clear():
+        # Nothing acks these packets, so drop them before the send window fills up
+        for client in recipients:
+            client.pending.clear()
+            client.in_flight = 0
+
+    def broadcast():
+        server.broadcast(recipients, request)
+        clear()
+
+    def unicast():
+        for client in recipients:
+            packet = server.new_packet(client, None).new(DATA_PACKET, FLAG_RELIABLE | FLAG_NEED_ACK | FLAG_HAS_SIZE)
+            packet.payload = request
+            server.send(packet)
+        clear()
+
+    results = {"clients": clients, "size": size}
+    for name, func in (("broadcast", broadcast), ("unicast", unicast)):
+        results[name] = measure(func, min_time)
+        results[name]["us_per_client"] = results[name]["ns_per_op"] / clients / 1000
+        print(f"fanout_{name:23} {results[name]['us_per_client']:12.2f} us/client", file=sys.stderr)
+    return results
+
+
+def replay_benchmark(path, speed=0.0, prudp_version=1, access_key="", kerberos_password=""):
+    server = PRUDPServer()
+    server.prudp_version = prudp_version
+    server.access_key = access_key
+    server.kerberos_password = kerberos_password
+    return Replayer(server, path).run(speed)
+
+
+def git_commit():
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=root, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+RESULT_METADATA = ("commit", "python", "platform", "timestamp")
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    for name, result in new.get("micro", {}).items():
+        if name in old.get("micro", {}):
+            before = old["micro"][name]["ns_per_op"]
+            after = result["ns_per_op"]
+            print(f"{name:30} {before:12.0f} -> {after:12.0f} ns/op ({(after - before) / before * 100:+.1f}%)")
+
+    # Every other section is compared figure by figure, nested ones included (fanout, netsim link stats)
+    before_values = {}
+    after_values = {}
+    for section in new:
+        if section in RESULT_METADATA or section == "micro" or section not in old:
+            continue
+        flatten(section, old[section], before_values)
+        flatten(section, new[section], after_values)
+    for key, after in after_values.items():
+        before = before_values.get(key)
+        if before:
+            print(f"{key:40} {before:14.1f} -> {after:14.1f} ({(after - before) / before * 100:+.1f}%)")
+
+
+def flatten(prefix, value, out):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            # Iteration counts only say how long a batch ran, not how fast
+            if key != "iterations":
+                flatten(f"{prefix}.{key}", item, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the nex hot paths")
+    parser.add_argument("--micro", action="store_true", help="run the per-function microbenchmarks")
+    parser.add_argument("--loopback", action="store_true", help="run the end-to-end loopback benchmark")
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--calls", "--packets", type=int, default=20, help="RMC calls per session")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per microbenchmark batch")
+    parser.add_argument("--netsim", action="store_true", help="run the loopback workload over a simulated lossy network")
+    parser.add_argument("--loss", type=float, default=0.05, help="packet loss of the simulated network")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the simulated network")
+    parser.add_argument("--import-time", action="store_true", help="measure the cold import time of prudp")
+    parser.add_argument("--import-budget", type=float, metavar="MS", help="fail if importing prudp takes longer or loads an optional backend")
+    parser.add_argument("--fanout", action="store_true", help="run the notification fan-out benchmark")
+    parser.add_argument("--fanout-clients", type=int, default=1000)
+    parser.add_argument("--replay", metavar="CAPTURE", help="replay a capture file into a socketless server")
+    parser.add_argument("--speed", type=float, default=0.0, help="replay speed multiplier (0 = as fast as possible)")
+    parser.add_argument("--prudp-version", type=int, default=1, choices=[0, 1], help="PRUDP version of the replay server")
+    parser.add_argument("--access-key", default="", help="access key of the replay server")
+    parser.add_argument("--kerberos-password", default="", help="secure server password of the replay server")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    run_all = not (args.micro or args.loopback or args.netsim or args.fanout or args.replay or args.import_time or args.import_budget)
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time()
+    }
+    if args.import_time or args.import_budget or run_all:
+        results["import"] = import_benchmark()
+    if args.micro or run_all:
+        results["micro"] = micro_benchmarks(args.min_time)
+    if args.loopback or run_all:
+        results["loopback"] = loopback_benchmark(args.sessions, args.calls)
+    if args.netsim or run_all:
+        results["netsim"] = netsim_benchmark(args.sessions, args.calls, args.loss, args.seed)
+    if args.fanout or run_all:
+        results["fanout"] = fanout_benchmark(args.fanout_clients, min_time=args.min_time)
+    if args.replay:
+        results["replay"] = replay_benchmark(args.replay, args.speed, args.prudp_version, args.access_key, args.kerberos_password)
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.import_budget:
+        imported = results["import"]
+        if imported["import_ms"] > args.import_budget or imported["lazy_modules_loaded"]:
+            print(f"import prudp: {imported['import_ms']:.1f} ms (budget {args.import_budget:.1f} ms), "
+                  f"optional modules loaded: {imported['lazy_modules_loaded']}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
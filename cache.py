@@ -0,0 +1,139 @@
+import time
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict
+from rmc import call_handler
+
+
+def success_offset(body: bytes) -> int:
+    # Response bodies start with the protocol, the custom id for protocol 0x7F, then the success flag
+    return 3 if body[0] == 0x7F else 1
+
+
+def call_offset(body: bytes) -> int:
+    # Successful responses continue with the call id, errors with the error code and then the call id
+    offset = success_offset(body) + 1
+    if body[offset - 1] == 0:
+        offset += 4
+    return offset
+
+
+class InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.body = None
+
+
+class ResponseCache:
+    def __init__(self, max_bytes: int = 16 << 20, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.ttls: Dict[tuple, float] = {}
+        self.entries = OrderedDict()
+        self.inflight: Dict[tuple, InFlight] = {}
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.metrics = None
+
+    def enable(self, protocol: int, method: int, ttl: float):
+        # Only for methods whose response depends on nothing but the parameters
+        self.ttls[(protocol, method)] = ttl
+
+    def disable(self, protocol: int, method: int):
+        self.ttls.pop((protocol, method), None)
+        self.invalidate(protocol, method)
+
+    def invalidate(self, protocol: int = None, method: int = None):
+        with self.lock:
+            for key in [key for key in self.entries if protocol is None or key[:2] == (protocol, method)]:
+                self.size -= len(self.entries.pop(key)[1])
+
+    def count(self, name: str, key: tuple):
+        if self.metrics is not None:
+            self.metrics.inc(name, (("protocol", str(key[0])), ("method", str(key[1]))))
+
+    def call(self, handler, packet) -> bytes:
+        request = packet.rmc_request
+        ttl = self.ttls.get((request["protocol"], request["method"]))
+        if ttl is None:
+            return call_handler(handler, packet)
+
+        key = (request["protocol"], request["method"], request["custom"], hashlib.blake2b(request["params"], digest_size=16).digest())
+        cached = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > self.clock():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    cached = entry[1]
+                else:
+                    self.size -= len(self.entries.pop(key)[1])
+
+            # Concurrent misses for the same key wait for the first one instead of all running the handler
+            flight = self.inflight.get(key)
+            leader = flight is None and cached is None
+            if leader:
+                flight = self.inflight[key] = InFlight()
+                self.misses += 1
+            elif cached is None:
+                self.coalesced += 1
+
+        if cached is not None:
+            self.count("rmc_cache_hits_total", key)
+            return self.patch(cached, request["call"])
+
+        if not leader:
+            self.count("rmc_cache_coalesced_total", key)
+            flight.done.wait()
+            if flight.body is None:
+                return call_handler(handler, packet)
+            return self.patch(flight.body, request["call"])
+
+        self.count("rmc_cache_misses_total", key)
+        body = None
+        try:
+            body = call_handler(handler, packet)
+        finally:
+            flight.body = body
+            with self.lock:
+                del self.inflight[key]
+                # Errors are not cached, the next call should get another chance
+                if body is not None and body[success_offset(body)] == 1:
+                    self.store(key, body, self.clock() + ttl)
+            flight.done.set()
+        return body
+
+    def store(self, key: tuple, body: bytes, expires: float):
+        if len(body) > self.max_bytes:
+            return
+        self.entries[key] = (expires, body)
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            evicted, (_, old) = self.entries.popitem(last=False)
+            self.size -= len(old)
+            self.evictions += 1
+            self.count("rmc_cache_evictions_total", evicted)
+
+    def patch(self, body: bytes, call: int) -> bytes:
+        out = bytearray(body)
+        struct.pack_into("<I", out, call_offset(body), call)
+        return bytes(out)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions
+            }
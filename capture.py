@@ -0,0 +1,172 @@
+import os
+import time
+import socket
+import struct
+import threading
+from collections import deque
+from typing import Dict
+
+CAPTURE_MAGIC = b"NEXCAP\x00\x01"
+
+CAPTURE_DATAGRAM = 0
+CAPTURE_SIGNATURE = 1
+
+# timestamp, kind, address length, port, data length
+RECORD = struct.Struct("<dBBHI")
+
+
+def pack_address(address) -> bytes:
+    host = address[0]
+    return socket.inet_pton(socket.AF_INET6 if ":" in host else socket.AF_INET, host)
+
+
+def unpack_address(ip: bytes, port: int) -> tuple:
+    return (socket.inet_ntop(socket.AF_INET6 if len(ip) == 16 else socket.AF_INET, ip), port)
+
+
+class CaptureWriter:
+    def __init__(self, path: str, buffer_size: int = 1 << 20, flush_interval: float = 0.5):
+        self.file = open(path, "wb")
+        self.file.write(CAPTURE_MAGIC)
+        self.start = time.monotonic()
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffered = 0
+        self.records = 0
+        self.bytes = 0
+        self.running = True
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def record(self, address, data, kind: int = CAPTURE_DATAGRAM):
+        # Called from the receive threads, so only pack and queue here; the writer thread does the I/O
+        ip = pack_address(address)
+        entry = RECORD.pack(time.monotonic() - self.start, kind, len(ip), address[1], len(data)) + ip + bytes(data)
+        with self.lock:
+            if not self.running:
+                return
+            self.buffer.append(entry)
+            self.buffered += len(entry)
+            self.records += 1
+            self.bytes += len(entry)
+            full = self.buffered >= self.buffer_size
+        if full:
+            self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+            if not self.running:
+                break
+
+    def flush(self):
+        with self.lock:
+            chunks = self.buffer
+            self.buffer = []
+            self.buffered = 0
+        if chunks:
+            self.file.write(b"".join(chunks))
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+
+def read_capture(path: str):
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(CAPTURE_MAGIC):
+        raise ValueError("Not a NEX capture file")
+
+    view = memoryview(data)
+    offset = len(CAPTURE_MAGIC)
+    while offset + RECORD.size <= len(data):
+        timestamp, kind, ip_length, port, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + ip_length + length > len(data):
+            # Truncated tail from a capture that was not closed cleanly
+            break
+        address = unpack_address(bytes(view[offset:offset + ip_length]), port)
+        offset += ip_length
+        yield timestamp, kind, address, view[offset:offset + length]
+        offset += length
+
+
+class NullSocket:
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+
+    def sendto(self, data, address):
+        self.packets += 1
+        self.bytes += len(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class Replayer:
+    def __init__(self, server, path: str):
+        self.server = server
+        self.datagrams = []
+        self.signatures: Dict[tuple, deque] = {}
+        self.socket = NullSocket()
+        for timestamp, kind, address, data in read_capture(path):
+            if kind == CAPTURE_SIGNATURE:
+                # Signatures are recorded after the SYN that caused them, so collect them up front
+                self.signatures.setdefault(address, deque()).append(bytes(data))
+            else:
+                self.datagrams.append((timestamp, address, data))
+
+    def next_signature(self, client) -> bytes:
+        # Hand out the connection signatures the recorded server chose, so recorded CONNECT and DATA
+        # packets still carry valid signatures
+        signatures = self.signatures.get(client.address)
+        if signatures:
+            return signatures.popleft()
+        return os.urandom(16)
+
+    def run(self, speed: float = 1.0) -> dict:
+        # speed is a multiplier on the recorded timing; 0 replays as fast as possible
+        server = self.server
+        server.socket = self.socket
+        server.new_connection_signature = self.next_signature
+
+        datagrams = 0
+        size = 0
+        max_lag = 0.0
+        start = time.monotonic()
+        for timestamp, address, data in self.datagrams:
+            if speed:
+                lag = time.monotonic() - start - timestamp / speed
+                if lag < 0:
+                    time.sleep(-lag)
+                else:
+                    max_lag = max(max_lag, lag)
+
+            server.handle_datagram(bytearray(data), address)
+            datagrams += 1
+            size += len(data)
+
+        elapsed = time.monotonic() - start
+        return {
+            "datagrams": datagrams,
+            "bytes": size,
+            "elapsed": elapsed,
+            "datagrams_per_sec": datagrams / elapsed if elapsed > 0 else 0,
+            "max_lag": max_lag,
+            "packets_out": self.socket.packets,
+            "bytes_out": self.socket.bytes,
+            "sessions": len(server.clients)
+        }
@@ -0,0 +1,310 @@
+import os
+import random
+import struct
+import asyncio
+import weakref
+from typing import Dict
+from common import SYN_PACKET, CONNECT_PACKET, DATA_PACKET, DISCONNECT_PACKET, FLAG_ACK, FLAG_NEED_ACK, FLAG_RELIABLE, FLAG_HAS_SIZE, FLAG_MULTI_ACK
+from common import OPTION_ALL_FUNCTIONS, DummyCompression
+from rmc import RMCRequest, RMCResponse
+from errors import NEXError
+from kerberos import KerberosCipher, KerberosTicket, derive_kerberos_key, build_connect_payload
+from prudp import PRUDPClient, PRUDPPacket, PRUDPPacketV0, PRUDPPacketV1
+
+
+class ResendTimer:
+    # One timer per event loop checks every connection for packets to resend. A task per connection
+    # would wake the loop thousands of times a second with as many connections open
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        # A dict rather than a set, so connections are always checked in the same order
+        self.connections = {}
+        self.handle = None
+
+    def add(self, connection: 'PRUDPConnection'):
+        self.interval = min(self.interval, connection.resend_timeout / 4)
+        self.connections[connection] = None
+        if self.handle is None:
+            self.handle = asyncio.get_running_loop().call_later(self.interval, self.tick)
+
+    def remove(self, connection: 'PRUDPConnection'):
+        self.connections.pop(connection, None)
+        if not self.connections and self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def tick(self):
+        self.handle = None
+        for connection in list(self.connections):
+            if connection.session.pending:
+                connection.resend_pending()
+        if self.connections:
+            self.handle = asyncio.get_running_loop().call_later(self.interval, self.tick)
+
+
+resend_timers = weakref.WeakKeyDictionary()
+
+
+def resend_timer(loop) -> ResendTimer:
+    timer = resend_timers.get(loop)
+    if timer is None:
+        timer = resend_timers[loop] = ResendTimer()
+    return timer
+
+
+class PRUDPConnection(asyncio.DatagramProtocol):
+    def __init__(self, prudp_version=1, access_key="", fragment_size=1300, loss=0.0, seed=None, max_substream_id=0):
+        self.prudp_version = prudp_version
+        self.max_substream_id = max_substream_id
+        self.fragment_size = fragment_size
+        self.compression = DummyCompression()
+        self.resend_timeout = 1.0
+        self.resend_max = 5
+        self.loss = loss
+        self.random = random.Random(seed)
+
+        self.session = PRUDPClient(None, None)
+        self.session.server_side = False
+        self.session.source = 0xAF
+        self.session.destination = 0xA1
+        self.session.set_access_key(access_key)
+
+        self.transport = None
+        self.resend_timer: ResendTimer = None
+        self.acks: Dict[tuple, asyncio.Future] = {}
+        self.calls: Dict[int, asyncio.Future] = {}
+        self.call_id = 0
+        self.stats = {
+            "packets_out": 0,
+            "packets_in": 0,
+            "retransmits": 0,
+            "injected_loss_out": 0,
+            "injected_loss_in": 0
+        }
+
+    def new_packet(self, data: bytearray = None) -> PRUDPPacket:
+        if self.prudp_version == 0:
+            return PRUDPPacketV0(self.session, data)
+        return PRUDPPacketV1(self.session, data)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.fail(exc or ConnectionError("Connection closed"))
+
+    def error_received(self, exc):
+        pass
+
+    def datagram_received(self, data, addr):
+        if self.loss and self.random.random() < self.loss:
+            self.stats["injected_loss_in"] += 1
+            return
+
+        self.stats["packets_in"] += 1
+        packet = self.new_packet(bytearray(data))
+        try:
+            packet.decode()
+        except Exception:
+            return
+
+        if not packet.valid_signature():
+            return
+
+        self.handle_packet(packet)
+
+    def handle_packet(self, packet: PRUDPPacket):
+        session = self.session
+
+        if (packet.flags & FLAG_ACK) != 0 or (packet.flags & FLAG_MULTI_ACK) != 0:
+            if packet.flags & FLAG_MULTI_ACK:
+                session.acknowledge_multiple(packet.payload)
+            else:
+                session.acknowledge(packet.packet_type, packet.sequence_id, packet.substream_id)
+            future = self.acks.pop((packet.packet_type, packet.sequence_id), None)
+            if future is not None and not future.done():
+                future.set_result(packet)
+            return
+
+        if packet.substream_id > session.max_substream_id:
+            return
+
+        if (packet.flags & FLAG_NEED_ACK) != 0:
+            self.acknowledge_packet(packet)
+
+        if packet.packet_type == DATA_PACKET and packet.flags & FLAG_RELIABLE:
+            for ready in session.accept(packet):
+                self.handle_data(ready)
+        elif packet.packet_type == DISCONNECT_PACKET:
+            self.fail(ConnectionError("Server disconnected"))
+
+    def handle_data(self, packet: PRUDPPacket):
+        if packet.payload:
+            packet.payload = self.session.decrypt(packet.payload, packet.substream_id)
+
+        message = self.session.reassemble(packet)
+        if message is None:
+            return
+
+        try:
+            response = RMCResponse.from_bytes(self.compression.decompress(message))
+        except ValueError:
+            return
+
+        future = self.calls.pop(response.data["call"], None)
+        if future is not None and not future.done():
+            future.set_result(response)
+
+    def acknowledge_packet(self, packet: PRUDPPacket):
+        ack_packet = packet.new(packet.packet_type, FLAG_ACK | FLAG_HAS_SIZE)
+        ack_packet.sequence_id = packet.sequence_id
+        ack_packet.fragment_id = packet.fragment_id
+        if isinstance(packet, PRUDPPacketV1):
+            ack_packet.substream_id = packet.substream_id
+        self.send_raw(ack_packet.encode())
+
+    def send_raw(self, data: bytes):
+        self.stats["packets_out"] += 1
+        if self.loss and self.random.random() < self.loss:
+            self.stats["injected_loss_out"] += 1
+            return
+        self.transport.sendto(data)
+
+    def send_reliable(self, packet: PRUDPPacket, data: bytes) -> asyncio.Future:
+        key = (packet.packet_type, packet.sequence_id)
+        future = asyncio.get_running_loop().create_future()
+        self.acks[key] = future
+        self.session.pending[(packet.packet_type, packet.substream_id, packet.sequence_id)] = [data, self.session.clock(), 0]
+        self.send_raw(data)
+        return future
+
+    def send_fragment(self, packet: PRUDPPacket, fragment_id: int):
+        session = self.session
+        packet.fragment_id = fragment_id
+        packet.sequence_id = session.next_sequence_id(packet.substream_id)
+        if packet.payload:
+            packet.payload = session.encrypt(packet.payload, packet.substream_id)
+        data = packet.encode()
+        session.pending[(packet.packet_type, packet.substream_id, packet.sequence_id)] = [data, session.clock(), 0]
+        session.in_flight += 1
+        session.packets_sent += 1
+        self.send_raw(data)
+
+    def send(self, payload: bytes, substream_id: int = 0):
+        data = self.compression.compress(payload)
+        fragment_size = self.fragment_size
+        fragments = [data[i:i + fragment_size] for i in range(0, len(data), fragment_size)]
+        for i, fragment in enumerate(fragments):
+            packet = self.new_packet().new(DATA_PACKET, FLAG_RELIABLE | FLAG_NEED_ACK | FLAG_HAS_SIZE)
+            packet.substream_id = substream_id
+            packet.payload = fragment
+            self.send_fragment(packet, 0 if i == len(fragments) - 1 else i % 255 + 1)
+
+    def resend_pending(self):
+        session = self.session
+        now = session.clock()
+        for (packet_type, substream_id, sequence_id), entry in list(session.pending.items()):
+            if now - entry[1] < session.retransmit_timeout(entry[2], self.resend_timeout):
+                continue
+            if entry[2] >= self.resend_max:
+                self.fail(TimeoutError("PRUDP resend limit reached"))
+                return
+            entry[1] = now
+            entry[2] += 1
+            self.stats["retransmits"] += 1
+            if packet_type == DATA_PACKET:
+                session.retransmits += 1
+            self.send_raw(entry[0])
+
+    def fail(self, exc: Exception):
+        for future in list(self.acks.values()) + list(self.calls.values()):
+            if not future.done():
+                future.set_exception(exc)
+        self.acks.clear()
+        self.calls.clear()
+        self.session.pending.clear()
+        self.session.connected = False
+        if self.resend_timer is not None:
+            self.resend_timer.remove(self)
+
+    async def connect(self, address, ticket: KerberosTicket = None, pid: int = 0, cid: int = 0):
+        loop = asyncio.get_running_loop()
+        # Timestamps follow the loop clock, which is virtual when running under netsim
+        self.session.clock = loop.time
+        await loop.create_datagram_endpoint(lambda: self, remote_addr=address)
+        self.resend_timer = resend_timer(loop)
+        self.resend_timer.add(self)
+
+        session = self.session
+
+        syn = self.new_packet().new(SYN_PACKET, FLAG_NEED_ACK)
+        syn.max_substream_id = self.max_substream_id
+        if isinstance(syn, PRUDPPacketV1):
+            syn.supported_functions = OPTION_ALL_FUNCTIONS
+        ack = await self.send_reliable(syn, syn.encode())
+
+        session.server_connection_signature = ack.connection_signature
+        session.client_connection_signature = os.urandom(16 if self.prudp_version == 1 else 4)
+        session.session_id = self.random.randrange(256)
+
+        connect = self.new_packet().new(CONNECT_PACKET, FLAG_RELIABLE | FLAG_NEED_ACK | FLAG_HAS_SIZE)
+        connect.sequence_id = session.next_sequence_id()
+        connect.connection_signature = session.client_connection_signature
+        connect.max_substream_id = self.max_substream_id
+        if isinstance(connect, PRUDPPacketV1):
+            connect.supported_functions = OPTION_ALL_FUNCTIONS
+
+        check = self.random.getrandbits(32)
+        if ticket is not None:
+            connect.payload = build_connect_payload(ticket, pid, cid, check)
+
+        future = self.send_reliable(connect, connect.encode())
+        if ticket is not None:
+            session.set_session_key(ticket.session_secret)
+        ack = await future
+        session.open_substreams(min(ack.max_substream_id, self.max_substream_id))
+
+        if ticket is not None:
+            size = struct.unpack_from("<I", ack.payload, 0)[0]
+            response = KerberosCipher(ticket.session_secret).decrypt(bytes(ack.payload[4:4 + size]))
+            if struct.unpack("<I", response)[0] != (check + 1) & 0xFFFFFFFF:
+                raise ConnectionError("Kerberos check value mismatch")
+            session.pid = pid
+
+        session.connected = True
+
+    async def call(self, protocol: int, method: int, params: bytes = b"", substream_id: int = 0) -> bytes:
+        self.call_id = (self.call_id + 1) & 0xFFFFFFFF
+        request = RMCRequest(protocol, 0, self.call_id, method, params)
+
+        future = asyncio.get_running_loop().create_future()
+        self.calls[self.call_id] = future
+        self.send(request.to_bytes(), substream_id)
+
+        response = await future
+        if response.data["success"] != 1:
+            raise NEXError.from_code(response.data["error"])
+        return response.data["resp_data"]
+
+    async def close(self):
+        if self.transport is None:
+            return
+        if self.session.connected:
+            packet = self.new_packet().new(DISCONNECT_PACKET, FLAG_RELIABLE | FLAG_NEED_ACK)
+            packet.sequence_id = self.session.next_sequence_id()
+            self.send_raw(packet.encode())
+        if self.resend_timer is not None:
+            self.resend_timer.remove(self)
+        self.session.connected = False
+        self.transport.close()
+        self.transport = None
+
+
+async def request_ticket(connection: PRUDPConnection, pid: int, password: str, target_pid: int = 2) -> KerberosTicket:
+    # TicketGranting::RequestTicket
+    data = await connection.call(0x0A, 3, struct.pack("<II", pid, target_pid))
+    result, size = struct.unpack_from("<II", data, 0)
+    if result & 0x80000000:
+        raise NEXError.from_code(result & 0x7FFFFFFF)
+    key = derive_kerberos_key(pid, password.encode())
+    return KerberosTicket.decrypt(key, bytes(data[8:8 + size]))
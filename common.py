@@ -1,7 +1,45 @@
 import re
+import sys
 import hashlib
+from array import array
 from datetime import datetime
-from streams import StreamIn
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from streams import StreamIn
+
+# Optional backends are imported on first use: most processes never touch numpy, and PyCryptodome
+# costs more to import than everything else a server needs
+numpy = None
+ARC4 = None
+loaded = set()
+
+
+def load_numpy():
+    global numpy
+    if "numpy" not in loaded:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        loaded.add("numpy")
+    return numpy
+
+
+def load_arc4():
+    global ARC4
+    if "ARC4" not in loaded:
+        try:
+            from Crypto.Cipher import ARC4
+        except ImportError:
+            ARC4 = None
+        loaded.add("ARC4")
+    return ARC4
+
+
+# Modules that only specific features need; importing prudp must not load any of them. The import-time
+# benchmark and test both check this list
+LAZY_MODULES = ["numpy", "Crypto", "anynet", "asyncio", "multiprocessing", "inspect", "http.server", "lite", "offload"]
+
 
 SYN_PACKET = 0
 CONNECT_PACKET = 1
@@ -24,6 +62,8 @@ OPTION_INITIAL_SEQUENCE_ID = 3
 OPTION_MAX_SUBSTREAM_ID = 4
 OPTION_CONNECTION_SIG_LITE = 128
 
+LITE_MAX_PAYLOAD = 0xFFFF
+
 def rc4(key, data):
     S = list(range(256))
     j = 0
@@ -40,6 +80,46 @@ def rc4(key, data):
         out.append(char ^ k)
     return bytes(out)
 
+class RC4:
+    # Keeps the keystream position between calls, as PRUDP encrypts a connection as one stream
+    __slots__ = ["cipher", "S", "i", "j", "key", "position"]
+
+    def __init__(self, key, position: int = 0):
+        # position skips ahead in the keystream, to resume a cipher from a session snapshot
+        self.key = bytes(key)
+        self.position = position
+        arc4 = load_arc4()
+        if arc4 is not None:
+            self.cipher = arc4.new(self.key, drop=position)
+            return
+        self.cipher = None
+        S = list(range(256))
+        j = 0
+        for i in range(256):
+            j = (j + S[i] + key[i % len(key)]) % 256
+            S[i], S[j] = S[j], S[i]
+        self.S = S
+        self.i = self.j = 0
+        if position:
+            self.position = 0
+            self.crypt(bytes(position))
+
+    def crypt(self, data) -> bytes:
+        self.position += len(data)
+        if self.cipher is not None:
+            return self.cipher.encrypt(bytes(data))
+        S = self.S
+        i, j = self.i, self.j
+        out = bytearray(len(data))
+        for n, char in enumerate(data):
+            i = (i + 1) % 256
+            j = (j + S[i]) % 256
+            S[i], S[j] = S[j], S[i]
+            out[n] = char ^ S[(S[i] + S[j]) % 256]
+        self.i, self.j = i, j
+        return bytes(out)
+
+
 def md5_hash(data):
     return hashlib.md5(data).digest()
 
@@ -81,7 +161,7 @@ class DateTime:
 
     def to_ymdhms(self):
         v = self._raw
-        y = (v >> 26) & 0x3F
+        y = v >> 26
         m = (v >> 22) & 0xF
         d = (v >> 17) & 0x1F
         h = (v >> 12) & 0x1F
@@ -100,6 +180,96 @@ class DateTime:
         y, m, d, h, mi, s = self.to_ymdhms()
         return datetime(y, m, d, h, mi, s)
 
+    # Bulk helpers working on sequences of raw u64 values. When numpy is
+    # available they return numpy arrays, otherwise array('Q') / lists.
+
+    @staticmethod
+    def unpack_raw_list(data, count, offset=0, endian="<"):
+        size = count * 8
+        view = memoryview(data)[offset:offset + size]
+        if len(view) < size:
+            raise ValueError("Data too short")
+        numpy = load_numpy()
+        if numpy is not None:
+            return numpy.frombuffer(view, dtype=endian + "u8")
+        raws = array("Q")
+        raws.frombytes(view)
+        if (endian == "<") != (sys.byteorder == "little"):
+            raws.byteswap()
+        return raws
+
+    @staticmethod
+    def pack_raw_list(raws, endian="<"):
+        numpy = load_numpy()
+        if numpy is not None:
+            return numpy.asarray(raws, dtype=endian + "u8").tobytes()
+        out = array("Q", raws)
+        if (endian == "<") != (sys.byteorder == "little"):
+            out.byteswap()
+        return out.tobytes()
+
+    @classmethod
+    def list_from_stream(cls, stream: 'StreamIn', count=None):
+        if count is None:
+            count = stream.u32()
+        raws = cls.unpack_raw_list(stream.data, count, stream.tell(), stream.endian)
+        stream.skip(count * 8)
+        return raws
+
+    @classmethod
+    def list_to_stream(cls, stream, raws, with_count=True):
+        if with_count:
+            stream.u32(len(raws))
+        stream.write(cls.pack_raw_list(raws, stream.endian))
+
+    @staticmethod
+    def split_raw_list(raws):
+        numpy = load_numpy()
+        if numpy is not None:
+            v = numpy.asarray(raws, dtype=numpy.uint64)
+            return (
+                v >> 26,
+                (v >> 22) & 0xF,
+                (v >> 17) & 0x1F,
+                (v >> 12) & 0x1F,
+                (v >> 6) & 0x3F,
+                v & 0x3F
+            )
+        return (
+            [v >> 26 for v in raws],
+            [(v >> 22) & 0xF for v in raws],
+            [(v >> 17) & 0x1F for v in raws],
+            [(v >> 12) & 0x1F for v in raws],
+            [(v >> 6) & 0x3F for v in raws],
+            [v & 0x3F for v in raws]
+        )
+
+    @staticmethod
+    def join_raw_list(y, m, d, h, mi, s):
+        numpy = load_numpy()
+        if numpy is not None:
+            u64 = numpy.uint64
+            return (
+                (numpy.asarray(y, dtype=u64) << u64(26)) |
+                (numpy.asarray(m, dtype=u64) << u64(22)) |
+                (numpy.asarray(d, dtype=u64) << u64(17)) |
+                (numpy.asarray(h, dtype=u64) << u64(12)) |
+                (numpy.asarray(mi, dtype=u64) << u64(6)) |
+                numpy.asarray(s, dtype=u64)
+            )
+        return array("Q", [
+            (a << 26) | (b << 22) | (c << 17) | (e << 12) | (f << 6) | g
+            for a, b, c, e, f, g in zip(y, m, d, h, mi, s)
+        ])
+
+    @classmethod
+    def to_datetime_list(cls, raws):
+        return [datetime(*fields) for fields in zip(*(map(int, col) for col in cls.split_raw_list(raws)))]
+
+    @classmethod
+    def from_raw_list(cls, raws):
+        return [cls(v) for v in raws]
+
 
 class StationURL:
     _field_map = {
@@ -202,7 +372,7 @@ class ResultRange:
         self.structure = structure
 
     @classmethod
-    def from_stream(cls, stream: StreamIn):
+    def from_stream(cls, stream: 'StreamIn'):
         offset = stream.u32()
         length = stream.u32()
         return cls(offset=offset, length=length)
@@ -0,0 +1,200 @@
+import time
+import heapq
+import logging
+import itertools
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class RTTEstimator:
+    # Smoothed RTT and retransmission timeout as in RFC 6298
+    def __init__(self, initial_rto: float = 1.0, min_rto: float = 0.1, max_rto: float = 10.0):
+        self.srtt = 0.0
+        self.rttvar = 0.0
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.samples = 0
+
+    def update(self, rtt: float):
+        if self.samples == 0:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.samples += 1
+        self.rto = min(self.max_rto, max(self.min_rto, self.srtt + 4 * self.rttvar))
+
+    def timeout(self, retries: int) -> float:
+        # Exponential backoff for packets that were already retransmitted
+        return min(self.max_rto, self.rto * (2 ** retries))
+
+
+class FixedWindow:
+    def __init__(self, window: int = 32):
+        self.window = window
+
+    def on_ack(self, rtt: float):
+        pass
+
+    def on_loss(self, now: float, srtt: float):
+        pass
+
+    def pacing_interval(self, srtt: float) -> float:
+        return 0.0
+
+
+class AIMD:
+    def __init__(self, initial_window: float = 4, min_window: float = 2, max_window: float = 256, pacing_gain: float = 1.25):
+        self.window = initial_window
+        self.ssthresh = max_window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.pacing_gain = pacing_gain
+        self.recovery_until = 0.0
+
+    def on_ack(self, rtt: float):
+        if self.window < self.ssthresh:
+            # Slow start: one more packet per ack doubles the window every round trip
+            self.window += 1
+        else:
+            self.window += 1 / self.window
+        self.window = min(self.window, self.max_window)
+
+    def on_loss(self, now: float, srtt: float):
+        # Losses from the same window only count once, otherwise one burst collapses the window
+        if now < self.recovery_until:
+            return
+        self.ssthresh = max(self.window / 2, self.min_window)
+        self.window = self.ssthresh
+        self.recovery_until = now + max(srtt, 0.01)
+
+    def pacing_interval(self, srtt: float) -> float:
+        # Spread one window over a round trip, a little faster so pacing never limits the window
+        if srtt <= 0:
+            return 0.0
+        return srtt / (self.window * self.pacing_gain)
+
+
+class Pacer:
+    def __init__(self):
+        self.timers = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def call_at(self, when: float, callback, *args):
+        with self.condition:
+            heapq.heappush(self.timers, (when, next(self.counter), callback, args))
+            self.condition.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.timers:
+                    self.condition.wait()
+                delay = self.timers[0][0] - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                when, count, callback, args = heapq.heappop(self.timers)
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception("Paced callback failed")
+
+
+class FragmentSizer:
+    def __init__(self, size: int = 1300, min_size: int = 512, max_size: int = 1400, step: int = 32,
+                 interval: int = 64, loss_threshold: float = 0.05, trial_intervals: int = 4, hold: int = 16):
+        self.size = size
+        self.min_size = min_size
+        self.max_size = max(max_size, size)
+        self.step = step
+        self.interval = interval
+        self.loss_threshold = loss_threshold
+        self.trial_intervals = trial_intervals
+        self.hold = hold
+        self.held = 0
+        self.trial = None
+        self.losses = deque(maxlen=trial_intervals)
+        self.acked = 0
+        self.lost = 0
+        self.probe_size = 0
+        self.probe_sequence = None
+        self.probe_deadline = 0.0
+        self.probe_failures = 0
+
+    def observe(self, size: int):
+        # Non-final fragments from the peer show what its side of the path carries
+        if self.size < size <= self.max_size:
+            self.size = size
+
+    def on_ack(self):
+        self.acked += 1
+        if self.acked + self.lost >= self.interval:
+            self.adjust()
+
+    def on_loss(self):
+        self.lost += 1
+        if self.acked + self.lost >= self.interval:
+            self.adjust()
+
+    def adjust(self):
+        loss = self.lost / (self.acked + self.lost)
+        self.acked = 0
+        self.lost = 0
+        self.losses.append(loss)
+        if len(self.losses) < self.trial_intervals:
+            return
+        average = sum(self.losses) / len(self.losses)
+
+        if self.trial is not None:
+            size, previous_loss = self.trial
+            self.trial = None
+            self.losses.clear()
+            if average > previous_loss * 0.75:
+                # The loss does not depend on the size, smaller fragments would only mean more of them
+                self.size = size
+                self.held = self.hold
+            return
+
+        if self.held:
+            self.held -= 1
+        elif average > self.loss_threshold and self.size > self.min_size:
+            # Try smaller fragments, which cut the bytes resent per loss, and keep them only if loss drops
+            self.trial = (self.size, average)
+            self.losses.clear()
+            self.size = max(self.min_size, self.size * 3 // 4)
+            self.probe_size = 0
+            self.probe_sequence = None
+            return
+        if loss == 0 and self.size < self.max_size and self.probe_sequence is None:
+            self.probe_size = min(self.max_size, self.size + self.step)
+
+    def start_probe(self, sequence_id: int, deadline: float):
+        self.probe_sequence = sequence_id
+        self.probe_deadline = deadline
+
+    def probe_acked(self, sequence_id: int):
+        if sequence_id == self.probe_sequence:
+            self.size = max(self.size, self.probe_size)
+            self.probe_size = 0
+            self.probe_sequence = None
+            self.probe_failures = 0
+
+    def check_probe(self, now: float):
+        if self.probe_sequence is None or now < self.probe_deadline:
+            return
+        self.probe_size = 0
+        self.probe_sequence = None
+        self.probe_failures += 1
+        if self.probe_failures >= 2:
+            # Twice in a row is not random loss, the path does not carry anything larger
+            self.max_size = self.size
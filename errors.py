@@ -294,4 +294,86 @@ error_names = {
 	0x00750003: "Ess::GameSessionMaintenance"
 }
 
-error_codes = {name: code for code, name in error_names.items()}
\ No newline at end of file
+ERROR_MASK = 0x10000000
+
+
+class NEXError(Exception):
+    category = None
+
+    def __init__(self, code, message=None):
+        if isinstance(code, str):
+            code = lookup_codes()[code]
+        self.code = code & ~ERROR_MASK
+        self.result = self.code | ERROR_MASK
+        self.name = error_names.get(self.code, "Unknown")
+        super().__init__(message or f"{self.name} (0x{self.result:08X})")
+
+    @staticmethod
+    def from_code(code, message=None):
+        name = error_names.get(code & ~ERROR_MASK, "")
+        return error_class(name.split("::")[0])(code, message)
+
+    @staticmethod
+    def from_name(name, message=None):
+        return error_class(name.split("::")[0])(name, message)
+
+
+# The reverse lookups and the exception class per category (e.g. CoreError or RendezVousError) are built
+# on first use instead of at import, a process that never raises an error never pays for them
+error_classes = {}
+
+
+def lookup_codes():
+    codes = globals().get("error_codes")
+    if codes is None:
+        codes = globals()["error_codes"] = {name: code for code, name in error_names.items()}
+    return codes
+
+
+def is_category(category: str) -> bool:
+    prefix = category + "::"
+    return any(name.startswith(prefix) for name in error_names.values())
+
+
+def error_class(category: str):
+    cls = error_classes.get(category)
+    if cls is None:
+        if not category or not is_category(category):
+            return NEXError
+        cls = error_classes.setdefault(category, type(category + "Error", (NEXError,), {"category": category}))
+    return cls
+
+
+def __getattr__(name):
+    if name == "error_codes":
+        return lookup_codes()
+    if name == "error_results":
+        value = {code: code | ERROR_MASK for code in error_names}
+    elif name.endswith("Error") and is_category(name[:-5]):
+        value = error_class(name[:-5])
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+# Errors that get their RMC response template built up front. The codes are spelled out so building
+# the templates does not need the reverse lookup
+common_errors = [
+    ("Core::Unknown", 0x00010001),
+    ("Core::NotImplemented", 0x00010002),
+    ("Core::InvalidArgument", 0x0001000A),
+    ("Core::AccessDenied", 0x00010006),
+    ("Core::Exception", 0x00010005),
+    ("Core::Timeout", 0x0001000B),
+    ("Core::SystemError", 0x00010012),
+    ("RendezVous::InvalidUsername", 0x00030064),
+    ("RendezVous::InvalidPassword", 0x00030065),
+    ("RendezVous::NotAuthenticated", 0x00030002),
+    ("RendezVous::PermissionDenied", 0x000300D9),
+    ("RendezVous::SessionVoid", 0x00030073),
+    ("Authentication::TokenParseError", 0x00680002),
+    ("DataStore::NotFound", 0x00690004),
+    ("DataStore::PermissionDenied", 0x00690003),
+    ("Ranking::NotFound", 0x00670005)
+]
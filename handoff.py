@@ -0,0 +1,196 @@
+import socket
+import struct
+from common import DATA_PACKET, RC4
+from capture import pack_address, unpack_address
+
+SNAPSHOT_MAGIC = b"NEXSNAP\x00\x01"
+
+# session id, pid, connected, source, destination, ping sequence id, max substream id, fragment size
+CLIENT = struct.Struct("<IIBBBHBH")
+# sequence id out, sequence id in, RC4 position in, RC4 position out
+SUBSTREAM = struct.Struct("<HHQQ")
+# sequence id, fragment id, flags, payload length
+INCOMING = struct.Struct("<HBHI")
+# packet type, flags, fragment id, payload length
+QUEUED = struct.Struct("<BHBI")
+# packet type, substream id, sequence id, retries, data length
+PENDING = struct.Struct("<BBHBI")
+
+
+class SnapshotWriter:
+    def __init__(self):
+        self.chunks = [SNAPSHOT_MAGIC]
+
+    def pack(self, fmt: struct.Struct, *values):
+        self.chunks.append(fmt.pack(*values))
+
+    def blob(self, data: bytes):
+        self.chunks.append(struct.pack("<I", len(data)))
+        self.chunks.append(bytes(data))
+
+    def address(self, address):
+        ip = pack_address(address)
+        self.chunks.append(struct.pack("<BH", len(ip), address[1]))
+        self.chunks.append(ip)
+
+    def count(self, n: int):
+        self.chunks.append(struct.pack("<I", n))
+
+    def getvalue(self) -> bytes:
+        return b"".join(self.chunks)
+
+
+class SnapshotReader:
+    def __init__(self, data: bytes):
+        if not data.startswith(SNAPSHOT_MAGIC):
+            raise ValueError("Not a NEX session snapshot")
+        self.data = memoryview(data)
+        self.offset = len(SNAPSHOT_MAGIC)
+
+    def unpack(self, fmt: struct.Struct) -> tuple:
+        values = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def read(self, size: int) -> bytes:
+        if self.offset + size > len(self.data):
+            raise ValueError("Truncated session snapshot")
+        data = bytes(self.data[self.offset:self.offset + size])
+        self.offset += size
+        return data
+
+    def blob(self) -> bytes:
+        return self.read(self.count())
+
+    def address(self) -> tuple:
+        ip_length, port = struct.unpack_from("<BH", self.data, self.offset)
+        self.offset += 3
+        return unpack_address(self.read(ip_length), port)
+
+    def count(self) -> int:
+        n = struct.unpack_from("<I", self.data, self.offset)[0]
+        self.offset += 4
+        return n
+
+
+def write_snapshot(clients, backlog: list) -> bytes:
+    # Everything a session needs to continue on another process: keys, signatures, sequence ids and
+    # RC4 keystream positions, plus whatever was still unacked, queued or waiting for reassembly
+    writer = SnapshotWriter()
+    writer.count(len(clients))
+    for client in clients:
+        writer.address(client.address)
+        writer.pack(CLIENT, client.session_id, client.pid, client.connected, client.source, client.destination,
+                    client.ping_sequence_id, client.max_substream_id, client.fragment_sizer.size)
+        writer.blob(client.server_connection_signature)
+        writer.blob(client.client_connection_signature)
+        writer.blob(client.session_key)
+        writer.blob(client.secure_key)
+
+        writer.count(len(client.substreams))
+        for substream in client.substreams:
+            writer.pack(SUBSTREAM, substream.sequence_id_out, substream.sequence_id_in,
+                        substream.cipher_in.position, substream.cipher_out.position)
+            writer.blob(substream.cipher_in.key)
+            writer.blob(substream.cipher_out.key)
+            writer.blob(substream.fragments)
+            writer.count(len(substream.incoming))
+            for sequence_id, packet in substream.incoming.items():
+                writer.pack(INCOMING, sequence_id, packet.fragment_id, packet.flags, len(packet.payload))
+                writer.chunks.append(bytes(packet.payload))
+            writer.count(len(substream.queue))
+            for packet, fragment_id in substream.queue:
+                writer.pack(QUEUED, packet.packet_type, packet.flags, fragment_id, len(packet.payload))
+                writer.chunks.append(bytes(packet.payload))
+
+        writer.count(len(client.pending))
+        for (packet_type, substream_id, sequence_id), entry in client.pending.items():
+            writer.pack(PENDING, packet_type, substream_id, sequence_id, entry[2], len(entry[0]))
+            writer.chunks.append(bytes(entry[0]))
+
+    writer.count(len(backlog))
+    for address, data in backlog:
+        writer.address(address)
+        writer.blob(data)
+    return writer.getvalue()
+
+
+def restore_snapshot(server, data: bytes) -> list:
+    # Rebuilds the sessions on the server and returns the datagrams that arrived during the handoff
+    reader = SnapshotReader(data)
+    restored = []
+    for _ in range(reader.count()):
+        client = server.new_client(reader.address())
+        (client.session_id, client.pid, connected, client.source, client.destination,
+         client.ping_sequence_id, max_substream_id, client.fragment_sizer.size) = reader.unpack(CLIENT)
+        client.connected = bool(connected)
+        client.server_connection_signature = reader.blob()
+        client.client_connection_signature = reader.blob()
+        client.session_key = reader.blob()
+        client.secure_key = reader.blob()
+
+        client.open_substreams(max_substream_id)
+        for substream_id in range(reader.count()):
+            substream = client.substreams[substream_id]
+            substream.sequence_id_out, substream.sequence_id_in, position_in, position_out = reader.unpack(SUBSTREAM)
+            substream.cipher_in = RC4(reader.blob(), position_in)
+            substream.cipher_out = RC4(reader.blob(), position_out)
+            substream.fragments = bytearray(reader.blob())
+            for _ in range(reader.count()):
+                sequence_id, fragment_id, flags, length = reader.unpack(INCOMING)
+                packet = server.new_packet(client, None).new(DATA_PACKET, flags)
+                packet.substream_id = substream_id
+                packet.sequence_id = sequence_id
+                packet.fragment_id = fragment_id
+                packet.payload = reader.read(length)
+                substream.incoming[sequence_id] = packet
+            for _ in range(reader.count()):
+                packet_type, flags, fragment_id, length = reader.unpack(QUEUED)
+                packet = server.new_packet(client, None).new(packet_type, flags)
+                packet.substream_id = substream_id
+                packet.payload = reader.read(length)
+                substream.queue.append((packet, fragment_id))
+
+        for _ in range(reader.count()):
+            packet_type, substream_id, sequence_id, retries, length = reader.unpack(PENDING)
+            entry = client.pending[(packet_type, substream_id, sequence_id)] = [reader.read(length), 0.0, retries]
+            restored.append(entry)
+            if packet_type == DATA_PACKET:
+                client.in_flight += 1
+
+        server.clients[f"{client.address[0]}:{client.address[1]}"] = client
+
+    # The send times stayed with the old process. Spread the unacked packets over one resend interval,
+    # so the first resend pass after the restart does not send them all in one burst
+    now = server.clock()
+    for i, entry in enumerate(restored):
+        entry[1] = now - server.resend_timeout * (1 - (i + 1) / len(restored))
+
+    return [(reader.address(), bytearray(reader.blob())) for _ in range(reader.count())]
+
+
+def send_socket(connection: socket.socket, sock: socket.socket, data: bytes):
+    # The listening socket travels as SCM_RIGHTS ancillary data next to the snapshot length
+    socket.send_fds(connection, [struct.pack("<Q", len(data))], [sock.fileno()])
+    connection.sendall(data)
+
+
+def receive_socket(path: str, timeout: float = 30.0):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(path)
+        message, fds, flags, address = socket.recv_fds(connection, 8, 1)
+        if len(message) < 8 or not fds:
+            raise ConnectionError("Handoff did not include a socket")
+        size = struct.unpack("<Q", message)[0]
+        chunks = []
+        while size:
+            chunk = connection.recv(min(size, 1 << 20))
+            if not chunk:
+                raise ConnectionError("Handoff connection closed early")
+            chunks.append(chunk)
+            size -= len(chunk)
+    finally:
+        connection.close()
+    return socket.socket(fileno=fds[0]), b"".join(chunks)
@@ -0,0 +1,283 @@
+import hmac
+import time
+import logging
+import datetime
+import hashlib
+import asyncio
+import binascii
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+from rmc import RMCRequest, RMCResponse
+from cache import ResponseCache
+from errors import NEXError
+from kerberos import derive_kerberos_key
+
+logger = logging.getLogger(__name__)
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error"
+}
+
+
+class HPPClient:
+    def __init__(self, address, server: 'HPPServer', pid: int):
+        self.address = address
+        self.server = server
+        self.pid = pid
+        self.connected = True
+
+
+class HPPPacket:
+    def __init__(self, client: HPPClient, payload: bytes):
+        self.client = client
+        self.payload = payload
+        self.rmc_request = RMCRequest()
+
+
+def http_response(status: int, body: bytes = b"", keep_alive: bool = True) -> bytes:
+    head = (
+        f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+        f"Content-Type: application/octet-stream\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    return head.encode() + body
+
+
+class HPPConnection(asyncio.Protocol):
+    def __init__(self, server: 'HPPServer'):
+        self.server = server
+        self.transport = None
+        self.address = None
+        self.buffer = bytearray()
+        self.last = None
+        self.closing = False
+        self.timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info("peername")
+        self.touch()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def touch(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = asyncio.get_running_loop().call_later(self.server.keep_alive_timeout, self.idle)
+
+    def idle(self):
+        # Only close between requests, never while a response is still being produced
+        if self.transport is not None and (self.last is None or self.last.done()):
+            self.transport.close()
+        else:
+            self.touch()
+
+    def data_received(self, data):
+        self.touch()
+        buffer = self.buffer
+        buffer += data
+
+        # Several pipelined requests can arrive in one read; parse them all before trimming the buffer
+        offset = 0
+        while not self.closing:
+            end = buffer.find(b"\r\n\r\n", offset)
+            if end < 0:
+                if len(buffer) - offset > self.server.max_header_size:
+                    self.reject(431)
+                break
+
+            try:
+                lines = bytes(buffer[offset:end]).decode("latin-1").split("\r\n")
+                method, path, version = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+            except ValueError:
+                self.reject(400)
+                break
+
+            if length > self.server.max_body_size:
+                self.reject(413)
+                break
+            if len(buffer) < end + 4 + length:
+                break
+
+            body = bytes(buffer[end + 4:end + 4 + length])
+            offset = end + 4 + length
+
+            connection = headers.get("connection", "").lower()
+            if version == "HTTP/1.0":
+                keep_alive = connection == "keep-alive"
+            else:
+                keep_alive = connection != "close"
+
+            if method != "POST":
+                self.queue(self.server.completed(http_response(405, keep_alive=keep_alive)), keep_alive)
+            elif not path.startswith("/hpp"):
+                self.queue(self.server.completed(http_response(404, keep_alive=keep_alive)), keep_alive)
+            else:
+                self.queue(self.server.submit(self.address, headers, body, keep_alive), keep_alive)
+
+            if not keep_alive:
+                self.closing = True
+
+        del buffer[:offset]
+
+    def reject(self, status: int):
+        self.closing = True
+        self.queue(self.server.completed(http_response(status, keep_alive=False)), False)
+
+    def queue(self, future, keep_alive: bool):
+        # Requests are handled concurrently but pipelined responses must go out in request order
+        self.last = asyncio.get_running_loop().create_task(self.respond(future, self.last, keep_alive))
+
+    async def respond(self, future, previous, keep_alive: bool):
+        try:
+            response = await future
+        except Exception:
+            logger.exception("HPP request failed")
+            response = http_response(500, keep_alive=False)
+            keep_alive = False
+        if previous is not None:
+            # Only the order matters here, a failed earlier response must not hold back this one
+            await asyncio.wait((previous,))
+        if self.transport is None:
+            return
+        self.transport.write(response)
+        if not keep_alive:
+            self.transport.close()
+
+
+class HPPServer:
+    def __init__(self, server=None, workers: int = None):
+        # Passing a PRUDPServer shares its RMC handlers, access key and metrics
+        self.rmc_handlers: Dict[tuple, object] = server.rmc_handlers if server is not None else {}
+        self.access_key = server.access_key if server is not None else str()
+        if self.access_key:
+            try:
+                binascii.unhexlify(self.access_key)
+            except binascii.Error:
+                raise ValueError(f"HPP access key must be hexadecimal: {self.access_key!r}")
+        self.metrics = server.metrics if server is not None else None
+        self.response_cache = server.response_cache if server is not None else ResponseCache()
+        self.password_lookup = None
+        self.keep_alive_timeout = 15.0
+        self.max_header_size = 8192
+        self.max_body_size = 1 << 20
+        self.executor = ThreadPoolExecutor(workers)
+        self.lock = threading.Lock()
+        self.access_key_mac = None
+        self.account_macs: Dict[int, hmac.HMAC] = {}
+        self.server = None
+
+    def register_rmc(self, protocol: int, method: int, handler):
+        self.rmc_handlers[(protocol, method)] = handler
+
+    def cache_rmc(self, protocol: int, method: int, ttl: float):
+        self.response_cache.enable(protocol, method, ttl)
+
+    def access_key_signature(self, body: bytes) -> bytes:
+        if self.access_key_mac is None:
+            self.access_key_mac = hmac.new(binascii.unhexlify(self.access_key), digestmod=hashlib.md5)
+        mac = self.access_key_mac.copy()
+        mac.update(body)
+        return mac.digest()
+
+    def password_signature(self, pid: int, body: bytes) -> bytes:
+        # Deriving the account key takes 65000+ MD5 rounds, so keep a keyed HMAC per PID and copy it
+        mac = self.account_macs.get(pid)
+        if mac is None:
+            password = self.password_lookup(pid)
+            if password is None:
+                return None
+            mac = hmac.new(derive_kerberos_key(pid, password.encode()), digestmod=hashlib.md5)
+            with self.lock:
+                self.account_macs[pid] = mac
+        mac = mac.copy()
+        mac.update(body)
+        return mac.digest()
+
+    def forget(self, pid: int):
+        with self.lock:
+            self.account_macs.pop(pid, None)
+
+    def valid_signature(self, pid: int, headers: dict, body: bytes) -> bool:
+        try:
+            signature1 = binascii.unhexlify(headers.get("signature1", ""))
+            signature2 = binascii.unhexlify(headers.get("signature2", ""))
+        except (binascii.Error, ValueError):
+            return False
+
+        if not hmac.compare_digest(self.access_key_signature(body), signature1):
+            return False
+        if self.password_lookup is None:
+            return True
+        expected = self.password_signature(pid, body)
+        return expected is not None and hmac.compare_digest(expected, signature2)
+
+    def completed(self, response: bytes) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(response)
+        return future
+
+    def submit(self, address, headers: dict, body: bytes, keep_alive: bool) -> asyncio.Future:
+        # Handlers and key derivation run on the shared worker pool, never on the event loop
+        return asyncio.get_running_loop().run_in_executor(self.executor, self.handle_request, address, headers, body, keep_alive)
+
+    def handle_request(self, address, headers: dict, body: bytes, keep_alive: bool) -> bytes:
+        try:
+            pid = int(headers.get("pid", "0"))
+            request = RMCRequest.from_bytes(body)
+        except ValueError:
+            return http_response(400, keep_alive=keep_alive)
+
+        try:
+            response = self.handle_rmc(address, pid, headers, body, request)
+        except Exception:
+            # Signature checks can fail too (a bad access key, password_lookup raising), answer anyway
+            logger.exception("HPP request failed")
+            response = RMCResponse.error_bytes(request["protocol"], request["call"], NEXError("Core::Exception"), request["custom"])
+        return http_response(200, len(response).to_bytes(4, "little") + response, keep_alive)
+
+    def handle_rmc(self, address, pid: int, headers: dict, body: bytes, request: RMCRequest) -> bytes:
+        if self.metrics is not None:
+            self.metrics.inc("hpp_requests_total")
+
+        packet = HPPPacket(HPPClient(address, self, pid), body)
+        packet.rmc_request = request
+
+        if not self.valid_signature(pid, headers, body):
+            if self.metrics is not None:
+                self.metrics.inc("hpp_invalid_signatures_total")
+            response = RMCResponse.error_bytes(request["protocol"], request["call"], NEXError("Core::AccessDenied"), request["custom"])
+        else:
+            handler = self.rmc_handlers.get((request["protocol"], request["method"]))
+            if handler is None:
+                response = RMCResponse.error_bytes(request["protocol"], request["call"], NEXError("Core::NotImplemented"), request["custom"])
+            else:
+                start = time.perf_counter()
+                response = self.response_cache.call(handler, packet)
+                if self.metrics is not None:
+                    self.metrics.handler(request["protocol"], request["method"], time.perf_counter() - start)
+        return response
+
+    async def listen(self, address: str):
+        host, port = address.split(":")
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: HPPConnection(self), host, int(port))
+        print(f"[{datetime.datetime.now()}] HPP Server listening on {host}:{port}")
+        async with self.server:
+            await self.server.serve_forever()
@@ -3,19 +3,16 @@ import hashlib
 import struct
 import secrets
 from datetime import datetime
-try:
-    from Crypto.Cipher import ARC4
-except ImportError:
-    ARC4 = None
-from common import md5_hash, rc4
+from common import md5_hash, rc4, load_arc4
 
 class KerberosCipher:
     def __init__(self, key):
         self.key = key
 
     def crypt(self, data):
-        if ARC4 is not None:
-            cipher = ARC4.new(self.key)
+        arc4 = load_arc4()
+        if arc4 is not None:
+            cipher = arc4.new(self.key)
             return cipher.encrypt(data)
         else:
             return rc4(self.key, data)
@@ -129,4 +126,15 @@ def derive_kerberos_key(pid, password):
     val = password
     for _ in range(65000 + (pid % 1024)):
         val = md5_hash(val)
-    return val
\ No newline at end of file
+    return val
+
+
+def create_ticket(user_key, server_key, user_pid, target_pid, session_key_size=32, version=0):
+    session_key = secrets.token_bytes(session_key_size)
+    internal = KerberosTicketInternal(datetime.utcnow(), user_pid, session_key).encrypt(server_key, version)
+    return KerberosTicket(session_key, target_pid, internal).encrypt(user_key)
+
+
+def build_connect_payload(ticket, pid, cid, check):
+    request = KerberosCipher(ticket.session_secret).encrypt(struct.pack('<III', pid, cid, check))
+    return struct.pack('<I', len(ticket.extra)) + ticket.extra + struct.pack('<I', len(request)) + request
\ No newline at end of file
@@ -0,0 +1,219 @@
+import base64
+import struct
+import asyncio
+import hashlib
+import threading
+from common import LITE_MAX_PAYLOAD
+
+LITE_HEADER_SIZE = 12
+# The header's 8-bit options length and 16-bit payload size bound every Lite packet
+LITE_MAX_PACKET = LITE_HEADER_SIZE + 0xFF + LITE_MAX_PAYLOAD
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WEBSOCKET_BINARY = 2
+WEBSOCKET_CLOSE = 8
+WEBSOCKET_PING = 9
+WEBSOCKET_PONG = 10
+
+
+class LiteStream(asyncio.BufferedProtocol):
+    def __init__(self, server, buffer_size: int = 65536, min_read: int = 4096):
+        self.server = server
+        self.min_read = min_read
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.wanted = 0
+        self.transport = None
+        self.address = None
+        self.client = None
+        self.loop = None
+        self.thread = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info("peername")[:2]
+        self.loop = asyncio.get_running_loop()
+        self.thread = threading.get_ident()
+        self.client = self.server.new_stream_client(self)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        client = self.client
+        if self.server.clients.get(f"{self.address[0]}:{self.address[1]}") is client:
+            self.server.kick(client)
+
+    def get_buffer(self, sizehint):
+        # The socket reads straight into the receive buffer; only the unparsed tail of a partial
+        # frame is ever moved, and only when the free space at the end runs low
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < max(self.min_read, self.wanted - (self.end - self.start)):
+            size = self.end - self.start
+            if max(size, self.wanted) + self.min_read > len(self.buffer):
+                # A frame larger than the buffer: move to a bigger one, views into the old one stay valid
+                buffer = bytearray(max(len(self.buffer) * 2, self.wanted + self.min_read))
+                buffer[:size] = self.view[self.start:self.end]
+                self.buffer = buffer
+                self.view = memoryview(buffer)
+            else:
+                self.buffer[:size] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = size
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        self.start = self.parse(self.start, self.end)
+
+    def parse(self, start: int, end: int) -> int:
+        self.wanted = 0
+        while end - start >= LITE_HEADER_SIZE:
+            magic, options_length, payload_size = struct.unpack_from("<BBH", self.buffer, start)
+            if magic != 0x80:
+                self.close()
+                return end
+            size = LITE_HEADER_SIZE + options_length + payload_size
+            if end - start < size:
+                self.wanted = size
+                break
+            self.server.handle_stream_packet(self.client, self.view[start:start + size])
+            start += size
+        return start
+
+    def send(self, data: bytes):
+        if self.transport is not None:
+            self.transport.write(data)
+
+    def write(self, data: bytes):
+        # Handlers run on their own threads, but transports may only be used from the event loop
+        if threading.get_ident() == self.thread:
+            self.send(data)
+        elif self.transport is not None:
+            self.loop.call_soon_threadsafe(self.send, data)
+
+    def close(self):
+        if self.transport is None:
+            return
+        if threading.get_ident() == self.thread:
+            self.transport.close()
+        else:
+            self.loop.call_soon_threadsafe(self.transport.close)
+
+
+class WebSocketStream(LiteStream):
+    def __init__(self, server, buffer_size: int = 65536, min_read: int = 4096, max_frame_size: int = LITE_MAX_PACKET):
+        super().__init__(server, buffer_size, min_read)
+        self.max_frame_size = max_frame_size
+        self.upgraded = False
+
+    def parse(self, start: int, end: int) -> int:
+        self.wanted = 0
+        if not self.upgraded:
+            start = self.handshake(start, end)
+            if not self.upgraded:
+                return start
+
+        buffer = self.buffer
+        while end - start >= 2:
+            opcode = buffer[start] & 0x0F
+            length = buffer[start + 1] & 0x7F
+            offset = start + 2
+            if length == 126:
+                if end - offset < 2:
+                    break
+                length = struct.unpack_from(">H", buffer, offset)[0]
+                offset += 2
+            elif length == 127:
+                if end - offset < 8:
+                    break
+                length = struct.unpack_from(">Q", buffer, offset)[0]
+                offset += 8
+
+            if not buffer[start + 1] & 0x80 or not buffer[start] & 0x80:
+                # Clients must mask their frames, and Lite packets are never split over continuations
+                self.close()
+                return end
+            if length > self.max_frame_size:
+                # The length is the client's claim; it sizes the receive buffer, so it must not exceed a packet
+                self.close()
+                return end
+            if end - offset < 4 + length:
+                self.wanted = offset + 4 + length - start
+                break
+
+            mask = bytes(buffer[offset:offset + 4])
+            offset += 4
+            payload = self.view[offset:offset + length]
+            if length:
+                # Unmask in place with one big-integer XOR instead of a per-byte loop
+                key = int.from_bytes(mask * (length // 4 + 1), "little") & ((1 << (length * 8)) - 1)
+                payload[:] = (int.from_bytes(payload, "little") ^ key).to_bytes(length, "little")
+            start = offset + length
+
+            if opcode == WEBSOCKET_BINARY:
+                # Each message holds whole Lite packets, so they are parsed straight out of the frame
+                super().parse(offset, offset + length)
+                self.wanted = 0
+            elif opcode == WEBSOCKET_PING:
+                self.send_frame(WEBSOCKET_PONG, bytes(payload))
+            elif opcode == WEBSOCKET_CLOSE:
+                self.send_frame(WEBSOCKET_CLOSE, bytes(payload[:2]))
+                self.close()
+                return end
+            elif opcode != WEBSOCKET_PONG:
+                self.close()
+                return end
+        return start
+
+    def handshake(self, start: int, end: int) -> int:
+        header_end = self.buffer.find(b"\r\n\r\n", start, end)
+        if header_end < 0:
+            if end - start > 8192:
+                self.close()
+            return start
+
+        lines = bytes(self.buffer[start:header_end]).decode("latin-1").split("\r\n")
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        key = headers.get("sec-websocket-key")
+        if headers.get("upgrade", "").lower() != "websocket" or not key:
+            self.send(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            self.close()
+            return end
+
+        accept = base64.b64encode(hashlib.sha1(key.encode() + WEBSOCKET_GUID).digest()).decode()
+        response = (
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n"
+        )
+        protocol = headers.get("sec-websocket-protocol")
+        if protocol:
+            response += f"Sec-WebSocket-Protocol: {protocol.split(',')[0].strip()}\r\n"
+        self.send((response + "\r\n").encode())
+        self.upgraded = True
+        return header_end + 4
+
+    def send_frame(self, opcode: int, data: bytes):
+        if self.transport is None:
+            return
+        length = len(data)
+        if length < 126:
+            header = struct.pack(">BB", 0x80 | opcode, length)
+        elif length < 0x10000:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, length)
+        self.transport.writelines([header, data])
+
+    def send(self, data: bytes):
+        if self.upgraded:
+            self.send_frame(WEBSOCKET_BINARY, data)
+        elif self.transport is not None:
+            self.transport.write(data)
@@ -0,0 +1,197 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from errors import NEXError
+from kerberos import KerberosTicket, create_ticket, derive_kerberos_key
+from client import PRUDPConnection, request_ticket
+
+
+class CallMix:
+    def __init__(self, specs):
+        # Each spec is protocol:method[:weight[:params_size]]
+        self.calls = []
+        self.weights = []
+        for spec in specs:
+            parts = [int(part, 0) for part in spec.split(":")]
+            if len(parts) < 2:
+                raise ValueError(f"Invalid call spec: {spec}")
+            protocol, method = parts[0], parts[1]
+            weight = parts[2] if len(parts) > 2 else 1
+            size = parts[3] if len(parts) > 3 else 0
+            self.calls.append((protocol, method, size))
+            self.weights.append(weight)
+
+    def pick(self, rng: random.Random):
+        return rng.choices(self.calls, self.weights)[0]
+
+
+class LoadStats:
+    def __init__(self):
+        self.connected = 0
+        self.connect_failures = 0
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.disconnects = 0
+        self.latencies = {}
+        self.error_latencies = {}
+        self.connections = []
+
+    def record(self, protocol: int, method: int, latency: float):
+        self.calls += 1
+        self.latencies.setdefault(f"{protocol}:{method}", []).append(latency)
+
+    def record_error(self, protocol: int, method: int, latency: float):
+        # Error replies are often much faster than real work, so they get their own series
+        self.calls += 1
+        self.errors += 1
+        self.error_latencies.setdefault(f"{protocol}:{method}", []).append(latency)
+
+    def summary(self, elapsed: float) -> dict:
+        def percentiles(values):
+            values = sorted(values)
+            pick = lambda q: values[min(len(values) - 1, int(q * len(values)))] * 1000 if values else 0.0
+            return {"count": len(values), "p50_ms": pick(0.50), "p90_ms": pick(0.90), "p99_ms": pick(0.99)}
+
+        totals = {}
+        for connection in self.connections:
+            for key, value in connection.stats.items():
+                totals[key] = totals.get(key, 0) + value
+
+        all_latencies = [value for values in self.latencies.values() for value in values]
+        all_error_latencies = [value for values in self.error_latencies.values() for value in values]
+        return {
+            "elapsed": elapsed,
+            "connected": self.connected,
+            "connect_failures": self.connect_failures,
+            "calls": self.calls,
+            "calls_per_sec": self.calls / elapsed if elapsed > 0 else 0,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "disconnects": self.disconnects,
+            "latency": percentiles(all_latencies),
+            "latency_per_call": {key: percentiles(values) for key, values in self.latencies.items()},
+            "error_latency": percentiles(all_error_latencies),
+            "error_latency_per_call": {key: percentiles(values) for key, values in self.error_latencies.items()},
+            "transport": totals
+        }
+
+
+async def get_ticket(args, rng: random.Random, user_key: bytes, server_key: bytes):
+    if args.kerberos_password:
+        data = create_ticket(user_key, server_key, args.pid, 2, args.kerberos_size, args.kerberos_derivation)
+        return KerberosTicket.decrypt(user_key, data)
+
+    host, port = args.auth.split(":")
+    connection = PRUDPConnection(args.version, args.access_key, loss=args.loss, seed=rng.getrandbits(32))
+    try:
+        await connection.connect((host, int(port)))
+        return await request_ticket(connection, args.pid, args.password)
+    finally:
+        await connection.close()
+
+
+async def console(index: int, args, mix: CallMix, stats: LoadStats, deadline: float, user_key: bytes, server_key: bytes):
+    rng = random.Random(args.seed + index if args.seed is not None else None)
+    await asyncio.sleep(index / args.ramp if args.ramp else 0)
+
+    host, port = args.address.split(":")
+    connection = PRUDPConnection(args.version, args.access_key, args.fragment_size, args.loss, rng.getrandbits(32))
+    connection.resend_timeout = args.resend_timeout
+    stats.connections.append(connection)
+
+    try:
+        if args.pid:
+            ticket = await get_ticket(args, rng, user_key, server_key)
+            await connection.connect((host, int(port)), ticket, args.pid, index)
+        else:
+            await connection.connect((host, int(port)))
+    except Exception:
+        stats.connect_failures += 1
+        await connection.close()
+        return
+
+    stats.connected += 1
+    try:
+        while mix.calls and time.monotonic() < deadline:
+            protocol, method, size = mix.pick(rng)
+            start = time.perf_counter()
+            try:
+                await connection.call(protocol, method, rng.getrandbits(size * 8).to_bytes(size, "little") if size else b"")
+            except NEXError:
+                stats.record_error(protocol, method, time.perf_counter() - start)
+            except TimeoutError:
+                stats.timeouts += 1
+                return
+            except ConnectionError:
+                # The server disconnected or kicked this console, the others keep going
+                stats.disconnects += 1
+                return
+            else:
+                stats.record(protocol, method, time.perf_counter() - start)
+            if args.think:
+                await asyncio.sleep(args.think)
+        if not mix.calls:
+            await asyncio.sleep(max(0, deadline - time.monotonic()))
+    finally:
+        await connection.close()
+
+
+async def run(args) -> dict:
+    mix = CallMix(args.call)
+    stats = LoadStats()
+
+    user_key = server_key = b""
+    if args.pid:
+        user_key = derive_kerberos_key(args.pid, args.password.encode())
+        if args.kerberos_password:
+            server_key = derive_kerberos_key(2, args.kerberos_password.encode())
+
+    start = time.monotonic()
+    deadline = start + args.duration
+    await asyncio.gather(*[
+        console(i, args, mix, stats, deadline, user_key, server_key) for i in range(args.clients)
+    ])
+    return stats.summary(time.monotonic() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many PRUDP consoles against a NEX server")
+    parser.add_argument("address", help="server address as host:port")
+    parser.add_argument("--version", type=int, default=1, choices=[0, 1], help="PRUDP version")
+    parser.add_argument("--access-key", default="", help="game server access key")
+    parser.add_argument("--clients", type=int, default=100, help="number of simulated consoles")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--ramp", type=float, default=0, help="new connections per second (0 = all at once)")
+    parser.add_argument("--call", action="append", default=[], help="protocol:method[:weight[:params_size]], repeatable")
+    parser.add_argument("--think", type=float, default=0, help="seconds between calls of one console")
+    parser.add_argument("--loss", type=float, default=0.0, help="injected packet loss ratio in each direction")
+    parser.add_argument("--fragment-size", type=int, default=1300)
+    parser.add_argument("--resend-timeout", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, help="seed for reproducible call mixes and loss")
+    parser.add_argument("--pid", type=int, default=0, help="user pid for Kerberos authentication")
+    parser.add_argument("--password", default="", help="user password for Kerberos authentication")
+    parser.add_argument("--auth", help="authentication server address to request tickets from")
+    parser.add_argument("--kerberos-password", default="", help="secure server password, to mint tickets locally")
+    parser.add_argument("--kerberos-size", type=int, default=32)
+    parser.add_argument("--kerberos-derivation", type=int, default=0)
+    parser.add_argument("--output", help="write the summary as JSON to this file")
+    args = parser.parse_args()
+
+    if args.pid and not args.auth and not args.kerberos_password:
+        parser.error("--pid needs either --auth or --kerberos-password")
+
+    summary = asyncio.run(run(args))
+    output = json.dumps(summary, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import json
+import bisect
+import threading
+from typing import Dict
+from common import SYN_PACKET, CONNECT_PACKET, DATA_PACKET, DISCONNECT_PACKET, PING_PACKET, USER_PACKET
+
+packet_type_names = {
+    SYN_PACKET: "syn",
+    CONNECT_PACKET: "connect",
+    DATA_PACKET: "data",
+    DISCONNECT_PACKET: "disconnect",
+    PING_PACKET: "ping",
+    USER_PACKET: "user"
+}
+
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Histogram:
+    __slots__ = ["bounds", "counts", "sum", "count"]
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(zip([str(b) for b in self.bounds] + ["+Inf"], self.counts))
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[tuple, int] = {}
+        self.histograms: Dict[tuple, Histogram] = {}
+        self.gauges: Dict[str, object] = {}
+
+    def inc(self, name: str, labels: tuple = (), value: int = 1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: tuple = ()):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name: str, callback):
+        self.gauges[name] = callback
+
+    def packet_in(self, packet_type: int, size: int):
+        labels = (("type", packet_type_names.get(packet_type, str(packet_type))),)
+        with self.lock:
+            key = ("prudp_packets_in_total", labels)
+            self.counters[key] = self.counters.get(key, 0) + 1
+            key = ("prudp_bytes_in_total", labels)
+            self.counters[key] = self.counters.get(key, 0) + size
+
+    def packet_out(self, packet_type: int, size: int):
+        labels = (("type", packet_type_names.get(packet_type, str(packet_type))),)
+        with self.lock:
+            key = ("prudp_packets_out_total", labels)
+            self.counters[key] = self.counters.get(key, 0) + 1
+            key = ("prudp_bytes_out_total", labels)
+            self.counters[key] = self.counters.get(key, 0) + size
+
+    def handler(self, protocol: int, method: int, seconds: float):
+        self.observe("rmc_handler_seconds", seconds, (("protocol", str(protocol)), ("method", str(method))))
+
+    def stats(self) -> dict:
+        with self.lock:
+            counters = {format_key(name, labels): value for (name, labels), value in self.counters.items()}
+            histograms = {format_key(name, labels): h.to_dict() for (name, labels), h in self.histograms.items()}
+        gauges = {name: callback() for name, callback in self.gauges.items()}
+        return {"counters": counters, "histograms": histograms, "gauges": gauges}
+
+    def prometheus(self) -> str:
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                declare(name, "counter")
+                lines.append(f"{format_key(name, labels)} {value}")
+
+            for (name, labels), h in sorted(self.histograms.items(), key=lambda item: item[0]):
+                declare(name, "histogram")
+                total = 0
+                for bound, n in zip(list(h.bounds) + ["+Inf"], h.counts):
+                    total += n
+                    lines.append(f"{format_key(name + '_bucket', labels + (('le', str(bound)),))} {total}")
+                lines.append(f"{format_key(name + '_sum', labels)} {h.sum}")
+                lines.append(f"{format_key(name + '_count', labels)} {h.count}")
+
+        for name, callback in sorted(self.gauges.items()):
+            declare(name, "gauge")
+            lines.append(f"{name} {callback()}")
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, address: str):
+        # http.server is slow to import and only needed when metrics are exposed
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        host, port = address.split(":")
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = metrics.prometheus().encode()
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/stats":
+                    body = json.dumps(metrics.stats()).encode()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = ThreadingHTTPServer((host, int(port)), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd
+
+
+def format_key(name: str, labels: tuple) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
@@ -0,0 +1,215 @@
+import time
+import random
+import asyncio
+import selectors
+from typing import Dict
+
+
+class VirtualSelector(selectors.SelectSelector):
+    # Nothing real is ever polled: waiting for the next timer just moves the clock forward
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise RuntimeError("Simulation stalled with nothing scheduled")
+        self.loop.now += timeout
+        return []
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    def __init__(self, network: 'Network'):
+        selector = VirtualSelector()
+        super().__init__(selector)
+        selector.loop = self
+        self.now = 0.0
+        self.network = network
+
+    def time(self) -> float:
+        return self.now
+
+    async def create_datagram_endpoint(self, protocol_factory, local_addr=None, remote_addr=None, **kwargs):
+        protocol = protocol_factory()
+        transport = self.network.attach(protocol)
+        protocol.connection_made(transport)
+        return transport, protocol
+
+
+class Link:
+    def __init__(self, loss: float = 0.0, duplicate: float = 0.0, reorder: float = 0.0, latency: float = 0.0,
+                 jitter: float = 0.0, bandwidth: int = 0, queue_bytes: int = 0):
+        # bandwidth is in bytes per second (0 = unlimited); queue_bytes bounds the send queue (0 = unbounded)
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.queue_bytes = queue_bytes
+        self.busy_until = 0.0
+        self.stats = {"packets": 0, "bytes": 0, "lost": 0, "queue_drops": 0, "duplicated": 0, "reordered": 0}
+
+    def schedule(self, now: float, size: int, rng: random.Random) -> list:
+        # Returns the arrival times of the copies that make it across
+        self.stats["packets"] += 1
+        self.stats["bytes"] += size
+
+        departure = now
+        if self.bandwidth:
+            start = max(now, self.busy_until)
+            if self.queue_bytes and (start - now) * self.bandwidth > self.queue_bytes:
+                self.stats["queue_drops"] += 1
+                return []
+            self.busy_until = departure = start + size / self.bandwidth
+
+        if self.loss and rng.random() < self.loss:
+            self.stats["lost"] += 1
+            return []
+
+        arrival = departure + self.latency
+        if self.jitter:
+            arrival += rng.random() * self.jitter
+        if self.reorder and rng.random() < self.reorder:
+            # Held back long enough for the packets behind it to overtake
+            self.stats["reordered"] += 1
+            arrival += self.latency + 0.001
+        arrivals = [arrival]
+        if self.duplicate and rng.random() < self.duplicate:
+            self.stats["duplicated"] += 1
+            arrivals.append(arrival + rng.random() * max(self.jitter, 0.001))
+        return arrivals
+
+
+class SimulatedTransport(asyncio.DatagramTransport):
+    def __init__(self, network: 'Network', protocol, address):
+        super().__init__()
+        self.network = network
+        self.protocol = protocol
+        self.address = address
+        self.closed = False
+
+    def sendto(self, data, addr=None):
+        if not self.closed:
+            self.network.to_server(self.address, bytes(data))
+
+    def get_extra_info(self, name, default=None):
+        if name == "sockname":
+            return self.address
+        if name == "peername":
+            return self.network.server_address
+        return default
+
+    def is_closing(self) -> bool:
+        return self.closed
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.network.detach(self.address)
+            self.network.loop.call_soon(self.protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+
+class SimulatedSocket:
+    # Stands in for the server's UDP socket; sendto is all the server uses for sending
+    def __init__(self, network: 'Network'):
+        self.network = network
+
+    def sendto(self, data, address):
+        self.network.to_client(address, bytes(data))
+        return len(data)
+
+    def getsockname(self):
+        return self.network.server_address
+
+    def close(self):
+        pass
+
+
+class Network:
+    def __init__(self, server, seed: int = 0, resend_interval: float = 0.01, **link):
+        # link takes the Link parameters, used for both directions of every client unless overridden
+        self.server = server
+        self.rng = random.Random(seed)
+        self.link = link
+        self.loop = VirtualClockLoop(self)
+        self.server_address = ("10.0.0.1", 60000)
+        self.endpoints: Dict[tuple, object] = {}
+        self.links: Dict[tuple, tuple] = {}
+        self.next_host = 2
+        self.resend_interval = resend_interval
+        self.datagrams = 0
+
+        server.socket = SimulatedSocket(self)
+        server.clock = self.loop.time
+        server.pacer = self.loop
+        server.inline_handlers = True
+
+    def set_links(self, address, uplink: Link, downlink: Link):
+        self.links[address] = (uplink, downlink)
+
+    def attach(self, protocol) -> SimulatedTransport:
+        address = (f"10.0.{self.next_host // 250}.{self.next_host % 250 + 2}", 40000 + self.next_host)
+        self.next_host += 1
+        self.endpoints[address] = protocol
+        if address not in self.links:
+            self.links[address] = (Link(**self.link), Link(**self.link))
+        return SimulatedTransport(self, protocol, address)
+
+    def detach(self, address):
+        self.endpoints.pop(address, None)
+
+    def to_server(self, address, data: bytes):
+        for arrival in self.links[address][0].schedule(self.loop.now, len(data), self.rng):
+            self.loop.call_at(arrival, self.deliver_server, address, data)
+
+    def to_client(self, address, data: bytes):
+        if address not in self.links:
+            return
+        for arrival in self.links[address][1].schedule(self.loop.now, len(data), self.rng):
+            self.loop.call_at(arrival, self.deliver_client, address, data)
+
+    def deliver_server(self, address, data: bytes):
+        self.datagrams += 1
+        self.server.handle_datagram(bytearray(data), address)
+
+    def deliver_client(self, address, data: bytes):
+        protocol = self.endpoints.get(address)
+        if protocol is not None:
+            self.datagrams += 1
+            protocol.datagram_received(data, self.server_address)
+
+    def resend_tick(self):
+        self.server.resend_pending()
+        self.loop.call_later(self.resend_interval, self.resend_tick)
+
+    def run(self, coroutine):
+        # Runs a scenario to completion in virtual time and returns its result
+        self.loop.call_soon(self.resend_tick)
+        start = time.perf_counter()
+        try:
+            return self.loop.run_until_complete(coroutine)
+        finally:
+            self.wall_time = time.perf_counter() - start
+
+    def stats(self) -> dict:
+        uplink = {}
+        downlink = {}
+        for up, down in self.links.values():
+            for key, value in up.stats.items():
+                uplink[key] = uplink.get(key, 0) + value
+            for key, value in down.stats.items():
+                downlink[key] = downlink.get(key, 0) + value
+        return {
+            "virtual_time": self.loop.now,
+            "wall_time": getattr(self, "wall_time", 0.0),
+            "datagrams_delivered": self.datagrams,
+            "uplink": uplink,
+            "downlink": downlink
+        }
+
+    def close(self):
+        self.loop.close()
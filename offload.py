@@ -0,0 +1,247 @@
+import time
+import struct
+import logging
+import threading
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import deque
+from typing import Dict
+from rmc import RMCRequest, RMCResponse, call_handler
+from errors import NEXError
+
+logger = logging.getLogger(__name__)
+
+# head and tail are running byte counts, each written by one side only
+RING_HEADER = struct.Struct("<QQ")
+RECORD = struct.Struct("<I")
+WRAP = 0xFFFFFFFF
+# call tag, pid, payload follows
+REQUEST = struct.Struct("<II")
+# call tag, body follows
+RESPONSE = struct.Struct("<I")
+
+
+class SharedRing:
+    # Single producer, single consumer byte ring in shared memory. The semaphores carry the wakeups
+    # and, being system calls, also order the buffer writes against the head and tail updates
+    def __init__(self, buffer: memoryview, items, space):
+        self.header = buffer[:RING_HEADER.size]
+        self.data = buffer[RING_HEADER.size:]
+        self.capacity = len(self.data)
+        self.items = items
+        self.space = space
+
+    def fits(self, size: int) -> bool:
+        return RECORD.size + size <= self.capacity // 2
+
+    def put(self, *chunks) -> bool:
+        size = RECORD.size + sum(len(chunk) for chunk in chunks)
+        head, tail = RING_HEADER.unpack_from(self.header)
+        position = head % self.capacity
+        needed = size
+        if position + size > self.capacity:
+            needed += self.capacity - position
+        if head + needed - tail > self.capacity:
+            return False
+
+        if position + size > self.capacity:
+            if self.capacity - position >= RECORD.size:
+                RECORD.pack_into(self.data, position, WRAP)
+            head += self.capacity - position
+            position = 0
+
+        RECORD.pack_into(self.data, position, size - RECORD.size)
+        position += RECORD.size
+        for chunk in chunks:
+            self.data[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        struct.pack_into("<Q", self.header, 0, head + size)
+        self.items.release()
+        return True
+
+    def put_wait(self, *chunks):
+        while not self.put(*chunks):
+            self.space.acquire(timeout=0.1)
+
+    def get(self, timeout: float = None) -> bytes:
+        if not self.items.acquire(timeout=timeout):
+            return None
+        tail = struct.unpack_from("<Q", self.header, 8)[0]
+        position = tail % self.capacity
+        if self.capacity - position < RECORD.size or RECORD.unpack_from(self.data, position)[0] == WRAP:
+            tail += self.capacity - position
+            position = 0
+        length = RECORD.unpack_from(self.data, position)[0]
+        data = bytes(self.data[position + RECORD.size:position + RECORD.size + length])
+        struct.pack_into("<Q", self.header, 8, tail + RECORD.size + length)
+        self.space.release()
+        return data
+
+    def release(self):
+        self.header.release()
+        self.data.release()
+
+
+class OffloadedClient:
+    def __init__(self, pid: int):
+        self.pid = pid
+
+
+class OffloadedPacket:
+    # What a handler sees in the worker process: the request, but no session to send on
+    def __init__(self, payload: bytes, pid: int):
+        self.payload = payload
+        self.rmc_request = RMCRequest.from_bytes(payload)
+        self.client = OffloadedClient(pid)
+
+
+def worker_main(handlers: dict, requests: SharedRing, responses: SharedRing):
+    while True:
+        record = requests.get()
+        if not record:
+            break
+        tag, pid = REQUEST.unpack_from(record)
+        packet = OffloadedPacket(record[REQUEST.size:], pid)
+        request = packet.rmc_request
+        handler = handlers.get((request["protocol"], request["method"]))
+        if handler is None:
+            body = RMCResponse.error_bytes(request["protocol"], request["call"], NEXError("Core::NotImplemented"), request["custom"])
+        else:
+            body = call_handler(handler, packet)
+        if not responses.fits(RESPONSE.size + len(body)):
+            logger.error("Offloaded response of %d bytes does not fit the ring", len(body))
+            body = RMCResponse.error_bytes(request["protocol"], request["call"], NEXError("Core::Exception"), request["custom"])
+        responses.put_wait(RESPONSE.pack(tag), body)
+
+
+class OffloadWorker:
+    def __init__(self, context, handlers: dict, ring_size: int):
+        self.memory = shared_memory.SharedMemory(create=True, size=2 * (RING_HEADER.size + ring_size))
+        half = RING_HEADER.size + ring_size
+        self.memory.buf[:] = bytes(len(self.memory.buf))
+        self.requests = SharedRing(self.memory.buf[:half], context.Semaphore(0), context.Semaphore(0))
+        self.responses = SharedRing(self.memory.buf[half:2 * half], context.Semaphore(0), context.Semaphore(0))
+        self.pending: Dict[int, tuple] = {}
+        self.backlog = deque()
+        self.lock = threading.Lock()
+        self.alive = True
+        self.process = context.Process(target=worker_main, args=(handlers, self.requests, self.responses),
+                                       name="nex-offload", daemon=True)
+        self.process.start()
+
+    def submit(self, tag: int, pid: int, payload: bytes):
+        # Called from receive threads, so it never blocks: a full ring queues here until the worker catches up
+        with self.lock:
+            if self.backlog or not self.requests.put(REQUEST.pack(tag, pid), payload):
+                self.backlog.append((tag, pid, payload))
+
+    def flush_backlog(self):
+        with self.lock:
+            while self.backlog:
+                tag, pid, payload = self.backlog[0]
+                if not self.requests.put(REQUEST.pack(tag, pid), payload):
+                    break
+                self.backlog.popleft()
+
+
+class OffloadPool:
+    def __init__(self, server, protocols, workers: int = None, ring_size: int = 4 << 20):
+        # Workers are forked, so they see the handlers registered so far. Start the pool before the
+        # receive threads so no lock is copied into the children while held
+        context = multiprocessing.get_context("fork")
+        self.server = server
+        self.protocols = set(protocols)
+        handlers = {key: handler for key, handler in server.rmc_handlers.items() if key[0] in self.protocols}
+        self.workers = [OffloadWorker(context, handlers, ring_size) for _ in range(workers or multiprocessing.cpu_count())]
+        self.tags = itertools.count(1)
+        self.running = True
+        self.submitted = 0
+        self.completed = 0
+        self.local = 0
+        self.collectors = []
+        for worker in self.workers:
+            thread = threading.Thread(target=self.collect, args=(worker,), name="nex-offload-collector", daemon=True)
+            thread.start()
+            self.collectors.append(thread)
+
+    def handles(self, protocol: int) -> bool:
+        return protocol in self.protocols
+
+    def submit(self, packet) -> bool:
+        # Returns False when the call should run in-process instead
+        payload = bytes(packet.payload)
+        workers = [worker for worker in self.workers if worker.alive]
+        if not workers or not workers[0].requests.fits(REQUEST.size + len(payload)):
+            self.local += 1
+            return False
+        worker = min(workers, key=lambda worker: len(worker.pending))
+        tag = next(self.tags) & 0xFFFFFFFF
+        worker.pending[tag] = (packet.client, packet.substream_id, packet.rmc_request)
+        self.submitted += 1
+        worker.submit(tag, packet.client.pid or 0, payload)
+        return True
+
+    def collect(self, worker: OffloadWorker):
+        while self.running:
+            record = worker.responses.get(timeout=0.5)
+            if record is None:
+                if self.running and not worker.process.is_alive():
+                    self.fail(worker)
+                    return
+                continue
+            tag = RESPONSE.unpack_from(record)[0]
+            worker.flush_backlog()
+            entry = worker.pending.pop(tag, None)
+            if entry is None:
+                continue
+            client, substream_id, request = entry
+            self.completed += 1
+            # Back on the normal reliable path, as if a handler thread had produced the body
+            self.server.send_rmc(client, record[RESPONSE.size:], substream_id)
+
+    def fail(self, worker: OffloadWorker):
+        logger.error("Offload worker %d exited with %s", worker.process.pid, worker.process.exitcode)
+        worker.alive = False
+        with worker.lock:
+            worker.backlog.clear()
+        for tag in list(worker.pending):
+            client, substream_id, request = worker.pending.pop(tag)
+            body = RMCResponse.error_bytes(request["protocol"], request["call"], NEXError("Core::Exception"), request["custom"])
+            self.server.send_rmc(client, body, substream_id)
+
+    def outstanding(self) -> int:
+        return sum(len(worker.pending) for worker in self.workers)
+
+    def drain(self, deadline: float):
+        while self.outstanding() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self.workers),
+            "alive": sum(worker.alive for worker in self.workers),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "outstanding": self.outstanding(),
+            "backlog": sum(len(worker.backlog) for worker in self.workers),
+            "local": self.local
+        }
+
+    def close(self, timeout: float = 2.0):
+        self.running = False
+        for worker in self.workers:
+            # An empty record tells the worker to exit
+            with worker.lock:
+                worker.requests.put()
+        for worker in self.workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        for thread in self.collectors:
+            thread.join(timeout)
+        for worker in self.workers:
+            worker.requests.release()
+            worker.responses.release()
+            worker.memory.close()
+            worker.memory.unlink()
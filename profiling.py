@@ -0,0 +1,81 @@
+import random
+import threading
+from typing import Dict
+
+STAGES = ("recv", "decode", "checksum", "decrypt", "reassembly", "rmc_decode", "handler", "send")
+
+
+class StageProfiler:
+    def __init__(self, server, sample_rate: float = 1.0):
+        self.server = server
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.samples: Dict[str, list] = {}
+        self.timer = None
+        self.running = False
+
+    def hook(self, stage: str, elapsed: float, size: int, packet):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        stack = self.stack(stage, packet)
+        with self.lock:
+            entry = self.samples.get(stack)
+            if entry is None:
+                entry = self.samples[stack] = [0, 0.0, 0]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] += size
+
+    def stack(self, stage: str, packet) -> str:
+        if packet is None:
+            return f"prudp;{stage}"
+        frames = ["prudp", type(packet).__name__, stage]
+        if stage in ("handler", "rmc_decode"):
+            rmc_request = packet.rmc_request
+            frames.append(f"protocol_{rmc_request['protocol']}")
+            frames.append(f"method_{rmc_request['method']}")
+        return ";".join(frames)
+
+    def start(self, window: float = None, path: str = None):
+        if self.running:
+            return
+        self.running = True
+        for stage in STAGES:
+            self.server.add_stage_hook(stage, self.hook)
+        if window is not None:
+            self.timer = threading.Timer(window, self.stop, args=(path,))
+            self.timer.daemon = True
+            self.timer.start()
+
+    def stop(self, path: str = None):
+        if not self.running:
+            return
+        self.running = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for stage in STAGES:
+            self.server.remove_stage_hook(stage, self.hook)
+        if path is not None:
+            self.dump(path)
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                stack: {"count": count, "seconds": seconds, "bytes": size}
+                for stack, (count, seconds, size) in self.samples.items()
+            }
+
+    def folded(self) -> str:
+        # Collapsed stack format with microsecond weights, as read by flamegraph.pl and speedscope
+        with self.lock:
+            lines = [f"{stack} {int(seconds * 1000000)}" for stack, (count, seconds, size) in sorted(self.samples.items())]
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            f.write(self.folded())
@@ -2,19 +2,55 @@ import socket
 import time
 import datetime
 import os
-import inspect
+import stat
 import threading
-import multiprocessing
 import logging
 import hmac
 import hashlib
 import struct
-from typing import Dict
+from collections import deque
+from typing import Dict, TYPE_CHECKING
 from common import SYN_PACKET, CONNECT_PACKET, DATA_PACKET, DISCONNECT_PACKET, PING_PACKET, FLAG_ACK, FLAG_NEED_ACK, FLAG_RELIABLE, FLAG_HAS_SIZE, FLAG_MULTI_ACK
+from common import OPTION_SUPPORTED_FUNCTIONS, OPTION_CONNECTION_SIGNATURE, OPTION_FRAGMENT_ID, OPTION_INITIAL_SEQUENCE_ID, OPTION_MAX_SUBSTREAM_ID, OPTION_CONNECTION_SIG_LITE
+from common import RC4, DummyCompression, md5_hash, LITE_MAX_PAYLOAD
 from rmc import RMCRequest
+from kerberos import KerberosCipher, KerberosTicketInternal, derive_kerberos_key
+from ratelimit import RateLimiter, SynCookies, peek_packet_type, is_handshake
+from metrics import Metrics
+from profiling import STAGES
+from capture import CaptureWriter, NullSocket, CAPTURE_SIGNATURE
+from handoff import write_snapshot, restore_snapshot, send_socket, receive_socket
+from cache import ResponseCache
+from congestion import RTTEstimator, FixedWindow, FragmentSizer, Pacer
+if TYPE_CHECKING:
+    from lite import LiteStream
+    from offload import OffloadPool
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_RC4_KEY = b"CD&ML"
+
+
+def sequence_before(a: int, b: int) -> bool:
+    # Sequence ids are 16 bits and wrap around
+    return a != b and ((b - a) & 0xFFFF) < 0x8000
+
+
+class Substream:
+    def __init__(self, key: bytes):
+        self.sequence_id_out = 1
+        self.sequence_id_in = 1
+        self.incoming: Dict[int, 'PRUDPPacket'] = {}
+        self.fragments = bytearray()
+        self.cipher_in = RC4(key)
+        self.cipher_out = RC4(key)
+        self.queue = deque()
+
+    def set_key(self, key: bytes):
+        self.cipher_in = RC4(key)
+        self.cipher_out = RC4(key)
+
+
 class PRUDPClient:
     def __init__(self, address: socket.socket, server: 'PRUDPServer'):
         self.address = address
@@ -30,32 +66,178 @@ class PRUDPClient:
         self.connected = bool()
         self.server_connection_signature = bytearray()
         self.client_connection_signature = bytearray()
+        self.server_side = True
+        self.source = 0xA1
+        self.destination = 0xAF
+        self.lock = threading.RLock()
+        self.ping_sequence_id = 0
+        self.pending: Dict[tuple, list] = {}
+        self.max_substream_id = 0
+        self.substreams = [Substream(DEFAULT_RC4_KEY)]
+        self.stream: 'LiteStream' = None
+        self.congestion = FixedWindow()
+        self.rtt = RTTEstimator()
+        self.fragment_sizer = FragmentSizer()
+        self.in_flight = 0
+        self.next_substream = 0
+        self.next_send = 0.0
+        self.flush_scheduled = False
+        self.packets_sent = 0
+        self.retransmits = 0
+        self.clock = time.monotonic
+
+    def set_access_key(self, access_key: str):
+        key = access_key.encode()
+        self.signature_base = sum(key)
+        self.signature_key = md5_hash(key)
+
+    def set_session_key(self, session_key: bytes):
+        self.session_key = session_key
+        for substream in self.substreams:
+            substream.set_key(session_key)
+
+    def open_substreams(self, max_substream_id: int):
+        # Every substream has its own sequence space, reassembly buffer and RC4 state; substream 0
+        # already carried the handshake and keeps its state
+        self.max_substream_id = max_substream_id
+        key = self.session_key or DEFAULT_RC4_KEY
+        self.substreams = self.substreams[:max_substream_id + 1]
+        while len(self.substreams) <= max_substream_id:
+            self.substreams.append(Substream(key))
+
+    def local_signature(self) -> bytes:
+        return self.server_connection_signature if self.server_side else self.client_connection_signature
+
+    def remote_signature(self) -> bytes:
+        return self.client_connection_signature if self.server_side else self.server_connection_signature
+
+    def next_sequence_id(self, substream_id: int = 0) -> int:
+        substream = self.substreams[substream_id]
+        sequence_id = substream.sequence_id_out
+        substream.sequence_id_out = (sequence_id + 1) & 0xFFFF
+        return sequence_id
+
+    def encrypt(self, data: bytes, substream_id: int = 0) -> bytes:
+        return self.substreams[substream_id].cipher_out.crypt(data)
+
+    def decrypt(self, data: bytes, substream_id: int = 0) -> bytes:
+        return self.substreams[substream_id].cipher_in.crypt(data)
+
+    def accept(self, packet: 'PRUDPPacket') -> list:
+        # Returns the reliable packets that can be processed now, in sequence order
+        substream = self.substreams[packet.substream_id]
+        if packet.sequence_id != substream.sequence_id_in:
+            if not sequence_before(packet.sequence_id, substream.sequence_id_in):
+                substream.incoming[packet.sequence_id] = packet
+            return []
+
+        ready = [packet]
+        substream.sequence_id_in = (substream.sequence_id_in + 1) & 0xFFFF
+        while substream.sequence_id_in in substream.incoming:
+            ready.append(substream.incoming.pop(substream.sequence_id_in))
+            substream.sequence_id_in = (substream.sequence_id_in + 1) & 0xFFFF
+        return ready
+
+    def reassemble(self, packet: 'PRUDPPacket'):
+        # Returns the complete message once the last fragment (fragment id 0) arrived
+        substream = self.substreams[packet.substream_id]
+        if packet.fragment_id != 0:
+            substream.fragments += packet.payload
+            return None
+        if substream.fragments:
+            message = bytes(substream.fragments + packet.payload)
+            substream.fragments = bytearray()
+            return message
+        return bytes(packet.payload)
+
+    def acknowledge(self, packet_type: int, sequence_id: int, substream_id: int = 0) -> bool:
+        entry = self.pending.pop((packet_type, substream_id, sequence_id), None)
+        if entry is None:
+            if packet_type == PING_PACKET:
+                self.fragment_sizer.probe_acked(sequence_id)
+            return False
+        rtt = None
+        if entry[2] == 0:
+            # Karn's algorithm: the ack of a retransmitted packet could belong to either copy
+            rtt = self.clock() - entry[1]
+            self.rtt.update(rtt)
+        if packet_type == DATA_PACKET:
+            self.in_flight -= 1
+            self.congestion.on_ack(rtt)
+            self.fragment_sizer.on_ack()
+        return True
+
+    def acknowledge_multiple(self, payload: bytes):
+        # Aggregate ack: substream id, number of extra ids, base sequence id, extra ids
+        if len(payload) < 4:
+            return
+        substream_id = payload[0]
+        count = payload[1]
+        base = struct.unpack_from("<H", payload, 2)[0]
+        for packet_type, pending_substream, sequence_id in list(self.pending):
+            if packet_type == DATA_PACKET and pending_substream == substream_id and not sequence_before(base, sequence_id):
+                self.acknowledge(DATA_PACKET, sequence_id, substream_id)
+        for i in range(min(count, (len(payload) - 4) // 2)):
+            self.acknowledge(DATA_PACKET, struct.unpack_from("<H", payload, 4 + i * 2)[0], substream_id)
+
+    def retransmit_timeout(self, retries: int, default: float) -> float:
+        # Until the first RTT sample the configured timeout is all there is to go on
+        if not self.rtt.samples:
+            return default
+        return self.rtt.timeout(retries)
+
+    def transport_stats(self) -> dict:
+        return {
+            "srtt": self.rtt.srtt,
+            "rttvar": self.rtt.rttvar,
+            "rto": self.rtt.rto,
+            "rtt_samples": self.rtt.samples,
+            "window": self.congestion.window,
+            "fragment_size": self.fragment_sizer.size,
+            "in_flight": self.in_flight,
+            "queued": sum(len(substream.queue) for substream in self.substreams),
+            "packets_sent": self.packets_sent,
+            "retransmits": self.retransmits,
+            "loss": self.retransmits / self.packets_sent if self.packets_sent else 0.0
+        }
 
 
 class PRUDPPacket:
-    def __init__(self, client: PRUDPClient, data: bytearray):
-        self.client = client  
+    def __init__(self, client: PRUDPClient = None, data: bytearray = None):
+        self.client = client
         self.data = data
         self.version = int()
         self.source = int()
         self.destination = int()
         self.packet_type = int()
         self.flags = int()
+        self.session_id = int()
+        self.sequence_id = int()
         self.fragment_id = int()
+        self.substream_id = int()
+        self.max_substream_id = int()
+        self.signature = bytearray()
         self.connection_signature = bytearray()
         self.payload = bytearray()
         self.rmc_request = RMCRequest()
 
+    def new(self, packet_type: int, flags: int) -> 'PRUDPPacket':
+        packet = type(self)(self.client, None)
+        packet.source = self.client.source
+        packet.destination = self.client.destination
+        packet.session_id = self.client.session_id
+        packet.packet_type = packet_type
+        packet.flags = flags
+        return packet
+
 
 class PRUDPPacketV0(PRUDPPacket):
-    def __init__(self, client: PRUDPClient, data: bytearray):
-        super().__init__()
-        self.client = client
+    def __init__(self, client: PRUDPClient = None, data: bytearray = None):
+        super().__init__(client, data)
         self.checksum = int()
-        self.data = data
 
     def calculate_checksum(self, data: bytes) -> int:
-        signature_base = self.signature_base
+        signature_base = self.client.signature_base
         temp = 0
         steps = len(data) // 4
         for i in range(steps):
@@ -69,30 +251,223 @@ class PRUDPPacketV0(PRUDPPacket):
 
         return checksum & 0xFF
 
-        
+    def calculate_signature(self, connection_signature: bytes) -> bytes:
+        if self.packet_type == DATA_PACKET:
+            if not self.payload:
+                return struct.pack('<I', 0x12345678)
+            return hmac.new(self.client.signature_key, self.payload, hashlib.md5).digest()[:4]
+        return bytes(connection_signature[:4]).ljust(4, b"\0")
+
+    def decode(self):
+        data = self.data
+        if len(data) < 12:
+            raise ValueError("Packet too short")
+
+        self.checksum = data[-1]
+        if self.calculate_checksum(data[:-1]) != self.checksum:
+            raise ValueError("Invalid checksum")
+
+        self.source, self.destination, type_flags, self.session_id = struct.unpack_from('<BBHB', data, 0)
+        self.signature = bytes(data[5:9])
+        self.sequence_id = struct.unpack_from('<H', data, 9)[0]
+        self.packet_type = type_flags & 0xF
+        self.flags = type_flags >> 4
+
+        offset = 11
+        if self.packet_type == SYN_PACKET or self.packet_type == CONNECT_PACKET:
+            self.connection_signature = bytes(data[offset:offset + 4])
+            offset += 4
+        if self.packet_type == DATA_PACKET:
+            self.fragment_id = data[offset]
+            offset += 1
+
+        end = len(data) - 1
+        if self.flags & FLAG_HAS_SIZE:
+            size = struct.unpack_from('<H', data, offset)[0]
+            offset += 2
+            if offset + size != end:
+                raise ValueError("Payload size mismatch")
+        if offset > end:
+            raise ValueError("Packet too short")
+
+        self.payload = data[offset:end]
+
+    def valid_signature(self) -> bool:
+        if self.packet_type == SYN_PACKET:
+            return True
+        expected = self.calculate_signature(self.client.local_signature())
+        return hmac.compare_digest(expected, bytes(self.signature))
+
+    def encode(self) -> bytes:
+        self.signature = self.calculate_signature(self.client.remote_signature())
+
+        out = bytearray(struct.pack('<BBHB', self.source, self.destination, self.packet_type | (self.flags << 4), self.session_id))
+        out += self.signature
+        out += struct.pack('<H', self.sequence_id)
+        if self.packet_type == SYN_PACKET or self.packet_type == CONNECT_PACKET:
+            out += bytes(self.connection_signature[:4]).ljust(4, b"\0")
+        if self.packet_type == DATA_PACKET:
+            out.append(self.fragment_id)
+        if self.flags & FLAG_HAS_SIZE:
+            out += struct.pack('<H', len(self.payload))
+        out += self.payload
+        out.append(self.calculate_checksum(out))
+        return bytes(out)
 
 
 class PRUDPPacketV1(PRUDPPacket):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, client: PRUDPClient = None, data: bytearray = None):
+        super().__init__(client, data)
         self.magic = bytearray()
-        self.substream_id = int()
         self.supported_functions = int()
         self.initial_sequence_id = int()
-        self.max_substream_id = int()
+        self.header = bytes()
+        self.options = bytes()
 
     def calculate_signature(packet, header: bytes, connection_signature: bytes, options: bytes, payload: bytes) -> bytes:
-        key = packet.signature_key
-        signature_base = struct.pack('<I', packet.signature_base)
+        key = packet.client.signature_key
+        signature_base = struct.pack('<I', packet.client.signature_base)
         mac = hmac.new(key, digestmod=hashlib.md5)
         mac.update(header[4:])
-        mac.update(packet.session_key)
+        if packet.packet_type != SYN_PACKET and packet.packet_type != CONNECT_PACKET:
+            # The handshake is signed without the session key so a retransmitted CONNECT still validates
+            mac.update(packet.client.session_key)
         mac.update(signature_base)
         mac.update(connection_signature)
         mac.update(options)
         mac.update(payload)
         return mac.digest()
 
+    def decode(self):
+        data = self.data
+        if len(data) < 30 or data[0] != 0xEA or data[1] != 0xD0:
+            raise ValueError("Invalid PRUDPv1 packet")
+
+        self.magic = data[:2]
+        self.version, options_length, payload_size = struct.unpack_from('<BBH', data, 2)
+        self.source, self.destination, type_flags, self.session_id, self.substream_id, self.sequence_id = struct.unpack_from('<BBHBBH', data, 6)
+        self.packet_type = type_flags & 0xF
+        self.flags = type_flags >> 4
+        self.header = bytes(data[2:14])
+        self.signature = bytes(data[14:30])
+
+        if 30 + options_length + payload_size > len(data):
+            raise ValueError("Packet too short")
+
+        self.options = bytes(data[30:30 + options_length])
+        self.payload = data[30 + options_length:30 + options_length + payload_size]
+        self.decode_options(self.options)
+
+    def decode_options(self, options: bytes):
+        offset = 0
+        while offset + 2 <= len(options):
+            option_id, size = options[offset], options[offset + 1]
+            value = options[offset + 2:offset + 2 + size]
+            offset += 2 + size
+            if option_id == OPTION_SUPPORTED_FUNCTIONS and size == 4:
+                self.supported_functions = struct.unpack('<I', value)[0]
+            elif option_id == OPTION_CONNECTION_SIGNATURE:
+                self.connection_signature = bytes(value)
+            elif option_id == OPTION_FRAGMENT_ID and size == 1:
+                self.fragment_id = value[0]
+            elif option_id == OPTION_INITIAL_SEQUENCE_ID and size == 2:
+                self.initial_sequence_id = struct.unpack('<H', value)[0]
+            elif option_id == OPTION_MAX_SUBSTREAM_ID and size == 1:
+                self.max_substream_id = value[0]
+
+    def encode_options(self) -> bytes:
+        options = bytearray()
+        if self.packet_type == SYN_PACKET or self.packet_type == CONNECT_PACKET:
+            options += struct.pack('<BBI', OPTION_SUPPORTED_FUNCTIONS, 4, self.supported_functions)
+            options += struct.pack('<BB', OPTION_CONNECTION_SIGNATURE, 16) + bytes(self.connection_signature[:16]).ljust(16, b"\0")
+            if self.packet_type == CONNECT_PACKET:
+                options += struct.pack('<BBH', OPTION_INITIAL_SEQUENCE_ID, 2, self.initial_sequence_id)
+            options += struct.pack('<BBB', OPTION_MAX_SUBSTREAM_ID, 1, self.max_substream_id)
+        elif self.packet_type == DATA_PACKET:
+            options += struct.pack('<BBB', OPTION_FRAGMENT_ID, 1, self.fragment_id)
+        return bytes(options)
+
+    def connection_signature_for(self, connection_signature: bytes) -> bytes:
+        # SYN packets are exchanged before either side knows the other's signature
+        return b"" if self.packet_type == SYN_PACKET else connection_signature
+
+    def valid_signature(self) -> bool:
+        connection_signature = self.connection_signature_for(self.client.local_signature())
+        expected = self.calculate_signature(self.header, connection_signature, self.options, self.payload)
+        return hmac.compare_digest(expected, bytes(self.signature))
+
+    def encode(self) -> bytes:
+        self.options = self.encode_options()
+        self.header = struct.pack(
+            '<BBHBBHBBH', 1, len(self.options), len(self.payload), self.source, self.destination,
+            self.packet_type | (self.flags << 4), self.session_id, self.substream_id, self.sequence_id
+        )
+        connection_signature = self.connection_signature_for(self.client.remote_signature())
+        self.signature = self.calculate_signature(self.header, connection_signature, self.options, self.payload)
+        return b"\xEA\xD0" + self.header + self.signature + self.options + bytes(self.payload)
+
+
+class PRUDPPacketLite(PRUDPPacket):
+    def __init__(self, client: PRUDPClient = None, data: bytearray = None):
+        super().__init__(client, data)
+        self.source_stream_type = 10
+        self.destination_stream_type = 10
+        self.supported_functions = int()
+        self.initial_sequence_id = int()
+
+    def decode(self):
+        data = self.data
+        if len(data) < 12 or data[0] != 0x80:
+            raise ValueError("Invalid PRUDPLite packet")
+
+        options_length, payload_size, stream_types, self.source, self.destination, self.fragment_id, type_flags, self.sequence_id = struct.unpack_from('<BHBBBBHH', data, 1)
+        self.source_stream_type = stream_types >> 4
+        self.destination_stream_type = stream_types & 0xF
+        self.packet_type = type_flags & 0xF
+        self.flags = type_flags >> 4
+
+        if 12 + options_length + payload_size > len(data):
+            raise ValueError("Packet too short")
+
+        self.decode_options(bytes(data[12:12 + options_length]))
+        self.payload = bytes(data[12 + options_length:12 + options_length + payload_size])
+
+    def decode_options(self, options: bytes):
+        offset = 0
+        while offset + 2 <= len(options):
+            option_id, size = options[offset], options[offset + 1]
+            value = options[offset + 2:offset + 2 + size]
+            offset += 2 + size
+            if option_id == OPTION_SUPPORTED_FUNCTIONS and size == 4:
+                self.supported_functions = struct.unpack('<I', value)[0]
+            elif option_id == OPTION_CONNECTION_SIGNATURE or option_id == OPTION_CONNECTION_SIG_LITE:
+                self.connection_signature = bytes(value)
+            elif option_id == OPTION_INITIAL_SEQUENCE_ID and size == 2:
+                self.initial_sequence_id = struct.unpack('<H', value)[0]
+            elif option_id == OPTION_MAX_SUBSTREAM_ID and size == 1:
+                self.max_substream_id = value[0]
+
+    def encode_options(self) -> bytes:
+        options = bytearray()
+        if self.packet_type == SYN_PACKET or self.packet_type == CONNECT_PACKET:
+            options += struct.pack('<BBI', OPTION_SUPPORTED_FUNCTIONS, 4, self.supported_functions)
+            if self.packet_type == SYN_PACKET and self.flags & FLAG_ACK:
+                options += struct.pack('<BB', OPTION_CONNECTION_SIGNATURE, 16) + bytes(self.connection_signature[:16]).ljust(16, b"\0")
+            elif self.packet_type == CONNECT_PACKET and not self.flags & FLAG_ACK:
+                options += struct.pack('<BB', OPTION_CONNECTION_SIG_LITE, 16) + bytes(self.connection_signature[:16]).ljust(16, b"\0")
+        return bytes(options)
+
+    def valid_signature(self) -> bool:
+        # Lite packets are unsigned, the stream transport (TLS or WebSocket over TLS) protects them
+        return True
+
+    def encode(self) -> bytes:
+        options = self.encode_options()
+        header = struct.pack(
+            '<BBHBBBBHH', 0x80, len(options), len(self.payload), (self.source_stream_type << 4) | self.destination_stream_type,
+            self.source, self.destination, self.fragment_id, self.packet_type | (self.flags << 4), self.sequence_id
+        )
+        return header + options + bytes(self.payload)
 
 
 class PRUDPServer(PRUDPClient):
@@ -102,14 +477,42 @@ class PRUDPServer(PRUDPClient):
         self.generic_event_handles: Dict[str, list] = {}
         self.prudp_v0_event_handles: Dict[str, list] = {}
         self.prudp_v1_event_handles: Dict[str, list] = {}
+        self.prudp_lite_event_handles: Dict[str, list] = {}
+        self.rmc_handlers: Dict[tuple, object] = {}
         self.access_key = str()
         self.prudp_version = 1
         self.nex_version = int()
         self.fragment_size = 1300
+        self.min_fragment_size = 512
+        self.max_fragment_size = 1400
+        self.compression = DummyCompression()
+        self.resend_timeout = 1.0
+        self.resend_max = 5
         self.kerberos_password = str()
+        self.kerberos_key = bytes()
         self.kerberos_size = 32
         self.kerberos_derivation = 0
         self.kerberos_ticket = int()
+        self.rate_limiter: RateLimiter = None
+        self.syn_cookies: SynCookies = None
+        self.metrics: Metrics = None
+        self.running_handlers = 0
+        self.stage_hooks: Dict[str, list] = {}
+        self.capture: CaptureWriter = None
+        # Read through the server so a clock swapped in later (netsim's virtual one) also ages the cache
+        self.response_cache = ResponseCache(clock=lambda: self.clock())
+        self.offload: 'OffloadPool' = None
+        self.max_substream_id = 0
+        self.congestion_control = FixedWindow
+        self.pacer = Pacer()
+        self.lock = threading.Lock()
+        self.call_id = 0
+        self.draining = False
+        self.handoff_backlog = []
+        self.receive_threads = []
+        self.stopped: threading.Event = None
+        self.inline_handlers = False
+        self.clock = time.monotonic
 
     def listen(self, address: str):
         udp_ip, udp_port = address.split(":")
@@ -117,72 +520,330 @@ class PRUDPServer(PRUDPClient):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.bind((udp_ip, udp_port))
 
+        print(f"[{datetime.datetime.now()}] PRUDP Server listening on {udp_ip}:{udp_port}")
+        self.serve(sock)
+
+    def serve(self, sock: socket.socket, backlog: list = ()):
+        # The timeout only lets the receive threads notice a handoff
+        sock.settimeout(0.5)
         self.socket = sock
 
         quit_event = threading.Event()
+        self.stopped = quit_event
+
+        for addr, data in backlog:
+            self.handle_datagram(data, addr)
 
         def listen_datagram():
             err = None
-            while err is None:
+            while err is None and not self.draining:
                 try:
                     err = self.handle_socket_message()
                 except Exception as e:
                     err = e
-            quit_event.set()
-            raise err
+            if err is not None:
+                quit_event.set()
+                raise err
 
-        num_threads = multiprocessing.cpu_count()
+        num_threads = os.cpu_count() or 1
+        self.receive_threads = []
         for _ in range(num_threads):
             thread = threading.Thread(target=listen_datagram, daemon=True)
             thread.start()
+            self.receive_threads.append(thread)
+
+        threading.Thread(target=self.resend_loop, daemon=True).start()
 
-        print(f"[{datetime.datetime.now()}] PRUDP Server listening on {udp_ip}:{udp_port}")
         self.emit("Listening", None)
 
         quit_event.wait()
 
+    def enable_handoff(self, path: str, drain_timeout: float = 5.0):
+        # A new build calls resume() with the same path; this process then hands over its socket and
+        # sessions and its listen() returns
+        if os.path.exists(path):
+            # Only a socket left behind by an earlier server may go, never a file that happens to be there
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise ValueError(f"Handoff path exists and is not a socket: {path}")
+            os.unlink(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+
+        def accept():
+            connection, _ = listener.accept()
+            listener.close()
+            os.unlink(path)
+            with connection:
+                self.handoff(connection, drain_timeout)
+
+        threading.Thread(target=accept, daemon=True).start()
+
+    def handoff(self, connection: socket.socket, drain_timeout: float = 5.0):
+        # Stop reading; anything a receive thread picks up from now on goes into the snapshot instead
+        self.draining = True
+        deadline = time.monotonic() + drain_timeout
+        for thread in self.receive_threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        # Handlers still running would send on sequence ids and RC4 state the snapshot already holds
+        for thread in threading.enumerate():
+            if thread.name == "nex-handler":
+                thread.join(max(0, deadline - time.monotonic()))
+                if thread.is_alive():
+                    logger.warning("Handing off while a handler is still running")
+        if self.offload is not None:
+            self.offload.drain(deadline)
+            if self.offload.outstanding():
+                logger.warning("Handing off with offloaded calls still running")
+
+        sock = self.socket
+        self.socket = NullSocket()
+        clients = [client for client in list(self.clients.values()) if client.stream is None]
+        for client in clients:
+            client.lock.acquire()
+        try:
+            snapshot = write_snapshot(clients, self.handoff_backlog)
+        finally:
+            for client in clients:
+                client.lock.release()
+
+        send_socket(connection, sock, snapshot)
+        sock.close()
+        self.emit("Handoff", None)
+        if self.stopped is not None:
+            self.stopped.set()
+
+    def resume(self, path: str, drain_timeout: float = 5.0):
+        sock, snapshot = receive_socket(path)
+        backlog = restore_snapshot(self, snapshot)
+        # The old process removed the path once it accepted, so the next deploy can use it again
+        self.enable_handoff(path, drain_timeout)
+        address = sock.getsockname()
+        print(f"[{datetime.datetime.now()}] PRUDP Server resumed {len(self.clients)} sessions on {address[0]}:{address[1]}")
+        self.serve(sock, backlog)
+
+    async def listen_lite(self, address: str, websocket: bool = False):
+        # Only Lite servers need asyncio and the stream protocols, plain UDP servers skip importing them
+        import asyncio
+        from lite import LiteStream, WebSocketStream
+        host, port = address.split(":")
+        loop = asyncio.get_running_loop()
+        protocol = WebSocketStream if websocket else LiteStream
+        server = await loop.create_server(lambda: protocol(self), host, int(port))
+
+        print(f"[{datetime.datetime.now()}] PRUDPLite Server listening on {host}:{port}")
+        self.emit("Listening", None)
+
+        async with server:
+            await server.serve_forever()
+
+    def new_stream_client(self, stream: 'LiteStream') -> PRUDPClient:
+        client = self.new_client(stream.address)
+        client.stream = stream
+        self.clients[f"{stream.address[0]}:{stream.address[1]}"] = client
+        return client
+
+    def handle_stream_packet(self, client: PRUDPClient, data: memoryview):
+        hooks = self.stage_hooks
+        metrics = self.metrics
+
+        if metrics is not None or hooks:
+            start = time.perf_counter()
+
+        try:
+            packet = PRUDPPacketLite(client, data)
+            packet.decode()
+        except Exception:
+            if metrics is not None:
+                metrics.inc("prudp_invalid_packets_total")
+            return
+
+        # The frame lives in the stream's receive buffer, which is reused once this returns
+        packet.data = None
+
+        if metrics is not None:
+            metrics.observe("prudp_parse_seconds", time.perf_counter() - start)
+            metrics.packet_in(packet.packet_type, len(data))
+
+        if hooks:
+            self.fire_stage("decode", start, len(data), packet)
+
+        with client.lock:
+            self.handle_packet(packet)
+
+    def new_client(self, address) -> PRUDPClient:
+        client = PRUDPClient(address, self)
+        client.set_access_key(self.access_key)
+        client.congestion = self.congestion_control()
+        client.fragment_sizer = self.new_fragment_sizer()
+        client.clock = self.clock
+        return client
+
+    def new_fragment_sizer(self) -> FragmentSizer:
+        return FragmentSizer(self.fragment_size, self.min_fragment_size, self.max_fragment_size)
+
+    def new_packet(self, client: PRUDPClient, data: bytearray = None) -> PRUDPPacket:
+        if client is not None and client.stream is not None:
+            return PRUDPPacketLite(client, data)
+        if self.prudp_version == 0:
+            return PRUDPPacketV0(client, data)
+        return PRUDPPacketV1(client, data)
+
     def handle_socket_message(self):
         buffer = bytearray(64000)
         sock = self.socket
 
         try:
             length, addr = sock.recvfrom_into(buffer)
+        except socket.timeout:
+            return None
         except Exception as err:
             return err
 
+        data = buffer[:length]
+        if self.draining:
+            with self.lock:
+                self.handoff_backlog.append((addr, data))
+            return None
+        if self.capture is not None:
+            self.capture.record(addr, data)
+
+        return self.handle_datagram(data, addr)
+
+    def handle_datagram(self, data: bytearray, addr):
+        length = len(data)
+        hooks = self.stage_hooks
+        if hooks:
+            recv_start = time.perf_counter()
+
+        if self.rate_limiter is not None and not self.rate_limiter.allow(addr):
+            return None
+
         discriminator = f"{addr[0]}:{addr[1]}"
 
-        if discriminator not in self.clients:
-            new_client = PRUDPClient(addr, self)
-            self.clients[discriminator] = new_client
+        client = self.clients.get(discriminator)
+        unverified = False
+        if client is None:
+            if self.syn_cookies is not None:
+                # Unknown peers get no stored state until their CONNECT echoes a valid cookie
+                if not is_handshake(peek_packet_type(data, self.prudp_version)):
+                    self.drop_unverified()
+                    return None
+                unverified = True
+            client = self.new_client(addr)
+            if not unverified:
+                self.clients[discriminator] = client
 
-        client = self.clients[discriminator]
+        metrics = self.metrics
 
-        data = buffer[:length]
+        if hooks:
+            self.fire_stage("recv", recv_start, length, None)
+
+        if metrics is not None or hooks:
+            start = time.perf_counter()
 
         try:
-            if self.prudp_version == 0:
-                packet = PRUDPPacketV0(client, data)
-            else:
-                packet = PRUDPPacketV1(client, data)
+            packet = self.new_packet(client, data)
+            packet.decode()
         except Exception:
+            if metrics is not None:
+                metrics.inc("prudp_invalid_packets_total")
             return None
 
-        if (packet.flags & FLAG_ACK) != 0 or (packet.flags & FLAG_MULTI_ACK) != 0:
+        if metrics is not None:
+            metrics.observe("prudp_parse_seconds", time.perf_counter() - start)
+            metrics.packet_in(packet.packet_type, length)
+
+        if hooks:
+            self.fire_stage("decode", start, length, packet)
+
+        if unverified and packet.packet_type == CONNECT_PACKET:
+            if not self.check_cookie(packet):
+                self.drop_unverified()
+                return None
+            # No state was kept from the SYN, so the ports come from the CONNECT, which repeats them
+            client.source = packet.destination
+            client.destination = packet.source
+            # The SYN that would have marked it connected ran on a client that was thrown away
+            client.connected = True
+            self.clients[discriminator] = client
+
+        if metrics is not None or hooks:
+            start = time.perf_counter()
+
+        valid = packet.valid_signature()
+
+        if metrics is not None:
+            metrics.observe("prudp_signature_seconds", time.perf_counter() - start)
+
+        if hooks:
+            self.fire_stage("checksum", start, length, packet)
+
+        if not valid:
+            if metrics is not None:
+                metrics.inc("prudp_invalid_signatures_total")
             return None
 
-        if (packet.flags & FLAG_NEED_ACK) != 0:
+        with client.lock:
+            self.handle_packet(packet)
+
+        return None
+
+    def handle_packet(self, packet: PRUDPPacket):
+        client = packet.client
+
+        if (packet.flags & FLAG_ACK) != 0 or (packet.flags & FLAG_MULTI_ACK) != 0:
+            if self.metrics is not None:
+                self.metrics.inc("prudp_acks_in_total")
+            if packet.flags & FLAG_MULTI_ACK:
+                client.acknowledge_multiple(packet.payload)
+            else:
+                client.acknowledge(packet.packet_type, packet.sequence_id, packet.substream_id)
+            self.flush(client)
+            return
+
+        if packet.substream_id > client.max_substream_id:
+            return
+
+        if packet.packet_type == SYN_PACKET:
+            if self.syn_cookies is not None:
+                client.server_connection_signature = self.syn_cookies.make(client.address)
+            elif client.client_connection_signature or not client.server_connection_signature:
+                # A repeated SYN before CONNECT keeps the signature so a late SYN ack stays valid
+                client.server_connection_signature = self.new_connection_signature(client)
+            self.reset_client(client)
+            client.source = packet.destination
+            client.destination = packet.source
+
+        if packet.packet_type == CONNECT_PACKET:
+            client.client_connection_signature = packet.connection_signature
+            client.session_id = packet.session_id
+            client.open_substreams(min(packet.max_substream_id, self.max_substream_id))
+            client.substreams[0].sequence_id_in = (packet.sequence_id + 1) & 0xFFFF
+
+        # Stream clients only get handshake acks, the transport already guarantees delivery
+        if (packet.flags & FLAG_NEED_ACK) != 0 and (client.stream is None or packet.packet_type == SYN_PACKET or packet.packet_type == CONNECT_PACKET):
             if packet.packet_type != CONNECT_PACKET or (packet.packet_type == CONNECT_PACKET and len(packet.payload) <= 0):
-                threading.Thread(target=self.acknowledge_packet, args=(packet, None)).start()
+                self.acknowledge_packet(packet, None)
+            elif self.kerberos_password:
+                response = self.validate_ticket(client, packet.payload)
+                if response is None:
+                    return
+                self.acknowledge_packet(packet, response)
 
         if packet.packet_type == SYN_PACKET:
             client.connected = True
             self.emit("Syn", packet)
         elif packet.packet_type == CONNECT_PACKET:
-            packet.client_connection_signature = packet.connection_signature
             self.emit("Connect", packet)
         elif packet.packet_type == DATA_PACKET:
-            self.emit("Data", packet)
+            if client.stream is not None:
+                self.handle_data(packet)
+            elif packet.flags & FLAG_RELIABLE:
+                for ready in client.accept(packet):
+                    self.handle_data(ready)
+            else:
+                self.emit("Data", packet)
         elif packet.packet_type == DISCONNECT_PACKET:
             self.emit("Disconnect", packet)
             self.kick(client)
@@ -191,21 +852,130 @@ class PRUDPServer(PRUDPClient):
 
         self.emit("Packet", packet)
 
-        return None
-    
+    def handle_data(self, packet: PRUDPPacket):
+        client = packet.client
+        hooks = self.stage_hooks
+        metrics = self.metrics
+
+        if metrics is not None or hooks:
+            start = time.perf_counter()
+
+        if packet.payload and client.stream is None:
+            packet.payload = client.decrypt(packet.payload, packet.substream_id)
+
+        if metrics is not None:
+            metrics.observe("prudp_decrypt_seconds", time.perf_counter() - start)
+
+        if hooks:
+            self.fire_stage("decrypt", start, len(packet.payload), packet)
+            start = time.perf_counter()
+
+        if packet.fragment_id != 0 and client.stream is None:
+            client.fragment_sizer.observe(len(packet.payload))
+
+        message = client.reassemble(packet)
+        if message is None:
+            return
+
+        if hooks:
+            self.fire_stage("reassembly", start, len(message), packet)
+            start = time.perf_counter()
+
+        packet.payload = self.compression.decompress(message)
+
+        try:
+            packet.rmc_request = RMCRequest.from_bytes(packet.payload)
+        except Exception:
+            self.emit("Data", packet)
+            return
+
+        if hooks:
+            self.fire_stage("rmc_decode", start, len(packet.payload), packet)
+
+        request = packet.rmc_request
+        handler = self.rmc_handlers.get((request["protocol"], request["method"]))
+        if handler is not None:
+            offload = self.offload
+            if offload is None or not offload.handles(request["protocol"]) or not offload.submit(packet):
+                self.dispatch("RMC", lambda packet: self.handle_rmc(packet, handler), packet)
+
+        self.emit("Data", packet)
+
+    def new_connection_signature(self, client: PRUDPClient) -> bytes:
+        signature = os.urandom(16)
+        if self.capture is not None:
+            # Replays need the signatures this server handed out to validate the recorded packets
+            self.capture.record(client.address, signature, CAPTURE_SIGNATURE)
+        return signature
+
+    def start_capture(self, path: str) -> CaptureWriter:
+        self.capture = CaptureWriter(path)
+        return self.capture
+
+    def stop_capture(self):
+        capture = self.capture
+        self.capture = None
+        if capture is not None:
+            capture.close()
+
+    def check_cookie(self, packet: PRUDPPacket) -> bool:
+        client = packet.client
+        for cookie in self.syn_cookies.candidates(client.address):
+            client.server_connection_signature = cookie
+            if packet.valid_signature():
+                return True
+        return False
+
+    def validate_ticket(self, client: PRUDPClient, payload: bytes):
+        try:
+            ticket_size = struct.unpack_from("<I", payload, 0)[0]
+            ticket_data = bytes(payload[4:4 + ticket_size])
+            request_size = struct.unpack_from("<I", payload, 4 + ticket_size)[0]
+            request_data = bytes(payload[8 + ticket_size:8 + ticket_size + request_size])
+
+            if not self.kerberos_key:
+                self.kerberos_key = derive_kerberos_key(2, self.kerberos_password.encode())
+
+            ticket = KerberosTicketInternal.decrypt(self.kerberos_key, ticket_data, self.kerberos_derivation)
+            cipher = KerberosCipher(ticket.session_key)
+            pid, cid, check = struct.unpack("<III", cipher.decrypt(request_data))
+        except Exception:
+            return None
+
+        if pid != ticket.user_pid:
+            return None
+
+        client.pid = pid
+        client.set_session_key(ticket.session_key)
+
+        response = cipher.encrypt(struct.pack("<I", (check + 1) & 0xFFFFFFFF))
+        return struct.pack("<I", len(response)) + response
+
+    def reset_client(self, client: PRUDPClient):
+        client.pending.clear()
+        client.session_key = bytearray()
+        client.max_substream_id = 0
+        client.substreams = [Substream(DEFAULT_RC4_KEY)]
+        client.client_connection_signature = bytearray()
+        client.congestion = self.congestion_control()
+        client.rtt = RTTEstimator()
+        client.fragment_sizer = self.new_fragment_sizer()
+        client.in_flight = 0
+        client.next_send = 0.0
+
     def acknowledge_packet(self, packet: PRUDPPacket, payload: bytearray):
         client = packet.client
 
-        ack_packet = PRUDPPacket()
+        if self.metrics is not None:
+            self.metrics.inc("prudp_acks_out_total")
 
-        if self.prudp_version == 0:
-            ack_packet = PRUDPPacketV0(client, None)
-        else:
-            ack_packet = PRUDPPacketV1(client, None)
+        ack_packet = self.new_packet(client, None)
 
         ack_packet.source = packet.destination
         ack_packet.destination = packet.source
         ack_packet.packet_type = packet.packet_type
+        ack_packet.session_id = client.session_id
+        ack_packet.sequence_id = packet.sequence_id
         ack_packet.fragment_id = packet.fragment_id
         ack_packet.flags |= FLAG_ACK
         ack_packet.flags |= FLAG_HAS_SIZE
@@ -213,54 +983,178 @@ class PRUDPServer(PRUDPClient):
         if payload != None:
             ack_packet.payload = payload
 
-        if self.prudp_version == 0:
-            packet = PRUDPPacketV1()
-            ack_packet = PRUDPPacketV1()
-
-            ack_packet.version = 1
-            ack_packet.substream_id = 0
-            ack_packet.flags |= FLAG_HAS_SIZE
-
-            if packet.packet_type == SYN_PACKET:
-                serv_connection_signature = os.urandom(16)
-                ack_packet.server_connection_signature = serv_connection_signature
-                ack_packet.supported_functions = packet.supported_functions
-                ack_packet.max_substream_id = 0
-                ack_packet.connection_signature = serv_connection_signature
-
-            if packet.packet_type == CONNECT_PACKET:
-                ack_packet.connection_signature = bytes(16)
-                ack_packet.supported_functions = packet.supported_functions
-                ack_packet.initial_sequence_id = 10000
-                ack_packet.max_substream_id = 0
-
-            if packet.packet_type == DATA_PACKET:
-                pass # TODO 
-    
+        if packet.packet_type == SYN_PACKET:
+            ack_packet.connection_signature = client.server_connection_signature
+
+        if packet.packet_type == CONNECT_PACKET:
+            ack_packet.connection_signature = bytes(16)
+            ack_packet.initial_sequence_id = 10000
+
+        if isinstance(ack_packet, PRUDPPacketV1):
+            ack_packet.substream_id = packet.substream_id
+            ack_packet.supported_functions = packet.supported_functions
+            ack_packet.max_substream_id = min(packet.max_substream_id, self.max_substream_id)
+
+        if isinstance(ack_packet, PRUDPPacketLite):
+            ack_packet.source_stream_type = packet.destination_stream_type
+            ack_packet.destination_stream_type = packet.source_stream_type
+            ack_packet.supported_functions = packet.supported_functions
+
+        self.send_raw(client, ack_packet.encode(), packet.packet_type)
+
+    def drop_unverified(self):
+        if self.rate_limiter is not None:
+            self.rate_limiter.drop_unverified()
+
+    def enable_metrics(self, address: str = None) -> Metrics:
+        metrics = Metrics()
+        metrics.gauge("prudp_active_sessions", lambda: len(self.clients))
+        metrics.gauge("prudp_running_handlers", lambda: self.running_handlers)
+        metrics.gauge("prudp_srtt_seconds_avg", lambda: self.average_transport_stat("srtt"))
+        metrics.gauge("prudp_loss_ratio_avg", lambda: self.average_transport_stat("loss"))
+        metrics.gauge("rmc_cache_bytes", lambda: self.response_cache.size)
+        metrics.gauge("rmc_offload_outstanding", lambda: self.offload.outstanding() if self.offload is not None else 0)
+        self.metrics = metrics
+        self.response_cache.metrics = metrics
+        if address is not None:
+            metrics.serve(address)
+        return metrics
+
+    def stats(self) -> dict:
+        stats = self.metrics.stats() if self.metrics is not None else {}
+        if self.rate_limiter is not None:
+            stats["rate_limiter"] = self.rate_limiter.stats()
+        if self.response_cache.ttls:
+            stats["response_cache"] = self.response_cache.stats()
+        if self.offload is not None:
+            stats["offload"] = self.offload.stats()
+        return stats
+
+    def transport_stats(self) -> dict:
+        return {key: client.transport_stats() for key, client in list(self.clients.items()) if client.stream is None}
+
+    def average_transport_stat(self, name: str) -> float:
+        values = [stats[name] for stats in self.transport_stats().values() if stats["rtt_samples"]]
+        return sum(values) / len(values) if values else 0.0
+
+    def add_stage_hook(self, stage: str, hook):
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage: {stage}")
+        # Copy on write so receive threads never iterate over a list being modified
+        hooks = dict(self.stage_hooks)
+        hooks[stage] = hooks.get(stage, []) + [hook]
+        self.stage_hooks = hooks
+
+    def remove_stage_hook(self, stage: str, hook):
+        hooks = dict(self.stage_hooks)
+        remaining = [h for h in hooks.get(stage, []) if h != hook]
+        if remaining:
+            hooks[stage] = remaining
+        else:
+            hooks.pop(stage, None)
+        self.stage_hooks = hooks
+
+    def fire_stage(self, stage: str, start: float, size: int, packet):
+        hooks = self.stage_hooks.get(stage)
+        if hooks:
+            elapsed = time.perf_counter() - start
+            for hook in hooks:
+                hook(stage, elapsed, size, packet)
+
     def emit(self, event: str, packet):
         handlers = self.generic_event_handles.get(event, [])
         for handler in handlers:
-            threading.Thread(target=handler, args=(packet,)).start()
+            self.dispatch(event, handler, packet)
 
         if isinstance(packet, PRUDPPacketV0):
             handlers = self.prudp_v0_event_handles.get(event, [])
             for handler in handlers:
-                threading.Thread(target=handler, args=(packet,)).start()
+                self.dispatch(event, handler, packet)
 
         if isinstance(packet, PRUDPPacketV1):
             handlers = self.prudp_v1_event_handles.get(event, [])
             for handler in handlers:
-                threading.Thread(target=handler, args=(packet,)).start()
+                self.dispatch(event, handler, packet)
 
-    def kick(self, client: PRUDPClient):
-        if self.prudp_version == 0:
-            packet = PRUDPPacketV0(client, None)
+        if isinstance(packet, PRUDPPacketLite):
+            handlers = self.prudp_lite_event_handles.get(event, [])
+            for handler in handlers:
+                self.dispatch(event, handler, packet)
+
+    def dispatch(self, event: str, handler, packet):
+        if self.metrics is None:
+            target, args = handler, (packet,)
+        else:
+            target, args = self.dispatch_timed, (event, handler, packet)
+        if self.inline_handlers:
+            # Simulations run handlers on the caller's thread to stay deterministic
+            target(*args)
         else:
-            packet = PRUDPPacketV1(client, None)
+            threading.Thread(target=target, args=args, name="nex-handler").start()
+
+    def dispatch_timed(self, event: str, handler, packet):
+        metrics = self.metrics
+        with metrics.lock:
+            self.running_handlers += 1
+        start = time.perf_counter()
+        try:
+            handler(packet)
+        finally:
+            elapsed = time.perf_counter() - start
+            with metrics.lock:
+                self.running_handlers -= 1
+            # RMC calls are timed around the registered handler alone, in timed_rmc
+            if event != "RMC":
+                metrics.observe("prudp_event_handler_seconds", elapsed, (("event", event),))
+
+    def timed_rmc(self, handler, packet):
+        start = time.perf_counter()
+        try:
+            return handler(packet)
+        finally:
+            if self.metrics is not None:
+                rmc_request = packet.rmc_request
+                self.metrics.handler(rmc_request["protocol"], rmc_request["method"], time.perf_counter() - start)
+            self.fire_stage("handler", start, len(packet.payload), packet)
+
+    def register_rmc(self, protocol: int, method: int, handler):
+        # The handler receives the packet and returns the response body, or raises NEXError
+        self.rmc_handlers[(protocol, method)] = handler
+
+    def cache_rmc(self, protocol: int, method: int, ttl: float):
+        # Opt-in: every caller with the same parameters gets the same response for ttl seconds
+        self.response_cache.enable(protocol, method, ttl)
+
+    def offload_rmc(self, protocols, workers: int = None, ring_size: int = 4 << 20) -> 'OffloadPool':
+        # CPU-bound protocols run in worker processes; register their handlers first and call this before listen
+        from offload import OffloadPool
+        if self.offload is not None:
+            self.offload.close()
+        self.offload = OffloadPool(self, protocols, workers, ring_size)
+        return self.offload
+
+    def handle_rmc(self, packet: PRUDPPacket, handler):
+        if self.metrics is not None or "handler" in self.stage_hooks:
+            registered = handler
+            handler = lambda packet: self.timed_rmc(registered, packet)
+        # Responses go back on the substream the request came in on
+        self.send_rmc(packet.client, self.response_cache.call(handler, packet), packet.substream_id)
+
+    def send_rmc(self, client: PRUDPClient, body: bytes, substream_id: int = 0):
+        packet = self.new_packet(client, None).new(DATA_PACKET, FLAG_RELIABLE | FLAG_NEED_ACK | FLAG_HAS_SIZE)
+        packet.substream_id = substream_id
+        packet.payload = struct.pack("<I", len(body)) + body
+        self.send(packet)
+
+    def kick(self, client: PRUDPClient):
+        packet = self.new_packet(client, None)
 
         self.emit("Kick", packet)
 
         client.connected = False
+        client.pending.clear()
+        if client.stream is not None:
+            client.stream.close()
 
         discriminator = f"{client.address[0]}:{client.address[1]}"
         if discriminator in self.clients:
@@ -268,6 +1162,7 @@ class PRUDPServer(PRUDPClient):
 
 
     def on(self, event: str, handler):
+        import inspect
         params = list(inspect.signature(handler).parameters.values())
         if len(params) != 1:
             raise ValueError("Handler must take exactly one argument")
@@ -280,45 +1175,264 @@ class PRUDPServer(PRUDPClient):
             self.prudp_v0_event_handles.setdefault(event, []).append(handler)
         elif param_type == PRUDPPacketV1:
             self.prudp_v1_event_handles.setdefault(event, []).append(handler)
+        elif param_type == PRUDPPacketLite:
+            self.prudp_lite_event_handles.setdefault(event, []).append(handler)
         else:
             raise ValueError("Handler type not recognized")
 
     def send_ping(self, client: PRUDPClient):
-        ping_packet = PRUDPPacket()
-
-        if self.prudp_version == 0:
-            ping_packet = PRUDPPacketV0(client, None)
-        else:
-            ping_packet = PRUDPPacketV1(client, None)
+        ping_packet = self.new_packet(client, None)
 
-        ping_packet.source = 0xA1
-        ping_packet.destination = 0xAF
+        ping_packet.source = client.source
+        ping_packet.destination = client.destination
+        ping_packet.session_id = client.session_id
         ping_packet.packet_type = PING_PACKET
         ping_packet.flags |= FLAG_NEED_ACK
         ping_packet.flags |= FLAG_RELIABLE
 
         self.send(ping_packet)
 
-    def send_fragment(self, packet: PRUDPPacket, fragment_id: int):
-        data = packet.payload
+    def send_probe(self, client: PRUDPClient, size: int):
+        # A ping padded to the size of a larger fragment. It is never retransmitted and data never goes
+        # out at an untested size, so a path that drops large datagrams only costs the probe
+        probe = self.new_packet(client, None)
+        probe.source = client.source
+        probe.destination = client.destination
+        probe.session_id = client.session_id
+        probe.packet_type = PING_PACKET
+        probe.flags |= FLAG_NEED_ACK | FLAG_RELIABLE | FLAG_HAS_SIZE
+        # Data fragments carry a fragment id a ping does not, so pad the probe to the full size of a fragment
+        fragment = probe.new(DATA_PACKET, probe.flags)
+        probe.payload = bytes(size + len(fragment.encode()) - len(probe.encode()))
+        client.ping_sequence_id = (client.ping_sequence_id + 1) & 0xFFFF
+        probe.sequence_id = client.ping_sequence_id
+        client.fragment_sizer.start_probe(probe.sequence_id, self.clock() + client.retransmit_timeout(0, self.resend_timeout))
+        self.send_raw(client, probe.encode(), PING_PACKET)
+
+    def send_raw(self, client: PRUDPClient, data: bytes, packet_type: int):
+        if client.stream is not None:
+            client.stream.write(data)
+        else:
+            self.socket.sendto(data, client.address)
+        if self.metrics is not None:
+            self.metrics.packet_out(packet_type, len(data))
+
+    def prepare_fragment(self, packet: PRUDPPacket, fragment_id: int) -> bytes:
+        client = packet.client
         packet.fragment_id = fragment_id
-        packet.payload = data
-        # TODO: Finish this
+
+        with client.lock:
+            if packet.packet_type == PING_PACKET:
+                client.ping_sequence_id = (client.ping_sequence_id + 1) & 0xFFFF
+                packet.sequence_id = client.ping_sequence_id
+            elif packet.flags & FLAG_RELIABLE:
+                # Sequence ids and the RC4 stream must advance in the same order
+                packet.sequence_id = client.next_sequence_id(packet.substream_id)
+            if packet.packet_type == DATA_PACKET and packet.payload:
+                packet.payload = client.encrypt(packet.payload, packet.substream_id)
+            data = packet.encode()
+            if packet.flags & FLAG_NEED_ACK:
+                client.pending[(packet.packet_type, packet.substream_id, packet.sequence_id)] = [data, client.clock(), 0]
+                if packet.packet_type == DATA_PACKET:
+                    client.in_flight += 1
+                    client.packets_sent += 1
+        return data
+
+    def send_fragment(self, packet: PRUDPPacket, fragment_id: int):
+        hooks = self.stage_hooks
+        if hooks:
+            start = time.perf_counter()
+        data = self.prepare_fragment(packet, fragment_id)
+        self.send_raw(packet.client, data, packet.packet_type)
+        if hooks:
+            self.fire_stage("send", start, len(data), packet)
+
+    def send_lite(self, packet: PRUDPPacket, fragments: list):
+        # No RC4, acks or retransmission: the stream transport is already reliable and ordered
+        client = packet.client
+        hooks = self.stage_hooks
+        with client.lock:
+            for i, fragment in enumerate(fragments):
+                if hooks:
+                    start = time.perf_counter()
+                fragment_packet = packet.new(packet.packet_type, packet.flags)
+                fragment_packet.payload = fragment
+                fragment_packet.fragment_id = 0 if i == len(fragments) - 1 else i % 255 + 1
+                fragment_packet.sequence_id = client.next_sequence_id()
+                data = fragment_packet.encode()
+                self.send_raw(client, data, packet.packet_type)
+                if hooks:
+                    self.fire_stage("send", start, len(data), fragment_packet)
 
     def send(self, packet: PRUDPPacket):
         data = packet.payload
-        total_len = len(data)
-        fragments = total_len // self.fragment_size
-
-        fragment_id = 1
-        for _ in range(fragments + 1):
-            time.sleep(0.5)
-            if len(data) < self.fragment_size:
-                packet.payload = data
-                self.send_fragment(packet, 0)
-            else:
-                fragment = data[:self.fragment_size]
-                packet.payload = fragment
-                self.send_fragment(packet, fragment_id)
-                data = data[self.fragment_size:]
-                fragment_id += 1
\ No newline at end of file
+        if packet.packet_type == DATA_PACKET:
+            data = self.compression.compress(data)
+
+        if packet.client.stream is not None:
+            # Lite carries up to 64 KiB per packet, so messages are only split when they exceed that
+            self.send_lite(packet, [data[i:i + LITE_MAX_PAYLOAD] for i in range(0, len(data), LITE_MAX_PAYLOAD)] or [b""])
+            return
+
+        client = packet.client
+        fragment_size = client.fragment_sizer.size
+        fragments = [data[i:i + fragment_size] for i in range(0, len(data), fragment_size)] or [b""]
+
+        windowed = packet.packet_type == DATA_PACKET and packet.flags & FLAG_NEED_ACK
+
+        # Fragments of one message must not interleave with another send to the same client
+        with client.lock:
+            substream = client.substreams[packet.substream_id]
+            for i, fragment in enumerate(fragments):
+                fragment_packet = packet.new(packet.packet_type, packet.flags)
+                fragment_packet.source = packet.source
+                fragment_packet.destination = packet.destination
+                fragment_packet.substream_id = packet.substream_id
+                fragment_packet.payload = fragment
+                # Fragment ids are one byte and 0 marks the last one, so long messages wrap from 255 to 1
+                fragment_id = 0 if i == len(fragments) - 1 else i % 255 + 1
+                if windowed:
+                    substream.queue.append((fragment_packet, fragment_id))
+                else:
+                    self.send_fragment(fragment_packet, fragment_id)
+            if windowed:
+                self.flush(client)
+
+    def flush(self, client: PRUDPClient):
+        # Round robin over the substreams, so a large transfer on one cannot hold back small calls on another.
+        # The congestion controller decides how many packets may be in flight and how far apart they go out
+        with client.lock:
+            congestion = client.congestion
+            substreams = client.substreams
+            while client.in_flight < congestion.window:
+                for i in range(len(substreams)):
+                    substream = substreams[(client.next_substream + i) % len(substreams)]
+                    if substream.queue:
+                        break
+                else:
+                    return
+
+                interval = congestion.pacing_interval(client.rtt.srtt)
+                if interval:
+                    now = client.clock()
+                    if now < client.next_send:
+                        if not client.flush_scheduled:
+                            client.flush_scheduled = True
+                            self.pacer.call_at(client.next_send, self.paced_flush, client)
+                        return
+                    client.next_send = max(client.next_send + interval, now)
+
+                client.next_substream = (client.next_substream + i + 1) % len(substreams)
+                fragment_packet, fragment_id = substream.queue.popleft()
+                self.send_fragment(fragment_packet, fragment_id)
+
+    def paced_flush(self, client: PRUDPClient):
+        with client.lock:
+            client.flush_scheduled = False
+            if client.connected:
+                self.flush(client)
+
+    def broadcast(self, clients, payload: bytes, packet_type: int = DATA_PACKET, flags: int = FLAG_RELIABLE | FLAG_NEED_ACK | FLAG_HAS_SIZE):
+        # Compression and fragmentation happen once for all recipients; only the sequence id,
+        # RC4 stream and signature are per client. Returns how many clients the message went to,
+        # whether it was sent right away or queued behind their congestion window and pacing
+        hooks = self.stage_hooks
+        if hooks:
+            start = time.perf_counter()
+        data = payload
+        if packet_type == DATA_PACKET:
+            data = self.compression.compress(data)
+
+        # Clients can be on different fragment sizes, so split once per size in use
+        fragments_by_size = {}
+        lite_fragments = None
+
+        batch = []
+        recipients = 0
+        for client in clients:
+            if not client.connected:
+                continue
+            recipients += 1
+            packet = self.new_packet(client, None).new(packet_type, flags)
+            if client.stream is not None:
+                if lite_fragments is None:
+                    lite_fragments = [data[i:i + LITE_MAX_PAYLOAD] for i in range(0, len(data), LITE_MAX_PAYLOAD)] or [b""]
+                self.send_lite(packet, lite_fragments)
+                continue
+
+            fragment_size = client.fragment_sizer.size
+            fragments = fragments_by_size.get(fragment_size)
+            if fragments is None:
+                fragments = [data[i:i + fragment_size] for i in range(0, len(data), fragment_size)] or [b""]
+                fragments_by_size[fragment_size] = fragments
+            last = len(fragments) - 1
+
+            with client.lock:
+                substream = client.substreams[0]
+                congestion = client.congestion
+                queued = substream.queue or client.in_flight + len(fragments) > congestion.window or congestion.pacing_interval(client.rtt.srtt) > 0
+                for i, fragment in enumerate(fragments):
+                    fragment_packet = packet.new(packet_type, flags)
+                    fragment_packet.payload = fragment
+                    if queued:
+                        substream.queue.append((fragment_packet, 0 if i == last else i % 255 + 1))
+                    else:
+                        batch.append((self.prepare_fragment(fragment_packet, 0 if i == last else i % 255 + 1), client.address))
+                if queued:
+                    # Earlier messages are still waiting for the window, this one has to go after them
+                    self.flush(client)
+
+        self.send_batch(batch, packet_type)
+        if hooks:
+            self.fire_stage("send", start, sum(len(data) for data, address in batch), None)
+        return recipients
+
+    def broadcast_rmc(self, clients, protocol: int, method: int, params: bytes) -> int:
+        # Server initiated calls such as NotificationEvent share one call id across the fan-out
+        with self.lock:
+            self.call_id = (self.call_id + 1) & 0xFFFFFFFF
+            call_id = self.call_id
+        return self.broadcast(clients, RMCRequest(protocol, 0, call_id, method, params).to_bytes())
+
+    def send_batch(self, batch: list, packet_type: int):
+        sendto = self.socket.sendto
+        for data, address in batch:
+            sendto(data, address)
+        if self.metrics is not None:
+            for data, address in batch:
+                self.metrics.packet_out(packet_type, len(data))
+
+    def resend_loop(self):
+        while not self.draining:
+            time.sleep(min(self.resend_timeout / 4, 0.05))
+            self.resend_pending()
+
+    def resend_pending(self):
+        now = self.clock()
+        for client in list(self.clients.values()):
+            expired = False
+            with client.lock:
+                for (packet_type, substream_id, sequence_id), entry in client.pending.items():
+                    if now - entry[1] < client.retransmit_timeout(entry[2], self.resend_timeout):
+                        continue
+                    if entry[2] >= self.resend_max:
+                        expired = True
+                        break
+                    entry[1] = now
+                    entry[2] += 1
+                    self.socket.sendto(entry[0], client.address)
+                    if packet_type == DATA_PACKET:
+                        client.retransmits += 1
+                        if entry[2] == 1:
+                            client.fragment_sizer.on_loss()
+                        client.congestion.on_loss(now, client.rtt.srtt)
+                    if self.metrics is not None:
+                        self.metrics.inc("prudp_retransmits_total")
+                if not expired and client.stream is None:
+                    sizer = client.fragment_sizer
+                    sizer.check_probe(now)
+                    if sizer.probe_size and sizer.probe_sequence is None:
+                        self.send_probe(client, sizer.probe_size)
+            if expired:
+                self.emit("Timeout", self.new_packet(client, None))
+                self.kick(client)
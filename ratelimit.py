@@ -0,0 +1,122 @@
+import hmac
+import hashlib
+import os
+import struct
+import time
+import threading
+from typing import Dict
+from common import SYN_PACKET, CONNECT_PACKET
+
+
+class TokenBucket:
+    __slots__ = ["rate", "burst", "tokens", "last"]
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def consume(self, now: float, amount: float = 1) -> bool:
+        tokens = self.tokens + (now - self.last) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.last = now
+        if tokens < amount:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - amount
+        return True
+
+    def idle(self, now: float) -> bool:
+        return self.tokens + (now - self.last) * self.rate >= self.burst
+
+
+class RateLimiter:
+    def __init__(self, address_rate=200, address_burst=400, global_rate=50000, global_burst=100000, max_addresses=65536):
+        self.address_rate = address_rate
+        self.address_burst = address_burst
+        self.max_addresses = max_addresses
+        self.global_bucket = TokenBucket(global_rate, global_burst, time.monotonic())
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.lock = threading.Lock()
+        self.counters = {
+            "accepted": 0,
+            "dropped_global": 0,
+            "dropped_address": 0,
+            "dropped_table_full": 0,
+            "dropped_unverified": 0
+        }
+
+    def allow(self, address) -> bool:
+        now = time.monotonic()
+        ip = address[0]
+        with self.lock:
+            if not self.global_bucket.consume(now):
+                self.counters["dropped_global"] += 1
+                return False
+
+            bucket = self.buckets.get(ip)
+            if bucket is None:
+                if len(self.buckets) >= self.max_addresses:
+                    self.purge(now)
+                    if len(self.buckets) >= self.max_addresses:
+                        self.counters["dropped_table_full"] += 1
+                        return False
+                bucket = TokenBucket(self.address_rate, self.address_burst, now)
+                self.buckets[ip] = bucket
+
+            if not bucket.consume(now):
+                self.counters["dropped_address"] += 1
+                return False
+
+            self.counters["accepted"] += 1
+            return True
+
+    def purge(self, now: float):
+        # Buckets that have refilled completely carry no state worth keeping
+        for ip in [ip for ip, bucket in self.buckets.items() if bucket.idle(now)]:
+            del self.buckets[ip]
+
+    def drop_unverified(self):
+        with self.lock:
+            self.counters["dropped_unverified"] += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+            stats["tracked_addresses"] = len(self.buckets)
+            return stats
+
+
+class SynCookies:
+    def __init__(self, secret: bytes = None, lifetime: int = 30):
+        self.secret = secret or os.urandom(16)
+        self.lifetime = lifetime
+
+    def make(self, address, slot: int = None) -> bytes:
+        if slot is None:
+            slot = int(time.monotonic()) // self.lifetime
+        mac = hmac.new(self.secret, digestmod=hashlib.md5)
+        mac.update(f"{address[0]}:{address[1]}".encode())
+        mac.update(struct.pack("<Q", slot))
+        return mac.digest()
+
+    def candidates(self, address) -> list:
+        slot = int(time.monotonic()) // self.lifetime
+        return [self.make(address, slot), self.make(address, slot - 1)]
+
+
+def peek_packet_type(data, prudp_version: int) -> int:
+    # Reads the packet type straight from the raw datagram without building a packet
+    if prudp_version == 0:
+        if len(data) < 4:
+            return -1
+        return struct.unpack_from("<H", data, 2)[0] & 0xF
+    if len(data) < 14 or data[0] != 0xEA or data[1] != 0xD0:
+        return -1
+    return struct.unpack_from("<H", data, 8)[0] & 0xF
+
+
+def is_handshake(packet_type: int) -> bool:
+    return packet_type == SYN_PACKET or packet_type == CONNECT_PACKET
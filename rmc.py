@@ -1,4 +1,18 @@
 import struct
+import logging
+from errors import NEXError, ERROR_MASK, error_names, common_errors
+
+# protocol, success, error, call
+ERROR_TEMPLATE = struct.Struct("<BBII")
+ERROR_CALL_OFFSET = 6
+
+logger = logging.getLogger(__name__)
+
+# The common errors are packed at import, other known codes the first time they are sent
+error_templates = {
+    code | ERROR_MASK: ERROR_TEMPLATE.pack(0, 0, code | ERROR_MASK, 0)
+    for name, code in common_errors
+}
 
 class RMCRequest:
     FMT_BASE = "<I"
@@ -99,11 +113,15 @@ class RMCResponse:
 
     def set_error(self, err_code):
         self.data["success"] = 0
-        if not (err_code & 0x10000000):
-            err_code |= 0x10000000
-        self.data["error"] = err_code
+        if isinstance(err_code, NEXError):
+            self.data["error"] = err_code.result
+        else:
+            self.data["error"] = err_code | ERROR_MASK
 
     def to_bytes(self):
+        if self.data["success"] == 0 and self.data["protocol"] != 0x7F:
+            return RMCResponse.error_bytes(self.data["protocol"], self.data["call"], self.data["error"])
+
         out = bytearray()
         out.append(self.data["protocol"])
         if self.data["protocol"] == 0x7F:
@@ -122,4 +140,69 @@ class RMCResponse:
 
     @staticmethod
     def new(protocol, call):
-        return RMCResponse(protocol=protocol, call=call)
\ No newline at end of file
+        return RMCResponse(protocol=protocol, call=call)
+
+    @staticmethod
+    def from_bytes(byts):
+        if len(byts) < 14:
+            raise ValueError("Data too short")
+        sz = struct.unpack_from("<I", byts, 0)[0]
+        if sz != len(byts) - 4:
+            raise ValueError("Size mismatch")
+
+        pos = 4
+        response = RMCResponse(protocol=byts[pos])
+        pos += 1
+
+        if response.data["protocol"] == 0x7F:
+            response.data["custom"] = struct.unpack_from("<H", byts, pos)[0]
+            pos += 2
+
+        response.data["success"] = byts[pos]
+        pos += 1
+
+        if response.data["success"] == 1:
+            response.data["call"], method = struct.unpack_from("<II", byts, pos)
+            response.data["method"] = method & ~0x8000
+            response.data["resp_data"] = bytes(byts[pos + 8:])
+        else:
+            response.data["error"], response.data["call"] = struct.unpack_from("<II", byts, pos)
+        return response
+
+    @staticmethod
+    def error_bytes(protocol, call, err_code, custom=0):
+        if isinstance(err_code, NEXError):
+            err_code = err_code.result
+        else:
+            err_code |= ERROR_MASK
+
+        if protocol == 0x7F:
+            out = bytearray([protocol])
+            out += struct.pack("<HBII", custom, 0, err_code, call)
+            return bytes(out)
+
+        template = error_templates.get(err_code)
+        if template is None:
+            template = ERROR_TEMPLATE.pack(0, 0, err_code, 0)
+            if err_code & ~ERROR_MASK in error_names:
+                error_templates[err_code] = template
+
+        out = bytearray(template)
+        out[0] = protocol
+        struct.pack_into("<I", out, ERROR_CALL_OFFSET, call)
+        return bytes(out)
+
+
+def call_handler(handler, packet) -> bytes:
+    # Runs an RMC handler and returns the response body (without the size prefix), turning
+    # NEXError and unexpected exceptions into error responses
+    request = packet.rmc_request
+    try:
+        response = RMCResponse(request["protocol"], request["custom"], request["call"])
+        response.set_success(request["method"], handler(packet))
+        return response.to_bytes()
+    except NEXError as e:
+        return RMCResponse.error_bytes(request["protocol"], request["call"], e, request["custom"])
+    except Exception:
+        logger.exception("RMC handler failed")
+        return RMCResponse.error_bytes(request["protocol"], request["call"], NEXError("Core::Exception"), request["custom"])
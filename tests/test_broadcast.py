@@ -0,0 +1,58 @@
+import time
+import threading
+from congestion import AIMD, FixedWindow
+from prudp import PRUDPServer
+
+
+class RecordingSocket:
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def sendto(self, data, address):
+        with self.lock:
+            self.sent.append((bytes(data), address))
+        return len(data)
+
+    def per_address(self) -> dict:
+        with self.lock:
+            counts = {}
+            for data, address in self.sent:
+                counts[address] = counts.get(address, 0) + 1
+            return counts
+
+
+def fanout_server(congestion_control, clients: int):
+    server = PRUDPServer()
+    server.access_key = "ridfebb9"
+    server.congestion_control = congestion_control
+    server.socket = RecordingSocket()
+    recipients = []
+    for i in range(clients):
+        client = server.new_client(("127.0.0.1", 10000 + i))
+        client.connected = True
+        # One round trip measured, so AIMD paces its window over it
+        client.rtt.update(0.02)
+        recipients.append(client)
+    return server, recipients
+
+
+def test_paced_broadcast_reaches_every_client():
+    server, recipients = fanout_server(AIMD, 4)
+    assert recipients[0].congestion.pacing_interval(recipients[0].rtt.srtt) > 0
+    idle = server.new_client(("127.0.0.1", 20000))
+
+    # 3000 bytes is three fragments each, all of them queued for the pacer
+    assert server.broadcast(recipients + [idle], bytes(3000)) == 4
+
+    deadline = time.monotonic() + 2.0
+    while server.socket.per_address() != {client.address: 3 for client in recipients} and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert server.socket.per_address() == {client.address: 3 for client in recipients}
+    assert all(len(client.pending) == 3 for client in recipients)
+
+
+def test_unpaced_broadcast_sends_at_once():
+    server, recipients = fanout_server(FixedWindow, 4)
+    assert server.broadcast(recipients, bytes(3000)) == 4
+    assert server.socket.per_address() == {client.address: 3 for client in recipients}
@@ -0,0 +1,26 @@
+from prudp import PRUDPServer
+
+
+class Packet:
+    def __init__(self, call: int):
+        self.rmc_request = {"protocol": 10, "method": 1, "call": call, "custom": 0, "params": b"key"}
+
+
+def test_cache_expires_on_server_clock():
+    now = [100.0]
+    calls = []
+    server = PRUDPServer()
+    server.clock = lambda: now[0]
+    server.cache_rmc(10, 1, 5.0)
+
+    def handler(packet):
+        calls.append(packet.rmc_request["call"])
+        return b"value"
+
+    server.response_cache.call(handler, Packet(1))
+    now[0] += 4.0
+    server.response_cache.call(handler, Packet(2))
+    assert calls == [1]
+    now[0] += 2.0
+    server.response_cache.call(handler, Packet(3))
+    assert calls == [1, 3]
@@ -0,0 +1,32 @@
+import asyncio
+from prudp import PRUDPServer
+from client import PRUDPConnection, resend_timer
+from netsim import Network
+
+
+def test_connections_share_one_resend_timer():
+    server = PRUDPServer()
+    server.access_key = "ridfebb9"
+    server.register_rmc(10, 1, lambda packet: packet.rmc_request["params"])
+    network = Network(server, seed=5, loss=0.05, latency=0.02)
+
+    async def scenario():
+        timer = resend_timer(asyncio.get_running_loop())
+        connections = [PRUDPConnection(1, "ridfebb9", seed=i) for i in range(50)]
+        await asyncio.gather(*[connection.connect(network.server_address) for connection in connections])
+        assert set(timer.connections) == set(connections)
+        assert all(connection.resend_timer is timer for connection in connections)
+        results = await asyncio.gather(*[connection.call(10, 1, b"ping") for connection in connections])
+        retransmits = sum(connection.stats["retransmits"] for connection in connections)
+        for connection in connections:
+            await connection.close()
+        return timer, results, retransmits
+
+    try:
+        timer, results, retransmits = network.run(scenario())
+    finally:
+        network.close()
+    assert results == [b"ping"] * 50
+    # Lost packets were still resent, now by the shared timer, which stops once every connection is gone
+    assert retransmits > 0
+    assert not timer.connections and timer.handle is None
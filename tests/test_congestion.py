@@ -0,0 +1,81 @@
+import asyncio
+from congestion import AIMD, FixedWindow
+from prudp import PRUDPServer
+from client import PRUDPConnection
+from netsim import Network, Link
+
+
+def transfer(congestion_control, seed: int = 4):
+    # One session fetching large responses, first over a clean link and then over a lossy one
+    server = PRUDPServer()
+    server.access_key = "ridfebb9"
+    server.congestion_control = congestion_control
+    server.register_rmc(10, 1, lambda packet: bytes(200000))
+    network = Network(server, seed=seed, latency=0.02)
+    trace = {"losses": []}
+
+    async def scenario():
+        connection = PRUDPConnection(1, "ridfebb9", seed=seed)
+        await connection.connect(network.server_address)
+        congestion = next(iter(server.clients.values())).congestion
+        initial = congestion.window
+
+        on_loss = congestion.on_loss
+
+        def record_loss(now, srtt):
+            before = congestion.window
+            on_loss(now, srtt)
+            trace["losses"].append((before, congestion.window))
+
+        congestion.on_loss = record_loss
+
+        for _ in range(2):
+            assert len(await connection.call(10, 1)) == 200000
+        trace["clean"] = (initial, congestion.window)
+
+        address = connection.transport.get_extra_info("sockname")
+        network.set_links(address, Link(latency=0.02), Link(loss=0.05, latency=0.02))
+        for _ in range(2):
+            assert len(await connection.call(10, 1)) == 200000
+        trace["lossy"] = congestion.window
+        await connection.close()
+
+    try:
+        network.run(scenario())
+    finally:
+        network.close()
+    return trace
+
+
+def test_aimd_window_grows_without_loss_and_halves_on_loss():
+    trace = transfer(AIMD)
+    initial, grown = trace["clean"]
+    assert grown > initial * 4
+    losses = trace["losses"]
+    assert losses
+    for before, after in losses:
+        assert after == max(before / 2, 2) or after == before
+    # At least one loss actually cut the window, and it ended up below where the clean link left it
+    assert any(after < before for before, after in losses)
+    assert trace["lossy"] < grown
+
+
+def test_fixed_window_never_moves():
+    trace = transfer(FixedWindow)
+    assert trace["clean"] == (32, 32)
+    assert trace["losses"]
+    assert all(before == after == 32 for before, after in trace["losses"])
+
+
+def test_aimd_paces_a_window_over_a_round_trip():
+    congestion = AIMD(initial_window=8)
+    assert congestion.pacing_interval(0.0) == 0.0
+    # Eight packets spread over 80 ms, sent 25% faster than that so pacing never limits the window
+    assert abs(congestion.pacing_interval(0.08) - 0.08 / (8 * 1.25)) < 1e-12
+    congestion.on_loss(1.0, 0.08)
+    assert congestion.window == 4
+    # A second loss within the same round trip belongs to the same window
+    congestion.on_loss(1.05, 0.08)
+    assert congestion.window == 4
+    congestion.on_loss(1.1, 0.08)
+    assert congestion.window == 2
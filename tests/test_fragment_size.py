@@ -0,0 +1,57 @@
+import asyncio
+import pytest
+from common import DATA_PACKET, FLAG_RELIABLE, FLAG_NEED_ACK, FLAG_HAS_SIZE
+from prudp import PRUDPServer
+from client import PRUDPConnection
+from netsim import Network, Link
+
+
+class MTULink(Link):
+    # Drops every datagram larger than the path MTU, the way a router without fragmentation would
+    def __init__(self, mtu: int, **link):
+        super().__init__(**link)
+        self.mtu = mtu
+        self.oversized = 0
+
+    def schedule(self, now, size, rng):
+        if size > self.mtu:
+            self.oversized += 1
+            return []
+        return super().schedule(now, size, rng)
+
+
+def data_overhead(server) -> int:
+    client = server.new_client(("10.0.0.9", 1))
+    packet = server.new_packet(client, None).new(DATA_PACKET, FLAG_RELIABLE | FLAG_NEED_ACK | FLAG_HAS_SIZE)
+    return len(packet.encode())
+
+
+@pytest.mark.parametrize("mtu", [1350, 1380, 1395, 1420, 1500])
+def test_fragment_size_converges_below_path_mtu(mtu):
+    server = PRUDPServer()
+    server.access_key = "ridfebb9"
+    server.register_rmc(10, 1, lambda packet: bytes(100000))
+    network = Network(server, seed=1, latency=0.01)
+    overhead = data_overhead(server)
+
+    async def scenario():
+        connection = PRUDPConnection(1, "ridfebb9", seed=1)
+        await connection.connect(network.server_address)
+        network.set_links(connection.transport.get_extra_info("sockname"), MTULink(mtu, latency=0.01), MTULink(mtu, latency=0.01))
+        for _ in range(8):
+            assert len(await asyncio.wait_for(connection.call(10, 1), 30)) == 100000
+        client = next(iter(server.clients.values()))
+        await connection.close()
+        return client.fragment_sizer.size, client.retransmits
+
+    try:
+        size, retransmits = network.run(scenario())
+    finally:
+        network.close()
+    # The largest step the path carries, starting from 1300 in steps of 32 up to the 1400 maximum
+    expected = 1300
+    while expected < 1400 and min(expected + 32, 1400) + overhead <= mtu:
+        expected = min(expected + 32, 1400)
+    assert size == expected
+    # Only probes may hit the MTU, never a data fragment
+    assert retransmits == 0
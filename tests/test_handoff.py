@@ -0,0 +1,90 @@
+import asyncio
+import threading
+import pytest
+from common import DATA_PACKET
+from capture import NullSocket
+from congestion import RTTEstimator
+from handoff import write_snapshot, restore_snapshot
+from prudp import PRUDPServer
+from client import PRUDPConnection
+
+
+def echo_server():
+    server = PRUDPServer()
+    server.access_key = "ridfebb9"
+    server.register_rmc(10, 1, lambda packet: packet.rmc_request["params"])
+    return server
+
+
+def test_handoff_replays_queued_datagram(tmp_path):
+    path = str(tmp_path / "nex.sock")
+    old = echo_server()
+    old.enable_handoff(path)
+    ready = threading.Event()
+    old.on("Syn", lambda packet: ready.set())
+    old_thread = threading.Thread(target=old.listen, args=("127.0.0.1:0",), daemon=True)
+    old_thread.start()
+
+    async def scenario():
+        while old.socket is None or not old.receive_threads:
+            await asyncio.sleep(0.01)
+        address = old.socket.getsockname()
+        connection = PRUDPConnection(1, "ridfebb9")
+        await connection.connect(address)
+        assert await connection.call(10, 1, b"before") == b"before"
+
+        # Stop the old server reading, as a handoff does, so the next call is only seen by the drain
+        old.draining = True
+        for thread in old.receive_threads:
+            thread.join()
+        # Only the queued datagram may answer the call, never a retransmit
+        connection.session.rtt = RTTEstimator(30.0, 30.0, 30.0)
+        call = asyncio.ensure_future(connection.call(10, 1, b"queued"))
+        loop = asyncio.get_running_loop()
+        while not old.handoff_backlog:
+            await loop.run_in_executor(None, old.handle_socket_message)
+
+        new = echo_server()
+        threading.Thread(target=new.resume, args=(path,), daemon=True).start()
+        assert await asyncio.wait_for(call, 5) == b"queued"
+        host, port = connection.transport.get_extra_info("sockname")[:2]
+        assert list(new.clients) == [f"{host}:{port}"]
+        assert connection.stats["retransmits"] == 0
+        await connection.close()
+
+    asyncio.run(scenario())
+
+
+def test_enable_handoff_keeps_other_files(tmp_path):
+    path = tmp_path / "nex.sock"
+    path.write_text("not a socket")
+    with pytest.raises(ValueError):
+        echo_server().enable_handoff(str(path))
+    assert path.read_text() == "not a socket"
+
+
+def test_restored_resends_are_spread_out():
+    old = echo_server()
+    clients = [old.new_client(("10.0.0.2", 40000 + i)) for i in range(4)]
+    for client in clients:
+        client.connected = True
+        for sequence_id in range(5):
+            client.pending[(DATA_PACKET, 0, sequence_id)] = [bytes(20), 123.0, 0]
+    snapshot = write_snapshot(clients, [])
+
+    now = [1000.0]
+    new = echo_server()
+    new.socket = NullSocket()
+    new.clock = lambda: now[0]
+    restore_snapshot(new, snapshot)
+    assert len(new.clients) == 4
+
+    # Nothing is due straight after the restart, then the 20 packets come due over one resend interval
+    new.resend_pending()
+    assert new.socket.packets == 0
+    now[0] += new.resend_timeout / 2
+    new.resend_pending()
+    assert new.socket.packets == 10
+    now[0] += new.resend_timeout / 2
+    new.resend_pending()
+    assert new.socket.packets == 20
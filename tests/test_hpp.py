@@ -0,0 +1,132 @@
+import hmac
+import time
+import asyncio
+import hashlib
+from hpp import HPPServer, HPPConnection
+from rmc import RMCRequest, RMCResponse
+from errors import NEXError
+from kerberos import derive_kerberos_key
+
+ACCESS_KEY = "76f26496"
+PASSWORDS = {1000: "password"}
+
+
+def make_server():
+    server = HPPServer()
+    server.access_key = ACCESS_KEY
+    server.lookups = []
+
+    def password_lookup(pid):
+        server.lookups.append(pid)
+        return PASSWORDS.get(pid)
+
+    def echo(packet):
+        params = packet.rmc_request["params"]
+        if params == b"slow":
+            time.sleep(0.1)
+        return params + str(packet.client.pid).encode()
+
+    server.password_lookup = password_lookup
+    server.register_rmc(10, 1, echo)
+    return server
+
+
+def hpp_request(call: int, params: bytes, pid: int = 1000, password: str = "password", headers: str = "") -> bytes:
+    body = RMCRequest(10, 0, call, 1, params).to_bytes()
+    signature1 = hmac.new(bytes.fromhex(ACCESS_KEY), body, hashlib.md5).hexdigest()
+    signature2 = hmac.new(derive_kerberos_key(pid, password.encode()), body, hashlib.md5).hexdigest()
+    head = (f"POST /hpp/ HTTP/1.1\r\nHost: nex\r\npid: {pid}\r\nsignature1: {signature1}\r\n"
+            f"signature2: {signature2}\r\nContent-Length: {len(body)}\r\n{headers}\r\n")
+    return head.encode() + body
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode().split("\r\n")
+    headers = dict(line.split(": ", 1) for line in lines[1:] if line)
+    body = await reader.readexactly(int(headers["Content-Length"]))
+    status = int(lines[0].split(" ")[1])
+    return status, headers, RMCResponse.from_bytes(body) if status == 200 else None
+
+
+def run(server, scenario):
+    async def main():
+        listener = await asyncio.get_running_loop().create_server(lambda: HPPConnection(server), "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            return await asyncio.wait_for(scenario(reader, writer), 10)
+        finally:
+            writer.close()
+            listener.close()
+            await listener.wait_closed()
+
+    return asyncio.run(main())
+
+
+def test_pipelined_responses_keep_request_order():
+    async def scenario(reader, writer):
+        # The first call is the slowest, its response still has to go out first
+        writer.write(hpp_request(1, b"slow") + hpp_request(2, b"fast") + hpp_request(3, b"") + b"POST /other HTTP/1.1\r\n\r\n")
+        return [await read_response(reader) for _ in range(4)]
+
+    responses = run(make_server(), scenario)
+    assert [response.data["call"] for status, headers, response in responses[:3]] == [1, 2, 3]
+    assert [response.data["resp_data"] for status, headers, response in responses[:3]] == [b"slow1000", b"fast1000", b"1000"]
+    assert responses[3][0] == 404
+
+
+def test_keep_alive_until_connection_close():
+    async def scenario(reader, writer):
+        writer.write(hpp_request(1, b"a"))
+        first = await read_response(reader)
+        # A request split over writes on the same connection
+        data = hpp_request(2, b"b" * 5000, headers="Connection: close\r\n")
+        writer.write(data[:30])
+        await asyncio.sleep(0.05)
+        writer.write(data[30:])
+        second = await read_response(reader)
+        return first, second, await reader.read()
+
+    first, second, rest = run(make_server(), scenario)
+    assert first[1]["Connection"] == "keep-alive"
+    assert first[2].data["resp_data"] == b"a1000"
+    assert second[1]["Connection"] == "close"
+    assert second[2].data["resp_data"] == b"b" * 5000 + b"1000"
+    assert rest == b""
+
+
+def test_bad_signature_is_access_denied():
+    server = make_server()
+
+    async def scenario(reader, writer):
+        writer.write(hpp_request(1, b"x", password="wrong") + hpp_request(2, b"x", pid=2000))
+        request = bytearray(hpp_request(3, b"x"))
+        request[-1] ^= 0xFF
+        writer.write(request)
+        return [await read_response(reader) for _ in range(3)]
+
+    responses = run(server, scenario)
+    for status, headers, response in responses:
+        assert status == 200
+        assert response.data["success"] == 0
+        assert response.data["error"] == NEXError("Core::AccessDenied").result
+    assert [response.data["call"] for status, headers, response in responses] == [1, 2, 3]
+
+
+def test_account_key_is_derived_once_per_pid():
+    server = make_server()
+
+    async def scenario(reader, writer):
+        results = []
+        for call in range(1, 4):
+            writer.write(hpp_request(call, b"x"))
+            results.append(await read_response(reader))
+        server.forget(1000)
+        writer.write(hpp_request(4, b"x"))
+        results.append(await read_response(reader))
+        return results
+
+    responses = run(server, scenario)
+    assert all(response.data["success"] == 1 for status, headers, response in responses)
+    assert server.lookups == [1000, 1000]
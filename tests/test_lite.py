@@ -0,0 +1,199 @@
+import os
+import struct
+import asyncio
+from lite import LiteStream, WebSocketStream, LITE_MAX_PACKET, WEBSOCKET_BINARY, WEBSOCKET_CLOSE, WEBSOCKET_PING, WEBSOCKET_PONG
+
+
+class RecordingServer:
+    # Stands in for PRUDPServer: the parser only hands whole packets over
+    def __init__(self):
+        self.packets = []
+        self.clients = {}
+
+    def new_stream_client(self, stream):
+        return object()
+
+    def handle_stream_packet(self, client, data):
+        self.packets.append(bytes(data))
+
+    def kick(self, client):
+        pass
+
+
+class LoopbackTransport:
+    def __init__(self):
+        self.written = bytearray()
+        self.closed = False
+
+    def get_extra_info(self, name, default=None):
+        return ("127.0.0.1", 50000) if name == "peername" else default
+
+    def write(self, data):
+        self.written += data
+
+    def writelines(self, chunks):
+        for chunk in chunks:
+            self.written += chunk
+
+    def close(self):
+        self.closed = True
+
+
+def lite_packet(payload: bytes, options: bytes = b"") -> bytes:
+    return struct.pack("<BBH", 0x80, len(options), len(payload)) + bytes(8) + options + payload
+
+
+def masked_frame(opcode: int, payload: bytes, final: bool = True, mask: bool = True) -> bytes:
+    length = len(payload)
+    flag = 0x80 if mask else 0
+    if length < 126:
+        header = struct.pack(">BB", (0x80 if final else 0) | opcode, flag | length)
+    elif length < 0x10000:
+        header = struct.pack(">BBH", (0x80 if final else 0) | opcode, flag | 126, length)
+    else:
+        header = struct.pack(">BBQ", (0x80 if final else 0) | opcode, flag | 127, length)
+    if not mask:
+        return header + payload
+    key = os.urandom(4)
+    return header + key + bytes(byte ^ key[i % 4] for i, byte in enumerate(payload))
+
+
+def feed(stream: LiteStream, data: bytes, chunk: int = 1 << 20):
+    # Same calls the event loop makes for a BufferedProtocol, at most chunk bytes per read
+    while data:
+        buffer = stream.get_buffer(-1)
+        size = min(len(buffer), len(data), chunk)
+        buffer[:size] = data[:size]
+        stream.buffer_updated(size)
+        data = data[size:]
+
+
+def open_stream(cls, **kwargs):
+    server = RecordingServer()
+    transport = LoopbackTransport()
+
+    async def connect():
+        stream = cls(server, **kwargs)
+        stream.connection_made(transport)
+        return stream
+
+    return asyncio.run(connect()), server, transport
+
+
+def upgrade(stream: WebSocketStream, transport: LoopbackTransport):
+    feed(stream, b"GET /lite HTTP/1.1\r\nHost: nex\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                 b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n")
+    response = bytes(transport.written)
+    transport.written.clear()
+    return response
+
+
+def read_frames(data: bytes) -> list:
+    frames = []
+    while data:
+        opcode, length = data[0] & 0x0F, data[1] & 0x7F
+        offset = 2
+        if length == 126:
+            length, offset = struct.unpack_from(">H", data, 2)[0], 4
+        elif length == 127:
+            length, offset = struct.unpack_from(">Q", data, 2)[0], 10
+        frames.append((opcode, data[offset:offset + length]))
+        data = data[offset + length:]
+    return frames
+
+
+def test_lite_header_split_across_reads():
+    stream, server, transport = open_stream(LiteStream)
+    packets = [lite_packet(b"a" * 10), lite_packet(b"b" * 300, b"\x01\x02"), lite_packet(b"")]
+    feed(stream, b"".join(packets), chunk=1)
+    assert server.packets == packets
+    assert not transport.closed
+
+
+def test_lite_packet_larger_than_buffer():
+    stream, server, transport = open_stream(LiteStream, buffer_size=4096)
+    packets = [lite_packet(os.urandom(0xFFFF), os.urandom(0xFF)), lite_packet(b"tail")]
+    assert len(packets[0]) == LITE_MAX_PACKET
+    feed(stream, b"".join(packets), chunk=5000)
+    assert server.packets == packets
+
+
+def test_lite_bad_magic_closes():
+    stream, server, transport = open_stream(LiteStream)
+    feed(stream, b"\x81" + lite_packet(b"x")[1:])
+    assert server.packets == []
+    assert transport.closed
+
+
+def test_websocket_handshake():
+    stream, server, transport = open_stream(WebSocketStream)
+    response = upgrade(stream, transport)
+    assert response.startswith(b"HTTP/1.1 101 ")
+    # The key and accept value from the example in RFC 6455
+    assert b"Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n" in response
+
+
+def test_websocket_handshake_without_upgrade_is_refused():
+    stream, server, transport = open_stream(WebSocketStream)
+    feed(stream, b"GET / HTTP/1.1\r\nHost: nex\r\n\r\n")
+    assert transport.written.startswith(b"HTTP/1.1 400 ")
+    assert transport.closed
+
+
+def test_websocket_unmasks_frames_split_across_reads():
+    stream, server, transport = open_stream(WebSocketStream)
+    upgrade(stream, transport)
+    packets = [lite_packet(os.urandom(n)) for n in (0, 1, 3, 200, 5000)]
+    frames = masked_frame(WEBSOCKET_BINARY, packets[0] + packets[1]) + b"".join(masked_frame(WEBSOCKET_BINARY, packet) for packet in packets[2:])
+    feed(stream, frames, chunk=7)
+    assert server.packets == packets
+    assert not transport.closed
+
+
+def test_websocket_frame_over_64k():
+    stream, server, transport = open_stream(WebSocketStream)
+    upgrade(stream, transport)
+    packet = lite_packet(os.urandom(0xFFFF), os.urandom(0xFF))
+    frame = masked_frame(WEBSOCKET_BINARY, packet)
+    assert frame[1] & 0x7F == 127
+    feed(stream, frame, chunk=4096)
+    assert server.packets == [packet]
+
+
+def test_websocket_frame_size_limit():
+    stream, server, transport = open_stream(WebSocketStream)
+    upgrade(stream, transport)
+    buffer_size = len(stream.buffer)
+    # Only the header arrives: the claimed length alone must close the stream before any buffer grows
+    feed(stream, struct.pack(">BBQ", 0x80 | WEBSOCKET_BINARY, 0x80 | 127, LITE_MAX_PACKET + 1) + os.urandom(4))
+    assert transport.closed
+    assert len(stream.buffer) == buffer_size
+    assert server.packets == []
+
+
+def test_websocket_ping_gets_pong():
+    stream, server, transport = open_stream(WebSocketStream)
+    upgrade(stream, transport)
+    feed(stream, masked_frame(WEBSOCKET_PING, b"hello"))
+    assert read_frames(bytes(transport.written)) == [(WEBSOCKET_PONG, b"hello")]
+    assert not transport.closed
+
+
+def test_websocket_close_is_echoed():
+    stream, server, transport = open_stream(WebSocketStream)
+    upgrade(stream, transport)
+    feed(stream, masked_frame(WEBSOCKET_CLOSE, struct.pack(">H", 1000) + b"bye") + masked_frame(WEBSOCKET_BINARY, lite_packet(b"late")))
+    assert read_frames(bytes(transport.written)) == [(WEBSOCKET_CLOSE, struct.pack(">H", 1000))]
+    assert transport.closed
+    assert server.packets == []
+
+
+def test_websocket_rejects_unmasked_fragmented_and_text_frames():
+    for frame in (masked_frame(WEBSOCKET_BINARY, lite_packet(b"x"), mask=False),
+                  masked_frame(WEBSOCKET_BINARY, lite_packet(b"x"), final=False),
+                  masked_frame(1, b"text")):
+        stream, server, transport = open_stream(WebSocketStream)
+        upgrade(stream, transport)
+        feed(stream, frame)
+        assert transport.closed
+        assert server.packets == []
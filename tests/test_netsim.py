@@ -0,0 +1,54 @@
+import asyncio
+from prudp import PRUDPServer
+from client import PRUDPConnection
+from netsim import Network
+
+SESSIONS = 10
+CALLS = 10
+
+
+def simulate(seed: int, loss: float) -> dict:
+    server = PRUDPServer()
+    server.access_key = "ridfebb9"
+    server.register_rmc(10, 1, lambda packet: packet.rmc_request["params"])
+    network = Network(server, seed=seed, loss=loss, latency=0.02, jitter=0.005)
+
+    async def scenario():
+        connections = [PRUDPConnection(1, "ridfebb9", seed=seed + i) for i in range(SESSIONS)]
+        await asyncio.gather(*[connection.connect(network.server_address) for connection in connections])
+
+        async def session(connection):
+            completed = 0
+            for i in range(CALLS):
+                if await connection.call(10, 1, bytes([i]) * 500) == bytes([i]) * 500:
+                    completed += 1
+            return completed
+
+        completed = sum(await asyncio.gather(*[session(connection) for connection in connections]))
+        retransmits = sum(connection.stats["retransmits"] for connection in connections)
+        for connection in connections:
+            await connection.close()
+        return completed, retransmits
+
+    try:
+        completed, retransmits = network.run(scenario())
+        stats = network.stats()
+    finally:
+        network.close()
+    return {
+        "completed": completed,
+        "retransmits": retransmits,
+        "lost": stats["uplink"]["lost"] + stats["downlink"]["lost"],
+        "virtual_time": stats["virtual_time"]
+    }
+
+
+def test_lossy_network_completes_every_call():
+    result = simulate(seed=7, loss=0.05)
+    assert result["completed"] == SESSIONS * CALLS
+    assert result["lost"] > 0
+    assert result["retransmits"] > 0
+
+
+def test_same_seed_same_run():
+    assert simulate(seed=7, loss=0.05) == simulate(seed=7, loss=0.05)
@@ -0,0 +1,52 @@
+import time
+from common import DATA_PACKET, FLAG_RELIABLE, FLAG_NEED_ACK, FLAG_HAS_SIZE
+from capture import NullSocket
+from prudp import PRUDPServer
+
+
+class StreamSink:
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+
+def send_everything(server, clients):
+    for client in clients:
+        packet = server.new_packet(client, None).new(DATA_PACKET, FLAG_RELIABLE | FLAG_NEED_ACK | FLAG_HAS_SIZE)
+        packet.payload = bytes(3000)
+        server.send(packet)
+    server.broadcast(clients, bytes(3000))
+
+
+def fanout_server():
+    server = PRUDPServer()
+    server.access_key = "ridfebb9"
+    server.socket = NullSocket()
+    udp = server.new_client(("127.0.0.1", 10000))
+    lite = server.new_client(("127.0.0.1", 10001))
+    lite.stream = StreamSink()
+    for client in (udp, lite):
+        client.connected = True
+    return server, [udp, lite]
+
+
+def test_send_path_untimed_without_hooks(monkeypatch):
+    server, clients = fanout_server()
+    calls = []
+    perf_counter = time.perf_counter
+    monkeypatch.setattr(time, "perf_counter", lambda: calls.append(1) or perf_counter())
+    send_everything(server, clients)
+    assert calls == []
+    assert len(clients[1].stream.written) == 2
+
+
+def test_send_stage_fires_with_hooks():
+    server, clients = fanout_server()
+    sizes = []
+    server.add_stage_hook("send", lambda stage, elapsed, size, packet: sizes.append(size))
+    send_everything(server, clients)
+    # Three UDP fragments and one Lite packet per send, then one batch and one Lite packet from the broadcast
+    assert len(sizes) == 6
+    assert all(size > 0 for size in sizes)
@@ -0,0 +1,71 @@
+import asyncio
+import struct
+from common import DATA_PACKET
+from congestion import AIMD
+from prudp import PRUDPServer
+from client import PRUDPConnection
+from netsim import Network
+from ratelimit import RateLimiter, SynCookies
+
+
+class Listener(PRUDPConnection):
+    # Keeps every message the server pushes, which the stock client only matches against its calls
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.messages = []
+
+    def handle_data(self, packet):
+        if packet.payload:
+            packet.payload = self.session.decrypt(packet.payload, packet.substream_id)
+        message = self.session.reassemble(packet)
+        if message is not None:
+            self.messages.append(bytes(message))
+
+
+def test_syn_cookie_clients_receive_paced_broadcasts():
+    server = PRUDPServer()
+    server.access_key = "ridfebb9"
+    server.syn_cookies = SynCookies()
+    server.congestion_control = AIMD
+    network = Network(server, seed=3, latency=0.02, jitter=0.005)
+    payloads = [bytes([i]) * 3000 for i in range(7)]
+
+    async def scenario():
+        listeners = [Listener(1, "ridfebb9", seed=i) for i in range(5)]
+        await asyncio.gather(*[listener.connect(network.server_address) for listener in listeners])
+        assert all(client.connected for client in server.clients.values())
+        for payload in payloads:
+            assert server.broadcast(list(server.clients.values()), payload) == 5
+        while any(len(listener.messages) < len(payloads) for listener in listeners) and network.loop.now < 10:
+            await asyncio.sleep(0.05)
+        messages = [listener.messages for listener in listeners]
+        for listener in listeners:
+            await listener.close()
+        return messages
+
+    try:
+        messages = network.run(scenario())
+    finally:
+        network.close()
+    assert messages == [payloads] * 5
+
+
+def test_unverified_datagrams_keep_no_state():
+    server = PRUDPServer()
+    server.rate_limiter = RateLimiter()
+    server.syn_cookies = SynCookies()
+    data = bytearray(b"\xEA\xD0" + bytes(12))
+    struct.pack_into("<H", data, 8, DATA_PACKET)
+    server.handle_datagram(data, ("10.0.0.2", 40000))
+    assert server.clients == {}
+    assert server.rate_limiter.stats()["dropped_unverified"] == 1
+
+
+def test_rate_limiter_buckets_per_address():
+    limiter = RateLimiter(address_rate=0.001, address_burst=3, global_rate=0.001, global_burst=5)
+    assert [limiter.allow(("10.0.0.2", 1000)) for _ in range(4)] == [True, True, True, False]
+    assert limiter.allow(("10.0.0.3", 1000))
+    # The global bucket is spent now, whatever the address
+    assert not limiter.allow(("10.0.0.4", 1000))
+    stats = limiter.stats()
+    assert (stats["accepted"], stats["dropped_address"], stats["dropped_global"]) == (4, 1, 1)
@@ -0,0 +1,58 @@
+import struct
+from rmc import RMCResponse, error_templates
+from errors import NEXError, ERROR_MASK, error_names, common_errors
+
+
+def generic_error_bytes(protocol: int, call: int, result: int, custom: int = 0) -> bytes:
+    # The error branch of RMCResponse.to_bytes before templates, field by field
+    out = bytearray([protocol])
+    if protocol == 0x7F:
+        out += struct.pack("<H", custom)
+    out.append(0)
+    out += struct.pack("<I", result)
+    out += struct.pack("<I", call)
+    return bytes(out)
+
+
+def test_common_errors_are_prebuilt():
+    assert all(error_names[code] == name for name, code in common_errors)
+    assert all(code | ERROR_MASK in error_templates for name, code in common_errors)
+
+
+def test_error_bytes_match_generic_encoding():
+    codes = [code for name, code in common_errors]
+    # Known but not prebuilt, and a code with no name at all
+    codes += [0x00010003, 0x00690001, 0x00FF1234]
+    for code in codes:
+        for protocol, call in ((10, 1), (0x7E, 0xFFFFFFFF), (1, 0x12345678)):
+            expected = generic_error_bytes(protocol, call, code | ERROR_MASK)
+            assert RMCResponse.error_bytes(protocol, call, code) == expected
+            # Already masked codes are left alone
+            assert RMCResponse.error_bytes(protocol, call, code | ERROR_MASK) == expected
+            response = RMCResponse(protocol, 0, call)
+            response.set_error(code)
+            assert response.to_bytes() == expected
+
+
+def test_error_bytes_from_nex_error():
+    for name in ("Core::AccessDenied", "Ranking::InvalidArgument", "Core::InvalidPointer"):
+        error = NEXError(name)
+        assert RMCResponse.error_bytes(10, 7, error) == generic_error_bytes(10, 7, error.result)
+    error = NEXError.from_code(0x00FF1234)
+    assert RMCResponse.error_bytes(10, 7, error) == generic_error_bytes(10, 7, 0x00FF1234 | ERROR_MASK)
+
+
+def test_error_bytes_custom_protocol():
+    for code in (0x00010006, NEXError("DataStore::NotFound")):
+        result = code.result if isinstance(code, NEXError) else code | ERROR_MASK
+        expected = generic_error_bytes(0x7F, 42, result, custom=0x1234)
+        assert RMCResponse.error_bytes(0x7F, 42, code, 0x1234) == expected
+        response = RMCResponse(0x7F, 0x1234, 42)
+        response.set_error(code)
+        assert response.to_bytes() == expected
+
+
+def test_templates_are_not_shared_between_calls():
+    first = RMCResponse.error_bytes(10, 1, 0x00010006)
+    RMCResponse.error_bytes(11, 2, 0x00010006)
+    assert first == generic_error_bytes(10, 1, 0x00010006 | ERROR_MASK)
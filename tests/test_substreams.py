@@ -0,0 +1,78 @@
+import asyncio
+from prudp import PRUDPServer
+from client import PRUDPConnection
+from netsim import Network
+
+
+def substream_server(seen: dict):
+    server = PRUDPServer()
+    server.access_key = "ridfebb9"
+    server.max_substream_id = 2
+
+    def handler(packet):
+        seen.setdefault(packet.substream_id, []).append(packet.rmc_request["call"])
+        size = int.from_bytes(packet.rmc_request["params"][:4], "little")
+        return bytes(size)
+
+    server.register_rmc(10, 1, handler)
+    return server
+
+
+def test_substreams_deliver_in_order_under_loss_and_reordering():
+    seen = {}
+    server = substream_server(seen)
+    network = Network(server, seed=11, loss=0.05, reorder=0.1, duplicate=0.02, latency=0.02, jitter=0.01)
+
+    async def scenario():
+        connection = PRUDPConnection(1, "ridfebb9", seed=11, max_substream_id=2)
+        await connection.connect(network.server_address)
+        assert connection.session.max_substream_id == 2
+        # Calls on a substream go out in call id order and must reach the handler in that order
+        calls = []
+        for i in range(30):
+            calls.append(connection.call(10, 1, (3000).to_bytes(4, "little"), substream_id=i % 3))
+        results = await asyncio.gather(*calls)
+        retransmits = connection.stats["retransmits"]
+        await connection.close()
+        return results, retransmits
+
+    try:
+        results, retransmits = network.run(scenario())
+    finally:
+        network.close()
+    assert results == [bytes(3000)] * 30
+    assert retransmits > 0
+    assert sorted(seen) == [0, 1, 2]
+    for substream_id, calls in seen.items():
+        assert calls == sorted(calls)
+        assert len(calls) == 10
+
+
+def test_small_call_is_not_stuck_behind_a_large_transfer():
+    seen = {}
+    server = substream_server(seen)
+    network = Network(server, seed=2, latency=0.03, bandwidth=200_000, queue_bytes=64000)
+
+    async def scenario():
+        connection = PRUDPConnection(1, "ridfebb9", seed=2, max_substream_id=2)
+        await connection.connect(network.server_address)
+        loop = asyncio.get_running_loop()
+
+        async def timed(substream_id, size, delay):
+            await asyncio.sleep(delay)
+            start = loop.time()
+            result = await connection.call(10, 1, size.to_bytes(4, "little"), substream_id=substream_id)
+            return loop.time() - start, len(result)
+
+        # The large response takes about two seconds on this link; the small one starts while it is sending
+        large, small = await asyncio.gather(timed(1, 400000, 0), timed(2, 10, 0.2))
+        await connection.close()
+        return large, small
+
+    try:
+        large, small = network.run(scenario())
+    finally:
+        network.close()
+    assert large[1] == 400000 and small[1] == 10
+    assert large[0] > 1.0
+    assert small[0] < 0.5